@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+"""
+Нагрузочные замеры бота на синтетических данных (без обращений к Google Sheets и OpenAI)
+
+Примеры:
+    python3 bench_bot.py tenants --tenants 10 50 200
+    python3 bench_bot.py export --records 50000
+    python3 bench_bot.py records --records 100000
+    python3 bench_bot.py fuzzy --descriptions 50000
+    python3 bench_bot.py trends --records 100000
+    python3 bench_bot.py commands --records 20000 --latency 0.05
+    python3 bench_bot.py workers --workers 1 2 4
+    python3 bench_bot.py context
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import sys
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+from types import SimpleNamespace
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from main import (
+    TENANT_CONFIGS,
+    use_tenant,
+    store_ledger_part,
+    partition_title,
+    EXPORT_WRITERS,
+    EXPORT_CHUNK_SIZE,
+    FINANCE_COLUMNS,
+    records_from_mappings,
+    ingest_finance_rows,
+    RecipientIndex,
+    compute_trends,
+    resolve_context_phrase
+)
+
+def synthetic_records(count, seed=0, start=date(2024, 1, 1)):
+    """Генерирует записи, похожие на строки таблицы финансов (за год от start)"""
+    rng = random.Random(seed)
+    categories = list(main.FINANCE_CATEGORIES)
+    return [
+        {
+            'Дата': (start + timedelta(days=rng.randrange(365))).strftime('%d.%m.%Y'),
+            'Тип операции': 'Расход',
+            'Категория': rng.choice(categories),
+            'Описание/Получатель': f"Получатель {rng.randrange(500)}",
+            'Сумма': -rng.randrange(100, 100000),
+            'Комментарий': ''
+        }
+        for _ in range(count)
+    ]
+
+def bench_tenants(tenant_counts, records_per_tenant):
+    """Память процесса при обращениях все большего числа организаций"""
+    print(f"🏢 Лимит загруженных организаций: {main.TENANT_CACHE_LIMIT}, "
+          f"бюджет записей на организацию: {main.TENANT_RECORD_BUDGET}")
+    records = synthetic_records(records_per_tenant)
+    months = [partition_title(date(2024, month, 1)) for month in range(1, 13)]
+    per_month = max(1, len(records) // len(months))
+
+    for count in tenant_counts:
+        main.LOADED_TENANTS.clear()
+        tracemalloc.start()
+        for i in range(count):
+            name = f"bench-{i}"
+            TENANT_CONFIGS.setdefault(name, {'spreadsheet_id': name})
+            use_tenant(name)
+            for j, title in enumerate(months):
+                # Разбор заново - у каждой организации свои записи
+                store_ledger_part(title, records_from_mappings(records[j * per_month:(j + 1) * per_month], title))
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"• {count} организаций: в памяти {len(main.LOADED_TENANTS)}, "
+              f"занято {current / 2**20:.1f} МБ, пик {peak / 2**20:.1f} МБ")
+
+def measure(func):
+    """Время и пик памяти (МБ) вызова func(); память - вторым запуском, tracemalloc замедляет"""
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 2**20
+
+def bench_export(records_count):
+    """Выгрузка /export в разных форматах против JSON-копии /backup"""
+    records = records_from_mappings(synthetic_records(records_count), 'bench')
+    chunks = lambda: (records[i:i + EXPORT_CHUNK_SIZE] for i in range(0, len(records), EXPORT_CHUNK_SIZE))
+    print(f"📤 Выгрузка {records_count} записей")
+
+    with tempfile.TemporaryDirectory() as directory:
+        def backup():
+            with open(os.path.join(directory, 'backup.json'), 'w', encoding='utf-8') as f:
+                json.dump({'finance_records': len(records), 'finance': [record.as_dict() for record in records]}, f, ensure_ascii=False, indent=2)
+
+        scenarios = [('json (/backup)', 'backup.json', backup)]
+        for export_format, writer in EXPORT_WRITERS.items():
+            path = os.path.join(directory, f"export.{export_format}")
+            scenarios.append((export_format, path, lambda writer=writer, path=path: writer(chunks(), path)))
+
+        for name, path, func in scenarios:
+            try:
+                elapsed, peak = measure(func)
+            except ImportError as e:
+                print(f"• {name}: пропущено, не установлен модуль {e.name}")
+                continue
+            size = os.path.getsize(os.path.join(directory, path))
+            print(f"• {name}: {elapsed:.2f} с, {size / 2**20:.1f} МБ, пик памяти {peak:.1f} МБ")
+
+def bench_records(records_count):
+    """Память записей: словари get_all_records() против разобранных FinanceRecord"""
+    rows = [[str(record[column]) for column in FINANCE_COLUMNS] for record in synthetic_records(records_count)]
+    # Через JSON, как из ответа API: у каждой ячейки своя строка
+    payload = json.dumps([FINANCE_COLUMNS] + rows, ensure_ascii=False)
+    del rows
+
+    def allocated(build):
+        tracemalloc.start()
+        result = build()
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return result, current
+
+    def as_dicts():
+        values = json.loads(payload)
+        return [dict(zip(values[0], row)) for row in values[1:]]
+
+    def as_records():
+        return ingest_finance_rows(json.loads(payload), 'bench')
+
+    started = time.perf_counter()
+    as_records()
+    ingest_seconds = time.perf_counter() - started
+
+    per_100k = 100000 / records_count / 2**20
+    dicts, dicts_bytes = allocated(as_dicts)
+    del dicts
+    records, records_bytes = allocated(as_records)
+    print(f"🧾 Записей: {records_count}, разбор {ingest_seconds:.2f} с")
+    print(f"• словари get_all_records(): {dicts_bytes * per_100k:.1f} МБ на 100 тыс.")
+    print(f"• FinanceRecord: {records_bytes * per_100k:.1f} МБ на 100 тыс.")
+
+def synthetic_names(count, seed=0):
+    """Случайные русские слова-имена из слогов (count разных)"""
+    rng = random.Random(seed)
+    syllables = ['ба', 'ве', 'ги', 'до', 'ку', 'ла', 'ми', 'но', 'пе', 'ро', 'са', 'ти', 'ха', 'це', 'шу', 'ям']
+    endings = ['', 'ов', 'ин', 'ам', 'ев', 'ка']
+    names = set()
+    while len(names) < count:
+        names.add((''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))) + rng.choice(endings)).capitalize())
+    return sorted(names)
+
+def bench_fuzzy(descriptions_count, lookups=1000):
+    """Построение указателя получателей и поиск похожих имен с опечаткой"""
+    names = synthetic_names(descriptions_count)
+    rng = random.Random(1)
+
+    started = time.perf_counter()
+    index = RecipientIndex()
+    for name in names:
+        index.add(name)
+    build_seconds = time.perf_counter() - started
+
+    def typo(name):
+        position = rng.randrange(1, len(name))
+        return name[:position] + rng.choice('аеиоу') + name[position + 1:]
+
+    queries = [typo(rng.choice(names)) for _ in range(lookups)]
+    started = time.perf_counter()
+    for query in queries:
+        index.similar_words(query)
+    lookup_ms = (time.perf_counter() - started) / lookups * 1000
+    print(f"🔤 Разных слов: {len(index.counts)}, построение {build_seconds:.2f} с, "
+          f"похожие слова: {lookup_ms:.2f} мс на запрос")
+
+def bench_trends(records_count):
+    """Расчет /trends по всей истории"""
+    records = records_from_mappings(synthetic_records(records_count), 'bench')
+    today = date(2025, 1, 10)
+    try:
+        elapsed, peak = measure(lambda: compute_trends(records, today))
+    except ImportError as e:
+        print(f"📈 Пропущено: не установлен модуль {e.name}")
+        return
+    print(f"📈 Тренды по {records_count} записям: {elapsed:.2f} с, пик памяти {peak:.1f} МБ")
+
+class FakeTelegram:
+    """Имитация Bot API: считает вызовы, каждый занимает latency секунд"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    async def call(self):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+
+class FakeMessage:
+    """Сообщение чата с методами, которые вызывают обработчики"""
+
+    def __init__(self, api, text=''):
+        self.api = api
+        self.chat_id = 1
+        self.text = text
+
+    async def reply_text(self, text, **kwargs):
+        await self.api.call()
+        return FakeMessage(self.api, text)
+
+    async def edit_text(self, text, **kwargs):
+        await self.api.call()
+        self.text = text
+        return self
+
+    async def delete(self):
+        await self.api.call()
+
+class FakeBot:
+    """Бот для context.bot: отправка файлов и картинок"""
+
+    def __init__(self, api):
+        self.api = api
+
+    async def send_photo(self, **kwargs):
+        await self.api.call()
+
+    async def send_document(self, **kwargs):
+        await self.api.call()
+
+def bench_commands(records_count, latency, repeats=20):
+    """Вызовы Bot API и p95 времени ответа команд с имитацией сетевой задержки Telegram"""
+    name = next(iter(TENANT_CONFIGS))
+    username = next(user for user, tenant in main.TENANT_BY_USERNAME.items() if tenant == name)
+    tenant = use_tenant(name)
+    records = records_from_mappings(synthetic_records(records_count, start=date.today() - timedelta(days=364)), 'bench')
+    store_ledger_part(tenant.sheet_name, records)
+
+    commands = [
+        ('/categories месяц', main.category_analysis, ['месяц']),
+        ('/recipients', main.description_analysis, []),
+        ('/analytics', main.show_analytics, []),
+        ('/search', main.advanced_search, ['Получатель', '7']),
+        ('/suppliers', main.supplier_analysis, ['Получатель']),
+    ]
+    api = FakeTelegram(latency)
+    print(f"💬 Команды на {records_count} записях, задержка Bot API {latency * 1000:.0f} мс")
+
+    async def run():
+        for command, handler, args in commands:
+            calls = api.calls
+            timings = []
+            for _ in range(repeats):
+                update = SimpleNamespace(
+                    message=FakeMessage(api, command),
+                    callback_query=None,
+                    effective_user=SimpleNamespace(id=1, username=username),
+                    effective_chat=SimpleNamespace(id=1)
+                )
+                context = SimpleNamespace(args=list(args), bot=FakeBot(api))
+                started = time.perf_counter()
+                await handler(update, context)
+                timings.append(time.perf_counter() - started)
+            timings.sort()
+            median = timings[len(timings) // 2]
+            p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+            print(f"• {command}: {(api.calls - calls) / repeats:.1f} вызова Bot API, "
+                  f"медиана {median * 1000:.0f} мс, p95 {p95 * 1000:.0f} мс")
+
+    asyncio.run(run())
+
+def run_worker_share(worker_index, worker_count, updates, records_count, latency, queue):
+    """Процесс-обработчик: обновления своих чатов (номер чата по модулю числа процессов)"""
+    name = next(iter(TENANT_CONFIGS))
+    username = next(user for user, tenant in main.TENANT_BY_USERNAME.items() if tenant == name)
+    tenant = use_tenant(name)
+    records = records_from_mappings(synthetic_records(records_count, start=date.today() - timedelta(days=364)), 'bench')
+    store_ledger_part(tenant.sheet_name, records)
+    handlers = {
+        'categories': main.category_analysis,
+        'recipients': main.description_analysis,
+        'analytics': main.show_analytics,
+        'search': main.advanced_search,
+    }
+    api = FakeTelegram(latency)
+    mine = [update for update in updates if update[0] % worker_count == worker_index]
+
+    async def no_chart(*args):
+        return None
+
+    # Графики рисует свой пул процессов - здесь замеряются только обработчики
+    main.try_render_chart = no_chart
+
+    async def handle(chat_id, command, args):
+        if command == 'write':
+            # Запись операции: новая версия данных сбрасывает готовые отчеты
+            main.append_to_ledger_snapshot([date.today().strftime('%d.%m.%Y'), 'Расход', 'Такси', 'Получатель 1', -100, ''], tenant.sheet_name)
+            main.publish_data_change()
+            return
+        message = FakeMessage(api, command)
+        message.chat_id = chat_id
+        update = SimpleNamespace(
+            message=message,
+            callback_query=None,
+            effective_user=SimpleNamespace(id=chat_id, username=username),
+            effective_chat=SimpleNamespace(id=chat_id)
+        )
+        await handlers[command](update, SimpleNamespace(args=list(args), bot=FakeBot(api)))
+
+    async def run():
+        semaphore = asyncio.Semaphore(main.UPDATE_CONCURRENCY)
+
+        async def limited(update):
+            async with semaphore:
+                await handle(*update)
+
+        await asyncio.gather(*(limited(update) for update in mine))
+
+    queue.put('ready')
+    started = time.perf_counter()
+    asyncio.run(run())
+    queue.put((len(mine), time.perf_counter() - started))
+
+def bench_workers(worker_counts, updates_count, records_count, latency):
+    """Пропускная способность при 1, 2, 4... процессах-обработчиках с делением чатов между ними"""
+    rng = random.Random(0)
+    commands = [
+        ('categories', ['месяц']), ('categories', ['неделя']), ('categories', []),
+        ('recipients', []), ('recipients', ['месяц']), ('analytics', []),
+        ('search', ['Получатель', '7']), ('search', ['такси', 'месяц']),
+    ]
+    updates = []
+    for i in range(updates_count):
+        chat_id = rng.randrange(1, 1000)
+        # Каждое пятое обновление - запись операции
+        command, args = ('write', []) if i % 5 == 4 else rng.choice(commands)
+        updates.append((chat_id, command, args))
+    print(f"⚙️ {updates_count} обновлений от 1000 чатов, {records_count} записей, задержка Bot API {latency * 1000:.0f} мс")
+
+    context = multiprocessing.get_context('fork')
+    baseline = None
+    for worker_count in worker_counts:
+        queue = context.Queue()
+        processes = [
+            context.Process(target=run_worker_share, args=(index, worker_count, updates, records_count, latency, queue))
+            for index in range(worker_count)
+        ]
+        for process in processes:
+            process.start()
+        # Время считается с момента, когда все процессы загрузили данные
+        for _ in processes:
+            assert queue.get() == 'ready'
+        started = time.perf_counter()
+        results = [queue.get() for _ in processes]
+        elapsed = time.perf_counter() - started
+        for process in processes:
+            process.join()
+        throughput = updates_count / elapsed
+        baseline = baseline or throughput
+        shares = ", ".join(str(count) for count, _ in results)
+        print(f"• {worker_count} процесс(а): {throughput:.0f} обновлений/с (x{throughput / baseline:.1f}), обновлений по процессам: {shares}")
+
+# Размеченные сообщения с контекстными фразами: (контекст пользователя, сообщение,
+# ожидаемые (получатель, сумма, категория) или None - разбор неоднозначен и нужна модель)
+CONTEXT_LEDGER = [
+    ('Петров', -30000, 'Зарплаты сотрудникам'), ('Петров', -30000, 'Зарплаты сотрудникам'),
+    ('Петров', -25000, 'Зарплаты сотрудникам'), ('ООО Балтика', -12000, 'Оплата поставщику'),
+    ('ООО Балтика', -12000, 'Оплата поставщику'), ('Интигам', -8000, 'Оплата поставщику'),
+    ('Интигам', -9000, 'Оплата поставщику'), ('Мария', -15000, 'Зарплаты сотрудникам'),
+    ('Яндекс такси', -700, 'Такси'), ('Таня', -50000, 'Выплаты учредителям'),
+]
+CONTEXT_USER = {'recent_operations': [
+    'Рустам: -5,000 ₽ (Зарплаты сотрудникам)',
+    'Мария: -18,000 ₽ (Зарплаты сотрудникам)',
+    'Яндекс такси: -650 ₽ (Такси)',
+]}
+CONTEXT_FIXTURES = [
+    (CONTEXT_USER, 'такая же сумма Рустаму', ('Рустам', -650, 'Зарплаты сотрудникам')),
+    (CONTEXT_USER, 'дал Петрову такую же сумму', ('Петров', -650, 'Зарплаты сотрудникам')),
+    (CONTEXT_USER, 'столько же Балтике', ('ООО Балтика', -650, 'Оплата поставщику')),
+    (CONTEXT_USER, 'тому же 3000', ('Яндекс такси', -3000, 'Такси')),
+    (CONTEXT_USER, 'тому же человеку 2,5 тыс', ('Яндекс такси', -2500, 'Такси')),
+    (CONTEXT_USER, 'тому же такую же сумму', ('Яндекс такси', -650, 'Такси')),
+    (CONTEXT_USER, 'обычная зарплата Петрову', ('Петров', -30000, 'Зарплаты сотрудникам')),
+    (CONTEXT_USER, 'обычную зарплату петрову', ('Петров', -30000, 'Зарплаты сотрудникам')),
+    (CONTEXT_USER, 'обычная зарплата Марии', ('Мария', -18000, 'Зарплаты сотрудникам')),
+    (CONTEXT_USER, 'обычная сумма Балтике', ('ООО Балтика', -12000, 'Оплата поставщику')),
+    (CONTEXT_USER, 'как обычно Рустаму', ('Рустам', -5000, 'Зарплаты сотрудникам')),
+    (None, 'обычная зарплата Петрову', ('Петров', -30000, 'Зарплаты сотрудникам')),
+    (None, 'Таня лично как обычно', ('Таня', -50000, 'Выплаты учредителям')),
+    # Неоднозначно - решает модель
+    (CONTEXT_USER, 'обычная сумма Интигаму', None),      # 8000 и 9000 поровну
+    (CONTEXT_USER, 'обычная зарплата Сидорову', None),   # получателя нет ни в контексте, ни в таблице
+    (CONTEXT_USER, 'такая же сумма как вчера Петрову', None),
+    (CONTEXT_USER, 'тому же', None),                     # сумма не названа
+    (CONTEXT_USER, 'обычная зарплата Петрову 31000', None),
+    (CONTEXT_USER, 'пополнил такую же сумму', None),
+    (None, 'такая же сумма Петрову', None),              # контекста нет
+    (None, 'тому же 5000', None),
+]
+
+def bench_context():
+    """Точность локального разбора контекстных фраз на размеченных сообщениях"""
+    tenant = use_tenant(next(iter(TENANT_CONFIGS)))
+    today = date.today().strftime('%d.%m.%Y')
+    store_ledger_part(tenant.sheet_name, records_from_mappings([
+        {'Дата': today, 'Тип операции': 'Расход', 'Категория': category, 'Описание/Получатель': description, 'Сумма': amount, 'Комментарий': ''}
+        for description, amount, category in CONTEXT_LEDGER
+    ], 'bench'))
+    tenant.recipient_index = tenant.recipient_profiles = None
+
+    correct = wrong = missed = fallbacks = 0
+    started = time.perf_counter()
+    for user_context, text, expected in CONTEXT_FIXTURES:
+        analysis = resolve_context_phrase(text, user_context)
+        got = (analysis['description'], analysis['amount'], analysis['category']) if analysis else None
+        if got == expected:
+            correct += 1
+            fallbacks += got is None
+        else:
+            wrong += got is not None
+            missed += got is None
+            print(f"  ✗ {text!r}: ожидалось {expected}, получено {got}")
+    elapsed_ms = (time.perf_counter() - started) / len(CONTEXT_FIXTURES) * 1000
+    resolved = len(CONTEXT_FIXTURES) - fallbacks - missed
+    print(f"🧩 Размеченных сообщений: {len(CONTEXT_FIXTURES)}, верно: {correct} ({correct / len(CONTEXT_FIXTURES):.0%})")
+    print(f"• разобрано без модели: {resolved}, из них с ошибкой: {wrong}")
+    print(f"• передано модели: {fallbacks + missed} (лишних - {missed}), {elapsed_ms:.2f} мс на сообщение")
+    return correct, len(CONTEXT_FIXTURES)
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Нагрузочные замеры бота')
+    subparsers = parser.add_subparsers(dest='scenario', required=True)
+    tenants = subparsers.add_parser('tenants', help='память при росте числа организаций')
+    tenants.add_argument('--tenants', type=int, nargs='+', default=[10, 50, 200])
+    tenants.add_argument('--records', type=int, default=5000, help='записей на организацию')
+    export = subparsers.add_parser('export', help='время и размер выгрузки против JSON-копии')
+    export.add_argument('--records', type=int, default=50000)
+    records = subparsers.add_parser('records', help='память на 100 тыс. записей')
+    records.add_argument('--records', type=int, default=100000)
+    fuzzy = subparsers.add_parser('fuzzy', help='поиск похожих имен в большом указателе получателей')
+    fuzzy.add_argument('--descriptions', type=int, default=50000)
+    trends = subparsers.add_parser('trends', help='время расчета /trends по всей истории')
+    trends.add_argument('--records', type=int, default=100000)
+    commands = subparsers.add_parser('commands', help='вызовы Bot API и время ответа команд')
+    commands.add_argument('--records', type=int, default=20000)
+    commands.add_argument('--latency', type=float, default=0.05, help='секунд на вызов Bot API')
+    workers = subparsers.add_parser('workers', help='пропускная способность при нескольких процессах')
+    workers.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    workers.add_argument('--updates', type=int, default=1000)
+    workers.add_argument('--records', type=int, default=20000)
+    workers.add_argument('--latency', type=float, default=0.05, help='секунд на вызов Bot API')
+    subparsers.add_parser('context', help='точность разбора "такая же сумма" и "обычная зарплата" без модели')
+    args = parser.parse_args()
+
+    if args.scenario == 'tenants':
+        bench_tenants(args.tenants, args.records)
+    elif args.scenario == 'export':
+        bench_export(args.records)
+    elif args.scenario == 'records':
+        bench_records(args.records)
+    elif args.scenario == 'fuzzy':
+        bench_fuzzy(args.descriptions)
+    elif args.scenario == 'trends':
+        bench_trends(args.records)
+    elif args.scenario == 'commands':
+        bench_commands(args.records, args.latency)
+    elif args.scenario == 'workers':
+        bench_workers(args.workers, args.updates, args.records, args.latency)
+    elif args.scenario == 'context':
+        bench_context()
+
+if __name__ == '__main__':
+    main_cli()
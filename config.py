@@ -4,3 +4,57 @@ TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 GOOGLE_SHEET_ID = os.getenv('GOOGLE_SHEET_ID')
 SHEET_NAME = os.getenv('SHEET_NAME', 'Лист1')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+
+# Фоновые задачи: обновление снимка таблицы и утренняя сводка
+LEDGER_REFRESH_MINUTES = int(os.getenv('LEDGER_REFRESH_MINUTES', '10'))
+DIGEST_CHAT_ID = os.getenv('DIGEST_CHAT_ID')
+DIGEST_TIME = os.getenv('DIGEST_TIME', '09:00')
+
+# Разбиение таблицы финансов по месяцам: 'off' - один лист SHEET_NAME, 'month' - лист на каждый месяц
+LEDGER_PARTITIONING = os.getenv('LEDGER_PARTITIONING', 'off')
+
+# Несколько организаций в одном процессе: JSON-реестр {имя: {spreadsheet_id, worksheet, users}}
+TENANTS_FILE = os.getenv('TENANTS_FILE', 'tenants.json')
+# Сколько организаций держать в памяти одновременно и сколько записей кэшировать на одну
+TENANT_CACHE_LIMIT = int(os.getenv('TENANT_CACHE_LIMIT', '20'))
+TENANT_RECORD_BUDGET = int(os.getenv('TENANT_RECORD_BUDGET', '200000'))
+# Через сколько минут простоя организация выгружается из памяти
+TENANT_IDLE_MINUTES = int(os.getenv('TENANT_IDLE_MINUTES', '120'))
+# Месячные бюджеты категорий расходов (без TENANTS_FILE): JSON {"Такси": 20000, ...}.
+# В реестре организаций бюджеты задаются полем "budgets"
+BUDGETS = os.getenv('BUDGETS', '')
+
+# Основное хранилище операций: 'sheets' - Google Таблица, 'sqlite' - локальная база,
+# которая в фоне копируется в таблицу (таблица остается интерфейсом для ручных правок)
+LEDGER_STORE = os.getenv('LEDGER_STORE', 'sheets')
+LEDGER_DB_DIR = os.getenv('LEDGER_DB_DIR', 'data')
+# Как часто отправлять новые и измененные записи из базы в таблицу
+LEDGER_REPLICATION_SECONDS = int(os.getenv('LEDGER_REPLICATION_SECONDS', '30'))
+
+# Сколько процессов рисуют графики PNG
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', '2'))
+
+# Отчеты считаются в пуле из REPORT_WORKERS потоков; не успевший за REPORT_DEADLINE_SECONDS
+# отчет заменяется кратким
+REPORT_WORKERS = int(os.getenv('REPORT_WORKERS', '4'))
+REPORT_DEADLINE_SECONDS = float(os.getenv('REPORT_DEADLINE_SECONDS', '10'))
+# Сколько обновлений Telegram обрабатывать одновременно
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '16'))
+# Соединения с Bot API: ответы параллельных обработчиков не ждут свободного соединения
+TELEGRAM_POOL_SIZE = int(os.getenv('TELEGRAM_POOL_SIZE', '32'))
+TELEGRAM_TIMEOUT_SECONDS = float(os.getenv('TELEGRAM_TIMEOUT_SECONDS', '10'))
+# Отладка кэша отчетов: ответ из кэша помечается строкой внизу
+REPORT_CACHE_DEBUG = os.getenv('REPORT_CACHE_DEBUG', '0') == '1'
+
+# Несколько процессов-обработчиков: каждый получает обновления своих чатов (номер чата по модулю
+# WORKER_COUNT) через webhook_router.py. Общее состояние процессов - в Redis (STATE_BACKEND=redis)
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', '1'))
+WORKER_INDEX = int(os.getenv('WORKER_INDEX', '0'))
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+# Вебхук: внешний адрес (его задает роутер), порт первого процесса (процесс i слушает порт + i)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8081'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+ROUTER_PORT = int(os.getenv('ROUTER_PORT', os.getenv('PORT', '8080')))
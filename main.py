@@ -1,1299 +1,5359 @@
-message = update.message if update.message else update.callback_query.message
+import asyncio
+import contextvars
+import csv
+import gzip
+import heapq
+import io
+import itertools
+import logging
+import multiprocessing
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from collections import Counter, OrderedDict, deque
+from contextvars import ContextVar
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from datetime import datetime, timedelta
+import pytz
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.helpers import escape_markdown
+from telegram.error import BadRequest
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+import gspread
+from gspread.utils import numericise
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from google.oauth2.service_account import Credentials
+from openai import OpenAI
+from openai.types import CompletionUsage
+from config import (
+    TELEGRAM_TOKEN, GOOGLE_SHEET_ID, SHEET_NAME, OPENAI_API_KEY,
+    LEDGER_REFRESH_MINUTES, DIGEST_CHAT_ID, DIGEST_TIME, LEDGER_PARTITIONING,
+    TENANTS_FILE, TENANT_CACHE_LIMIT, TENANT_RECORD_BUDGET, TENANT_IDLE_MINUTES, BUDGETS,
+    LEDGER_STORE, LEDGER_DB_DIR, LEDGER_REPLICATION_SECONDS, CHART_WORKERS,
+    REPORT_WORKERS, REPORT_DEADLINE_SECONDS, UPDATE_CONCURRENCY,
+    TELEGRAM_POOL_SIZE, TELEGRAM_TIMEOUT_SECONDS, REPORT_CACHE_DEBUG,
+    WORKER_COUNT, WORKER_INDEX, STATE_BACKEND, REDIS_URL,
+    WEBHOOK_URL, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET
+)
 
-    try:
-        await message.reply_text("📊 Получаю историю с контекстом...")
+# Московское время
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
 
-        # История из контекста
-        user_context = USER_CONTEXT.get(user_id, {})
-        recent_ops = user_context.get('recent_operations', [])
+def get_moscow_time():
+    """Возвращает текущее московское время"""
+    return datetime.now(MOSCOW_TZ)
 
-        if recent_ops:
-            history = "🧠 **Контекст последних операций:**\n\n"
-            for i, op in enumerate(reversed(recent_ops[-5:]), 1):
-                history += f"{i}. {op}\n"
-        else:
-            history = "📊 **Контекст пуст** - начните добавлять операции!\n\n"
+def format_moscow_date():
+    """Возвращает дату в московском времени в формате ДД.ММ.ГГГГ"""
+    return get_moscow_time().strftime('%d.%m.%Y')
 
-        # Последние из таблицы
-        finance_records = finance_sheet.get_all_records()
-        recent_finance = finance_records[-3:] if len(finance_records) > 3 else finance_records
+# Настройка логирования
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
 
-        if recent_finance:
-            history += "\n💰 **Последние финансовые операции:**\n"
-            for record in reversed(recent_finance):
-                emoji = "📈" if record.get('Сумма', 0) > 0 else "📉"
-                history += f"{emoji} {record.get('Описание/Получатель', '')}: {record.get('Сумма', 0):,.0f} ₽\n"
+# Настройка OpenAI
+client = OpenAI(api_key=OPENAI_API_KEY)
 
-        await message.reply_text(history, parse_mode='Markdown')
+# Настройка Google Sheets
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 
-    except Exception as e:
-        logger.error(f"Ошибка истории: {e}")
-        await message.reply_text("❌ Ошибка при получении истории.")
+# Читаем credentials из переменной окружения
+creds_json = os.getenv('GOOGLE_CREDENTIALS')
+if creds_json:
+    creds_info = json.loads(creds_json)
+    creds = Credentials.from_service_account_info(creds_info, scopes=SCOPES)
+else:
+    # Fallback на файл для локальной разработки
+    creds = Credentials.from_service_account_file('credentials.json', scopes=SCOPES)
 
-async def show_analytics(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Умная аналитика трат"""
-    if not is_allowed_user(update):
-        await update.message.reply_text('Нет доступа')
-        return
-    try:
-        # Получаем message объект правильно
-        message = update.message if update.message else update.callback_query.message
+gc = gspread.authorize(creds)
 
-        await message.reply_text("📊 Анализирую ваши финансы...")
+# Колонки таблицы финансов
+FINANCE_COLUMNS = ['Дата', 'Тип операции', 'Категория', 'Описание/Получатель', 'Сумма', 'Комментарий']
 
-        # Получаем данные за последний месяц
-        month_ago = datetime.now() - timedelta(days=30)
-        finance_records = finance_sheet.get_all_records()
+# Организация по умолчанию (если нет файла TENANTS_FILE) - прежний единственный пользователь
+ALLOWED_USERNAME = 'antigorevich'
+DEFAULT_TENANT = 'default'
+
+def load_tenant_configs():
+    """Читает реестр организаций: {имя: {spreadsheet_id, worksheet, users, ...}}"""
+    if TENANTS_FILE and os.path.exists(TENANTS_FILE):
+        with open(TENANTS_FILE, encoding='utf-8') as f:
+            return json.load(f)
+    return {
+        DEFAULT_TENANT: {
+            'spreadsheet_id': GOOGLE_SHEET_ID,
+            'worksheet': SHEET_NAME,
+            'users': [ALLOWED_USERNAME],
+            'digest_chat_id': DIGEST_CHAT_ID,
+            'budgets': json.loads(BUDGETS) if BUDGETS else {}
+        }
+    }
 
-        recent_records = []
-        for record in finance_records:
-            try:
-                record_date = datetime.strptime(record.get('Дата', ''), '%d.%m.%Y')
-                if record_date >= month_ago:
-                    recent_records.append(record)
-            except:
-                continue
+class TenantState:
+    """Состояние одной организации: таблица, снимок данных, каталог разделов и контекст пользователей"""
+
+    def __init__(self, name, config):
+        self.name = name
+        self.spreadsheet_id = config['spreadsheet_id']
+        self.sheet_name = config.get('worksheet', SHEET_NAME)
+        self.partitioning = config.get('partitioning', LEDGER_PARTITIONING)
+        self.digest_chat_id = config.get('digest_chat_id')
+        self.store = config.get('store', LEDGER_STORE)
+        # Месячные бюджеты категорий расходов: {категория: лимит в рублях}
+        self.budgets = config.get('budgets', {})
+        self.spreadsheet = None
+        self.worksheets = {}
+        # Заголовки листов и число занятых строк (с заголовком) - для чтения диапазонами
+        self.sheet_headers = {}
+        self.row_counts = {}
+        # Версия данных в общем состоянии, которую этот процесс уже учел (см. sync_shared_state)
+        self.shared_version = 0
+        # Снимок данных: parts - записи по листам в порядке последнего использования
+        self.ledger = {'parts': OrderedDict(), 'version': 0}
+        # Снимок и указатель получателей меняются и из потоков пула (отчеты, упреждающая загрузка);
+        # loading_parts - по блокировке на лист, чтобы один лист не читался двумя потоками сразу
+        self.ledger_lock = threading.RLock()
+        self.loading_parts = {}
+        self.catalog = []
+        self.catalog_loaded = False
+        # Локальная база операций (при store == 'sqlite'), открывается при первом обращении
+        self.db = None
+        self.db_lock = threading.Lock()
+        self.store_ready = False
+        self.reports = {}
+        # Нарисованные графики в порядке последнего использования (см. render_chart)
+        self.charts = OrderedDict()
+        # Готовые ответы отчетов в порядке последнего использования (см. get_rendered)
+        self.rendered = OrderedDict()
+        # Подготовленные импорты выписок, ждущие подтверждения: {user_id: {id, rows, created}}
+        self.pending_imports = {}
+        # Операции, похожие на повтор и ждущие подтверждения: {user_id: {id, analysis, source_info, created}}
+        self.pending_records = {}
+        # Строки таблицы, о которых уже сообщили в лог как о неразобранных
+        self.reported_parse_errors = set()
+        # Указатель получателей по падежным формам (RecipientIndex), строится при первом обращении
+        self.recipient_index = None
+        # Суммы и категории расходов по получателям (см. recipient_profiles), строятся при первом обращении
+        self.recipient_profiles = None
+        # Последние действия пользователей (команда или тип ответа модели) - для упреждающей загрузки
+        self.recent_actions = {}
+        # Расходы по категориям с бюджетом за текущий месяц: {'month': (год, месяц), 'spent': {...}}
+        self.budget_spending = None
+        # Недавние операции по дням для поиска повторов (см. duplicate_index)
+        self.duplicate_index = None
+        self.last_used = time.monotonic()
+
+TENANT_CONFIGS = load_tenant_configs()
+TENANT_BY_USERNAME = {
+    username.lower(): name
+    for name, config in TENANT_CONFIGS.items()
+    for username in config.get('users', [])
+}
+
+# Загруженные организации в порядке последнего использования (LRU)
+LOADED_TENANTS = OrderedDict()
+CURRENT_TENANT = ContextVar('current_tenant', default=None)
+
+def get_tenant(name):
+    """Возвращает состояние организации, вытесняя давно не использованные сверх лимита"""
+    tenant = LOADED_TENANTS.get(name)
+    if tenant is None:
+        tenant = LOADED_TENANTS[name] = TenantState(name, TENANT_CONFIGS[name])
+        while len(LOADED_TENANTS) > TENANT_CACHE_LIMIT:
+            evicted_name, _ = LOADED_TENANTS.popitem(last=False)
+            increment_metric("tenants.evicted")
+            logger.info(f"Организация {evicted_name} выгружена из памяти")
+    LOADED_TENANTS.move_to_end(name)
+    tenant.last_used = time.monotonic()
+    return tenant
+
+def use_tenant(name):
+    """Делает организацию текущей для обработчика, фоновой задачи или скрипта"""
+    tenant = get_tenant(name)
+    CURRENT_TENANT.set(tenant)
+    return tenant
+
+def current_tenant():
+    """Текущая организация (по умолчанию - первая из реестра)"""
+    tenant = CURRENT_TENANT.get()
+    if tenant is None:
+        tenant = use_tenant(next(iter(TENANT_CONFIGS)))
+    return tenant
+
+def evict_idle_tenants(max_idle_seconds):
+    """Выгружает организации, которыми не пользовались дольше max_idle_seconds"""
+    now = time.monotonic()
+    for name, tenant in list(LOADED_TENANTS.items()):
+        if now - tenant.last_used > max_idle_seconds:
+            del LOADED_TENANTS[name]
+            increment_metric("tenants.evicted")
+
+# Общее состояние процессов-обработчиков: контекст пользователей, последние операции, число
+# строк листов и версия данных. Один процесс хранит его в памяти, несколько (WORKER_COUNT) -
+# в Redis (STATE_BACKEND=redis). Значения хранятся как JSON: каждый читатель получает копию.
+STATE_PREFIX = 'finbot'
+# Сколько секунд ждать блокировку записи и через сколько она снимается сама
+STATE_LOCK_SECONDS = 10
+# Сколько последних версий данных хранят дописанные строки (см. publish_data_change)
+STATE_ADDED_ROWS_KEPT = 100
+
+class MemoryState:
+    """Общее состояние в памяти одного процесса"""
+
+    def __init__(self):
+        self.values = {}
+        self.guard = threading.Lock()
+        self.locks = {}
+
+    def get(self, key):
+        value = self.values.get(key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self.values[key] = json.dumps(value, ensure_ascii=False)
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+    def incr(self, key):
+        with self.guard:
+            value = (self.get(key) or 0) + 1
+            self.set(key, value)
+        return value
+
+    @contextmanager
+    def lock(self, name, timeout=STATE_LOCK_SECONDS):
+        with self.guard:
+            lock = self.locks.setdefault(name, threading.Lock())
+        if not lock.acquire(timeout=timeout):
+            raise TimeoutError(f"блокировка {name} занята")
+        try:
+            yield
+        finally:
+            lock.release()
+
+class RedisState:
+    """Общее состояние в Redis (или совместимом сервере) для нескольких процессов"""
+
+    def __init__(self, url):
+        import redis  # нужен только при STATE_BACKEND=redis
+
+        self.redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.redis.get(key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self.redis.set(key, json.dumps(value, ensure_ascii=False))
+
+    def delete(self, key):
+        self.redis.delete(key)
+
+    def incr(self, key):
+        return int(self.redis.incr(key))
+
+    def lock(self, name, timeout=STATE_LOCK_SECONDS):
+        # Блокировка с токеном: если процесс упал, не отпустив ее, она истекает через timeout
+        return self.redis.lock(name, timeout=timeout, blocking_timeout=timeout)
+
+SHARED_STATE = None
+
+def shared_state():
+    """Общее состояние процессов (создается при первом обращении)"""
+    global SHARED_STATE
+    if SHARED_STATE is None:
+        SHARED_STATE = RedisState(REDIS_URL) if STATE_BACKEND == 'redis' else MemoryState()
+    return SHARED_STATE
+
+def state_key(*parts):
+    """Ключ общего состояния в пространстве текущей организации"""
+    return ":".join([STATE_PREFIX, current_tenant().name] + [str(part) for part in parts])
+
+def publish_data_change(rows=None):
+    """Сообщает остальным процессам, что данные организации изменились.
+
+    rows - дописанные строки: по ним остальные процессы дополнят счетчики бюджетов и
+    указатель повторов, не пересчитывая их по таблице. Без rows (правка, сверка)
+    эти данные у остальных процессов сбрасываются.
+    """
+    tenant = current_tenant()
+    state = shared_state()
+    version = state.incr(state_key('version'))
+    if rows is not None:
+        state.set(state_key('added', version), rows)
+        state.delete(state_key('added', version - STATE_ADDED_ROWS_KEPT))
+    # Между прошлой и этой версией данные менял другой процесс
+    if version - 1 > tenant.shared_version:
+        apply_shared_changes(tenant.shared_version, version - 1)
+    tenant.shared_version = version
+
+def sync_shared_state():
+    """Учитывает изменения данных, сделанные другими процессами"""
+    tenant = current_tenant()
+    version = shared_state().get(state_key('version')) or 0
+    if version != tenant.shared_version:
+        apply_shared_changes(tenant.shared_version, version)
+
+def apply_shared_changes(seen, version):
+    """Учитывает чужие изменения с версии seen до version.
+
+    Изменяемые листы снимка считаются устаревшими и перечитаются при следующем
+    обращении, а рост версии данных сбрасывает готовые отчеты и графики. Дописанные
+    строки добавляются в счетчики бюджетов и указатель повторов; если хоть одно
+    изменение было не дописыванием (или уже не хранится), они строятся заново.
+    """
+    tenant = current_tenant()
+    tenant.shared_version = version
+    increment_metric("state.invalidations")
+    added = [None]
+    if 0 < version - seen <= STATE_ADDED_ROWS_KEPT:
+        added = [shared_state().get(state_key('added', changed)) for changed in range(seen + 1, version + 1)]
+    with tenant.ledger_lock:
+        for title, part in tenant.ledger['parts'].items():
+            if not is_frozen_partition(title):
+                part['loaded_at'] = float('-inf')
+        tenant.row_counts.clear()
+        tenant.ledger['version'] += 1
+        if any(rows is None for rows in added):
+            tenant.budget_spending = None
+            tenant.duplicate_index = None
+            return
+        for rows in added:
+            for row in rows:
+                note_budget_spending(row)
+                note_duplicate_key(row)
+        increment_metric("state.rows_applied", sum(len(rows) for rows in added))
+
+def get_user_context(user_id):
+    """Контекст пользователя для модели: {'recent_operations': [...]} (или None)"""
+    return shared_state().get(state_key('context', user_id))
+
+def get_last_operation(user_id):
+    """Последняя записанная пользователем операция и ее место в таблице (или None)"""
+    return shared_state().get(state_key('last_operation', user_id))
+
+def tenant_spreadsheet(tenant=None):
+    """Открывает таблицу организации при первом обращении (клиент gspread общий для всех)"""
+    tenant = tenant or current_tenant()
+    if tenant.spreadsheet is None:
+        tenant.spreadsheet = gc.open_by_key(tenant.spreadsheet_id)
+    return tenant.spreadsheet
+
+def is_allowed_user(update: Update):
+    """Проверяет доступ и делает организацию пользователя текущей"""
+    user = update.effective_user
+    tenant_name = TENANT_BY_USERNAME.get(user.username.lower()) if user and user.username else None
+    if tenant_name is None:
+        return False
+    use_tenant(tenant_name)
+    sync_shared_state()
+    return True
 
-        if not recent_records:
-            await message.reply_text("📊 Недостаточно данных для аналитики.")
+def get_message_from_update(update: Update):
+    """Возвращает объект сообщения для ответа (из сообщения или из нажатия кнопки)"""
+    return update.message if update.message else update.callback_query.message
+
+# Метрики: счетчики и длительности (последние значения - для перцентилей)
+METRICS_COUNTERS = {}
+METRICS_TIMINGS = {}
+METRICS_WINDOW = 500
+
+def increment_metric(name, value=1):
+    """Увеличивает счетчик метрики"""
+    METRICS_COUNTERS[name] = METRICS_COUNTERS.get(name, 0) + value
+
+def record_timing(name, seconds):
+    """Запоминает длительность операции в секундах"""
+    timing = METRICS_TIMINGS.get(name)
+    if timing is None:
+        timing = METRICS_TIMINGS[name] = {'count': 0, 'total': 0.0, 'max': 0.0, 'recent': deque(maxlen=METRICS_WINDOW)}
+    timing['count'] += 1
+    timing['total'] += seconds
+    timing['max'] = max(timing['max'], seconds)
+    timing['recent'].append(seconds)
+
+def timing_percentile(name, percentile):
+    """Возвращает перцентиль длительности по последним замерам (или None)"""
+    timing = METRICS_TIMINGS.get(name)
+    if not timing or not timing['recent']:
+        return None
+    values = sorted(timing['recent'])
+    index = min(len(values) - 1, int(len(values) * percentile / 100))
+    return values[index]
+
+def format_metrics_report():
+    """Формирует текстовый отчет по метрикам"""
+    lines = ["📈 **Метрики бота**\n"]
+    for name in sorted(METRICS_COUNTERS):
+        lines.append(f"• `{name}`: {METRICS_COUNTERS[name]:,}")
+    prefetches = METRICS_COUNTERS.get('prefetch.hits', 0) + METRICS_COUNTERS.get('prefetch.misses', 0)
+    if prefetches:
+        lines.append(f"• Упреждающая загрузка: {METRICS_COUNTERS.get('prefetch.hits', 0) / prefetches:.0%} попаданий")
+    if METRICS_TIMINGS:
+        lines.append("\n⏱ **Время выполнения:**")
+        for name in sorted(METRICS_TIMINGS):
+            timing = METRICS_TIMINGS[name]
+            avg = timing['total'] / timing['count']
+            p95 = timing_percentile(name, 95)
+            lines.append(f"• `{name}`: {timing['count']} раз, среднее {avg * 1000:.0f} мс, p95 {p95 * 1000:.0f} мс, макс {timing['max'] * 1000:.0f} мс")
+    if len(lines) == 1:
+        lines.append("Пока нет данных.")
+    return "\n".join(lines)
+
+# Не чаще одной правки сообщения в секунду на чат (ограничение Telegram)
+STATUS_EDIT_INTERVAL = 1.0
+# Заглушка "Анализирую..." появляется, только если ответ не готов за столько секунд
+STATUS_DELAY = 0.5
+# Время последней правки по чатам (только за последние STATUS_EDIT_INTERVAL секунд)
+LAST_STATUS_EDIT = {}
+
+def note_status_edit(chat_id, now=None):
+    """Запоминает правку в чате; записи старше интервала больше не нужны и удаляются"""
+    now = time.monotonic() if now is None else now
+    for stale in [chat for chat, edited in LAST_STATUS_EDIT.items() if now - edited >= STATUS_EDIT_INTERVAL]:
+        del LAST_STATUS_EDIT[stale]
+    LAST_STATUS_EDIT[chat_id] = now
+
+class StatusMessage:
+    """Заглушка "Анализирую...", на месте которой появляется результат (вместо второго сообщения).
+
+    Заглушка отправляется, только если ответ не готов за delay секунд: быстрый
+    ответ уходит одним сообщением, долгий - правкой уже показанной заглушки.
+    """
+
+    def __init__(self, message, text, delay=STATUS_DELAY):
+        self.source = message
+        self.text = text
+        self.message = None
+        self._sending = False
+        self._task = asyncio.ensure_future(self._send_later(delay))
+
+    async def _send_later(self, delay):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._sending = True
+        self.message = await self.source.reply_text(self.text)
+
+    async def _shown(self):
+        """Отправленная заглушка (None, если она еще не отправлялась - тогда и не будет)"""
+        if not self._sending:
+            self._task.cancel()
+            return None
+        try:
+            await self._task
+        except Exception as e:
+            logger.warning(f"Заглушка не отправлена: {e}")
+            return None
+        return self.message
+
+    async def progress(self, text):
+        """Показывает промежуточный текст, если в этом чате давно не было правок (True - показан)"""
+        now = time.monotonic()
+        chat_id = self.source.chat_id
+        if now - LAST_STATUS_EDIT.get(chat_id, 0) < STATUS_EDIT_INTERVAL:
+            return False
+        note_status_edit(chat_id, now)
+        if not self._sending:
+            # Прогресс вместо заглушки: дальше он и правится
+            self._task.cancel()
+            self._sending = True
+            self._task = asyncio.ensure_future(self.source.reply_text(text))
+            self.message = await self._task
+            return True
+        message = await self._shown()
+        if message is None:
+            return False
+        try:
+            await message.edit_text(text)
+        except BadRequest as e:
+            logger.debug(f"Промежуточный текст не показан: {e}")
+            return False
+        return True
+
+    async def finish(self, text, **kwargs):
+        """Показывает итоговый текст на месте заглушки (parse_mode, reply_markup - как у reply_text)"""
+        message = await self._shown()
+        if message is None:
+            return await self.source.reply_text(text, **kwargs)
+        note_status_edit(self.source.chat_id)
+        try:
+            return await message.edit_text(text, **kwargs)
+        except BadRequest as e:
+            if 'not modified' in str(e).lower():
+                return message
+            # Например, заглушку удалили - результат уходит отдельным сообщением
+            logger.warning(f"Не удалось заменить сообщение: {e}")
+            return await self.source.reply_text(text, **kwargs)
+
+    async def delete(self):
+        """Убирает заглушку, когда ответ присылает другой обработчик"""
+        message = await self._shown()
+        if message is None:
             return
+        try:
+            await message.delete()
+        except BadRequest as e:
+            logger.debug(f"Заглушка не удалена: {e}")
 
-        # Анализируем
-        total_income = sum(record.get('Сумма', 0) for record in recent_records if record.get('Сумма', 0) > 0)
-        total_expense = sum(record.get('Сумма', 0) for record in recent_records if record.get('Сумма', 0) < 0)
+FINANCE_CATEGORIES = [
+    "Зарплаты сотрудникам", "Выплаты учредителям", "Оплата поставщику", "Процент",
+    "Закупка товара", "Материалы", "Транспорт", "Связь", "Такси",
+    "Общественные расходы", "Благотворительность", "Прочее"
+]
 
-        # По категориям
-        categories = {}
-        for record in recent_records:
-            if record.get('Сумма', 0) < 0:
-                cat = record.get('Категория', 'Прочее')
-                categories[cat] = categories.get(cat, 0) + record.get('Сумма', 0)
+OPERATION_TYPES = ["Пополнение", "Расход"]
 
-        # Самые частые получатели зарплат
-        salaries = {}
-        for record in recent_records:
-            if record.get('Категория') == 'Зарплаты сотрудникам':
-                person = record.get('Описание/Получатель', 'Неизвестно')
-                salaries[person] = salaries.get(person, 0) + abs(record.get('Сумма', 0))
+# Ограничение длины ответа модели: JSON одной операции или уточнения
+AI_MAX_TOKENS = 300
 
-        report = f"""
-📊 **Умная аналитика за 30 дней**
+# Статичная часть запроса: идет первой и не меняется между вызовами,
+# поэтому провайдер может кэшировать этот префикс
+AI_SYSTEM_PROMPT = f"""Ты эксперт по анализу финансовых операций. Определи тип сообщения пользователя и верни только JSON-объект.
 
-💰 **Общие итоги:**
-📈 Доходы: +{total_income:,.0f} ₽
-📉 Расходы: {total_expense:,.0f} ₽
-💼 Чистый результат: {total_income + total_expense:,.0f} ₽
-📊 Операций: {len(recent_records)}
+ФИНАНСОВАЯ операция:
+{{"type": "finance", "operation_type": "Пополнение" | "Расход", "amount": число (> 0 для пополнения, < 0 для расхода), "category": одна из {json.dumps(FINANCE_CATEGORIES, ensure_ascii=False)} или "-" для пополнений, "description": "краткое описание с именами", "comment": "", "confidence": число от 0 до 1}}
 
-💸 **Расходы по категориям:**
-"""
+НУЖНО УТОЧНЕНИЕ:
+{{"type": "clarification", "message": "уточняющий вопрос", "suggestions": ["вариант 1", "вариант 2", "вариант 3"]}}
+
+ПРАВИЛА:
+1. Пополнение: "пополнил", "снял", "взял наличку", "получил деньги". Расход: "заплатил", "потратил", "дал", "купил", "оплатил", "зарплата".
+2. Категории:
+   - "дал/заплатил/зарплата + ИМЯ" = "Зарплаты сотрудникам"
+   - "Таня лично/Игорь лично/Антон лично" = "Выплаты учредителям"
+   - "материалы/закупка/товары" = "Материалы"
+   - "такси/убер/яндекс" = "Такси"
+   - "транспорт/бензин/авто/Герасимов" = "Транспорт"
+   - "связь/интернет/телефон" = "Связь"
+   - "благотворительность/донат/помощь/СВО" = "Благотворительность"
+   - "хоз расходы/хозяйственные/офис/канцелярия" = "Общественные расходы"
+3. Описание - только суть, с заглавной буквы: убирай "заплатил", "дал", "потратил", "купил", "оплатил", "лично"; оставляй имена, должности, назначение.
+4. Имена - в именительном падеже: "Балтики" → "Балтика", "Рустаму" → "Рустам", "Петрову" → "Петров", "Интигаму" → "Интигам".
+5. Если в сообщении есть ЧИСЛО - confidence = 0.9 и НИКОГДА не уточняй. Лучше записать, чем спрашивать.
+6. Контекст (если передан): "такая же сумма" - последняя сумма из контекста; "тому же" - последний получатель; "как вчера" - операции за вчера; "обычная зарплата Петрову" - сумма из контекста, иначе уточни.
+7. Если числа нет и данных недостаточно (confidence < 0.7) - уточни."""
+
+def build_ai_messages(text, user_context=None):
+    """Собирает сообщения для модели: статичный системный префикс, затем контекст и текст"""
+    user_content = ""
+    if user_context:
+        recent_operations = user_context.get('recent_operations', [])
+        if recent_operations:
+            user_content += "КОНТЕКСТ последних операций пользователя:\n"
+            user_content += "\n".join(recent_operations[-5:]) + "\n\n"
+    user_content += f"Сообщение: \"{text}\""
 
-        for cat, amount in sorted(categories.items(), key=lambda x: x[1]):
-            percent = abs(amount) / abs(total_expense) * 100 if total_expense != 0 else 0
-            report += f"• {cat}: {amount:,.0f} ₽ ({percent:.1f}%)\n"
+    return [
+        {"role": "system", "content": AI_SYSTEM_PROMPT},
+        {"role": "user", "content": user_content}
+    ]
 
-        if salaries:
-            report += f"\n👥 **Зарплаты сотрудникам:**\n"
-            for person, amount in sorted(salaries.items(), key=lambda x: x[1], reverse=True):
-                report += f"• {person}: {amount:,.0f} ₽\n"
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
 
-        # Средние траты
-        avg_daily = abs(total_expense) / 30
-        report += f"\n📈 **Средние траты в день:** {avg_daily:,.0f} ₽"
+def validate_analysis(result):
+    """Проверяет ответ модели по схеме и возвращает нормализованный результат.
 
-        # Найти самую затратную категорию
-        if categories:
-            top_category = min(categories.items(), key=lambda x: x[1])
-            report += f"\n🔝 **Больше всего тратите на:** {top_category[0]}"
+    Бросает ValueError, если ответ не соответствует ни финансовой операции, ни уточнению.
+    """
+    if not isinstance(result, dict):
+        raise ValueError("ответ не является объектом")
+
+    if result.get('type') == 'finance':
+        if result.get('operation_type') not in OPERATION_TYPES:
+            raise ValueError(f"неизвестный тип операции: {result.get('operation_type')!r}")
+        amount = result.get('amount')
+        if not _is_number(amount) or amount == 0:
+            raise ValueError(f"некорректная сумма: {amount!r}")
+        category = result.get('category')
+        if category not in FINANCE_CATEGORIES and category != '-':
+            raise ValueError(f"неизвестная категория: {category!r}")
+        description = result.get('description')
+        if not isinstance(description, str) or not description.strip():
+            raise ValueError("пустое описание")
+        confidence = result.get('confidence', 1.0)
+        if not _is_number(confidence):
+            raise ValueError(f"некорректная уверенность: {confidence!r}")
+
+        # Знак суммы всегда следует из типа операции
+        amount = abs(amount) if result['operation_type'] == 'Пополнение' else -abs(amount)
+        return {
+            "type": "finance",
+            "operation_type": result['operation_type'],
+            "amount": amount,
+            "category": category,
+            "description": description.strip(),
+            "comment": str(result.get('comment') or ''),
+            "confidence": min(max(float(confidence), 0.0), 1.0)
+        }
 
-        await message.reply_text(report, parse_mode='Markdown')
+    if result.get('type') == 'clarification':
+        message = result.get('message')
+        if not isinstance(message, str) or not message.strip():
+            raise ValueError("пустой уточняющий вопрос")
+        suggestions = result.get('suggestions') or []
+        if not isinstance(suggestions, list):
+            raise ValueError("suggestions должен быть списком")
+        return {
+            "type": "clarification",
+            "message": message.strip(),
+            "suggestions": [str(suggestion) for suggestion in suggestions]
+        }
 
-    except Exception as e:
-        logger.error(f"Ошибка аналитики: {e}")
-        message = update.message if update.message else update.callback_query.message
-        await message.reply_text("❌ Ошибка при создании аналитики.")
+    raise ValueError(f"неизвестный тип ответа: {result.get('type')!r}")
 
-async def description_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Анализ трат по описанию (кому больше всего платите)"""
-    if not is_allowed_user(update):
-        await update.message.reply_text('Нет доступа')
-        return
-    args = context.args
-    message = update.message if update.message else update.callback_query.message
+# Символов на токен для оценки расхода, когда модель не прислала usage (поток оборван раньше)
+AI_CHARS_PER_TOKEN = 3
 
-    try:
-        await message.reply_text("👥 Анализирую траты по получателям...")
+def estimate_ai_usage(messages, completion):
+    """Примерный расход токенов вызова по длине запроса и полученного ответа"""
+    prompt_tokens = sum(len(str(message.get('content') or '')) for message in messages) // AI_CHARS_PER_TOKEN + 1
+    completion_tokens = len(completion) // AI_CHARS_PER_TOKEN + 1
+    return CompletionUsage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens)
 
-        finance_records = finance_sheet.get_all_records()
+def record_ai_usage(kind, started, response=None, usage=None):
+    """Учитывает задержку и токены одного вызова модели (usage - если его нет в response)"""
+    record_timing(f"ai.{kind}.latency", time.monotonic() - started)
+    increment_metric(f"ai.{kind}.calls")
+    usage = usage or getattr(response, 'usage', None)
+    if usage is None:
+        return
+    increment_metric(f"ai.{kind}.prompt_tokens", usage.prompt_tokens or 0)
+    increment_metric(f"ai.{kind}.completion_tokens", usage.completion_tokens or 0)
+    # Кэшированные токены префикса (поле есть не у всех провайдеров и версий API)
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = details.get('cached_tokens') if isinstance(details, dict) else getattr(details, 'cached_tokens', None)
+    if cached_tokens:
+        increment_metric(f"ai.{kind}.cached_prompt_tokens", cached_tokens)
+
+class StreamedJson:
+    """JSON-объект, который модель присылает по частям.
+
+    feed() добавляет фрагмент и возвращает True, как только объект верхнего уровня
+    закрыт, - остаток ответа можно не ждать. partial_string() достает уже пришедшую
+    часть строкового поля (например, текст уточняющего вопроса) для показа на лету.
+    """
 
-        # Определяем период
-        if args and args[0] in ['месяц', 'неделя']:
-            if args[0] == 'месяц':
-                cutoff_date = datetime.now() - timedelta(days=30)
-                period_name = "месяц"
-            else:
-                cutoff_date = datetime.now() - timedelta(days=7)
-                period_name = "неделю"
+    def __init__(self):
+        self.text = ""
+        self.end = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk):
+        start = len(self.text)
+        self.text += chunk
+        if self.end is not None:
+            return True
+        for i in range(start, len(self.text)):
+            char = self.text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in '{[':
+                self._depth += 1
+            elif char in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    self.end = i + 1
+                    return True
+        return False
 
-            filtered_records = []
-            for record in finance_records:
+    def partial_string(self, key):
+        """Уже полученная часть строкового поля key (или None, если оно еще не началось)"""
+        match = re.search(r'"%s"\s*:\s*"' % re.escape(key), self.text)
+        if match is None:
+            return None
+        value = []
+        i = match.end()
+        while i < len(self.text):
+            char = self.text[i]
+            if char == '"':
+                break
+            if char == '\\':
+                escape = self.text[i:i + 6] if self.text[i + 1:i + 2] == 'u' else self.text[i:i + 2]
+                if len(escape) < (6 if escape[1:2] == 'u' else 2):
+                    break  # экранирование пришло не целиком
                 try:
-                    record_date = datetime.strptime(record.get('Дата', ''), '%d.%m.%Y')
-                    if record_date >= cutoff_date:
-                        filtered_records.append(record)
-                except:
+                    value.append(json.loads(f'"{escape}"'))
+                except ValueError:
+                    break
+                i += len(escape)
+                continue
+            value.append(char)
+            i += 1
+        return "".join(value)
+
+    def result(self):
+        return json.loads(self.text[:self.end] if self.end is not None else self.text)
+
+def close_stream(stream):
+    """Закрывает поток ответа модели, не дочитывая его"""
+    close = getattr(stream, 'close', None)
+    if close is None:
+        response = getattr(stream, 'response', None)
+        close = getattr(response, 'close', None)
+    if close is not None:
+        close()
+
+def analyze_message_with_ai(text, user_context=None, on_partial=None):
+    """Анализирует сообщение с помощью ИИ с учетом контекста.
+
+    Ответ читается потоком: если после закрытого JSON-объекта модель пишет что-то еще,
+    поток обрывается, а служебные фрагменты (конец ответа, расход токенов) дочитываются.
+    Пока модель пишет уточняющий вопрос, уже пришедшая часть передается в on_partial.
+    """
+
+    # Сначала проверяем, не является ли это командным запросом
+    command_result = parse_voice_command(text)
+    if command_result:
+        return command_result
+
+    # "Такая же сумма", "тому же", "обычная зарплата" - по контексту и таблице, без модели
+    resolved = resolve_context_phrase(text, user_context)
+    if resolved:
+        return resolved
+
+    try:
+        started = time.monotonic()
+        messages = build_ai_messages(text, user_context)
+        stream = client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            temperature=0.1,
+            max_tokens=AI_MAX_TOKENS,
+            response_format={"type": "json_object"},
+            stream=True,
+            # Расход токенов приходит последним фрагментом потока (параметра нет в openai==1.3.7)
+            extra_body={'stream_options': {'include_usage': True}}
+        )
+        streamed = StreamedJson()
+        first_byte = None
+        usage = None
+        try:
+            for chunk in stream:
+                usage = getattr(chunk, 'usage', None) or usage
+                if not chunk.choices:
                     continue
-        else:
-            filtered_records = finance_records
-            period_name = "все время"
-
-        # Группируем по описанию (получателям)
-        recipients = {}
-        total_expense = 0
-
-        for record in filtered_records:
-            amount = record.get('Сумма', 0)
-            if amount < 0:  # Только расходы
-                description = record.get('Описание/Получатель', 'Без описания').strip()
-                category = record.get('Категория', 'Прочее')
-
-                if description and description != 'Без описания':
-                    recipients[description] = recipients.get(description, {
-                        'total': 0,
-                        'count': 0,
-                        'categories': {}
-                    })
-                    recipients[description]['total'] += abs(amount)
-                    recipients[description]['count'] += 1
-                    recipients[description]['categories'][category] = recipients[description]['categories'].get(category, 0) + abs(amount)
-                    total_expense += abs(amount)
+                content = chunk.choices[0].delta.content
+                if not content:
+                    continue
+                if streamed.end is not None:
+                    # Объект уже закрыт, дальше лишний текст - остаток ответа не ждем
+                    increment_metric("ai.analyze.early_stops")
+                    break
+                if first_byte is None:
+                    first_byte = time.monotonic()
+                    record_timing("ai.analyze.ttfb", first_byte - started)
+                if streamed.feed(content):
+                    continue
+                if on_partial is not None and streamed.partial_string('type') == 'clarification':
+                    partial = streamed.partial_string('message')
+                    if partial:
+                        on_partial(partial)
+        finally:
+            close_stream(stream)
+        # Поток оборван до фрагмента с usage - расход оценивается по длине запроса и ответа
+        if usage is None:
+            increment_metric("ai.analyze.estimated_usage")
+            usage = estimate_ai_usage(messages, streamed.text)
+        record_ai_usage('analyze', started, usage=usage)
+
+        return validate_analysis(streamed.result())
 
-        if not recipients:
-            await message.reply_text("👥 Нет данных о получателях за выбранный период.")
-            return
+    except Exception as e:
+        increment_metric("ai.analyze.errors")
+        logger.error(f"Ошибка ИИ анализа: {e}")
+        return {"type": "clarification", "message": "Извините, произошла ошибка. Попробуйте переформулировать.", "suggestions": []}
 
-        # Сортируем по убыванию суммы
-        sorted_recipients = sorted(recipients.items(), key=lambda x: x[1]['total'], reverse=True)
+async def analyze_message_streaming(text, user_context=None, status=None):
+    """Анализирует сообщение в потоке, показывая текст уточнения в заглушке по мере ответа модели"""
+    if status is None:
+        return await asyncio.to_thread(analyze_message_with_ai, text, user_context)
 
-        result = f"👥 **Анализ трат по получателям за {period_name}**\n\n"
-        result += f"💰 **Общие расходы:** {total_expense:,.0f} ₽\n"
-        result += f"👤 **Уникальных получателей:** {len(recipients)}\n\n"
+    loop = asyncio.get_running_loop()
+    shown = {'future': None}
 
-        # Топ получателей
-        result += "🔝 **Топ получателей:**\n"
-        for i, (recipient, data) in enumerate(sorted_recipients[:10], 1):
-            percentage = (data['total'] / total_expense) * 100
-            avg_payment = data['total'] / data['count']
-
-            # Определяем основную категорию
-            main_category = max(data['categories'].items(), key=lambda x: x[1])[0]
-
-            # Эмодзи по категориям
-            emoji_map = {
-                'Зарплаты сотрудникам': '👨‍💼',
-                'Выплаты учредителям': '👔',
-                'Оплата поставщику': '🏭',
-                'Процент': '📊',
-                'Закупка товара': '🛒',
-                'Транспорт': '🚗',
-                'Такси': '🚕',
-                'Связь': '📱',
-                'Материалы': '📦',
-                'Общественные расходы': '🏢',
-                'Благотворительность': '❤️'
-            }
+    def on_partial(partial):
+        # Одна правка за раз; частоту правок в чате ограничивает StatusMessage.progress
+        future = shown['future']
+        if future is not None and not future.done():
+            return
+        shown['future'] = asyncio.run_coroutine_threadsafe(status.progress(f"🤔 {partial}..."), loop)
+
+    analysis = await asyncio.to_thread(analyze_message_with_ai, text, user_context, on_partial)
+    # Итог не должен затереться запоздавшей промежуточной правкой
+    if shown['future'] is not None:
+        try:
+            await asyncio.wrap_future(shown['future'])
+        except Exception as e:
+            logger.debug(f"Промежуточный ответ не показан: {e}")
+    return analysis
+
+# Снимок таблицы финансов в памяти (у каждой организации свой - TenantState.ledger):
+# обработчики читают его вместо get_all_records(). parts - записи по листам (при разбиении
+# по месяцам каждый месяц - отдельный лист); version растет при каждом изменении данных -
+# по нему проверяется свежесть готовых отчетов.
+
+# Через сколько секунд снимок считается устаревшим (фоновое обновление идет чаще)
+LEDGER_SNAPSHOT_TTL = (LEDGER_REFRESH_MINUTES + 5) * 60
+
+# Каталог разделов: лист -> начало, конец и статус (замороженные разделы читаются из архива)
+PARTITION_CATALOG_SHEET = 'Каталог'
+PARTITION_CATALOG_COLUMNS = ['Лист', 'Начало', 'Конец', 'Статус']
+PARTITION_ACTIVE = 'активен'
+PARTITION_FROZEN = 'архив'
+# Строки без корректной даты при миграции попадают в раздел, который пересекается с любым периодом
+PARTITION_UNDATED = 'Финансы без даты'
+PARTITION_UNDATED_RANGE = (datetime(1900, 1, 1).date(), datetime(2999, 12, 31).date())
+PARTITION_ARCHIVE_DIR = 'archive'
+
+class FinanceRecord:
+    """Операция таблицы финансов, разобранная один раз при загрузке.
+
+    date - дата как в таблице (для вывода), day - разобранная дата (None, если ее нет),
+    amount - сумма числом. Тип, категория и получатель интернированы: повторяющиеся
+    строки тысяч записей хранятся в памяти один раз.
+    """
+    __slots__ = ('date', 'day', 'operation_type', 'category', 'description', 'amount', 'comment', '_search_text')
+
+    def __init__(self, date, day, operation_type, category, description, amount, comment=''):
+        self.date = date
+        self.day = day
+        self.operation_type = sys.intern(operation_type)
+        self.category = sys.intern(category)
+        self.description = sys.intern(description)
+        self.amount = amount
+        self.comment = comment
+        self._search_text = None
+
+    @property
+    def search_text(self):
+        """Получатель и категория в нижнем регистре для текстового поиска.
+
+        Считается при первом поиске и хранится в записи, то есть вместе с листом в снимке.
+        """
+        if self._search_text is None:
+            self._search_text = f"{self.description} {self.category}".lower()
+        return self._search_text
 
-            emoji = emoji_map.get(main_category, '💰')
+    def as_row(self):
+        """Значения в порядке колонок FINANCE_COLUMNS"""
+        return [self.date, self.operation_type, self.category, self.description, self.amount, self.comment]
 
-            result += f"{i}. {emoji} **{recipient}**\n"
-            result += f"   💰 {data['total']:,.0f} ₽ ({percentage:.1f}%)\n"
-            result += f"   📊 {data['count']} операций, ~{avg_payment:,.0f} ₽ за раз\n"
-            result += f"   📂 Основная категория: {main_category}\n\n"
+    def as_dict(self):
+        """Словарь как у get_all_records() - для JSON-копий и архивов"""
+        return dict(zip(FINANCE_COLUMNS, self.as_row()))
 
-        # Статистика
-        if len(sorted_recipients) > 10:
-            others_total = sum(data['total'] for _, data in sorted_recipients[10:])
-            others_count = len(sorted_recipients) - 10
-            result += f"... и ещё {others_count} получателей на {others_total:,.0f} ₽\n\n"
+    def __eq__(self, other):
+        if not isinstance(other, FinanceRecord):
+            return NotImplemented
+        return self.as_row() == other.as_row()
 
-        # Топ-3 анализ
-        if len(sorted_recipients) >= 3:
-            top3_total = sum(data['total'] for _, data in sorted_recipients[:3])
-            top3_percentage = (top3_total / total_expense) * 100
-            result += f"📈 **Топ-3 получателя:** {top3_percentage:.1f}% от всех трат\n"
+    __hash__ = None
 
-        # Средний чек по категориям
-        category_avg = {}
-        for recipient, data in recipients.items():
-            for category, amount in data['categories'].items():
-                if category not in category_avg:
-                    category_avg[category] = []
-                category_avg[category].append(amount / recipients[recipient]['count'])
+    def __repr__(self):
+        return f"FinanceRecord({', '.join(repr(value) for value in self.as_row())})"
 
-        if category_avg:
-            result += f"\n💳 **Средний чек по типам:**\n"
-            for category, amounts in category_avg.items():
-                avg = sum(amounts) / len(amounts)
-                result += f"• {category}: {avg:,.0f} ₽\n"
+def parse_amount(value):
+    """Сумма из ячейки числом: 1500, "-1 500,00", "1500.5" (None, если это не число)"""
+    if _is_number(value):
+        return float(value)
+    text = str(value).replace('\xa0', '').replace(' ', '').replace('−', '-').replace(',', '.')
+    try:
+        return float(text)
+    except ValueError:
+        return None
 
-        await message.reply_text(result, parse_mode='Markdown')
+def parse_finance_record(values):
+    """Разбирает строку таблицы (значения колонок FINANCE_COLUMNS) в FinanceRecord.
 
-    except Exception as e:
-        logger.error(f"Ошибка анализа по описанию: {e}")
-        await message.reply_text("❌ Ошибка при анализе получателей.")
+    Возвращает (запись, описание ошибки или None). Запись создается и при ошибке:
+    без даты - day None, сумма не число - 0.
+    """
+    values = list(values[:len(FINANCE_COLUMNS)]) + [''] * (len(FINANCE_COLUMNS) - len(values))
+    date_str, operation_type, category, description, amount, comment = values
+    date_str = str(date_str).strip()
+    day = parse_record_date(date_str) if date_str else None
+    parsed_amount = parse_amount(amount)
+
+    problems = []
+    if day is None:
+        problems.append(f"дата «{date_str}»" if date_str else "нет даты")
+    if parsed_amount is None:
+        problems.append(f"сумма «{amount}»")
+    record = FinanceRecord(
+        date_str, day, str(operation_type), str(category), str(description),
+        parsed_amount if parsed_amount is not None else 0.0, str(comment)
+    )
+    return record, ", ".join(problems) or None
 
-async def advanced_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Продвинутый поиск операций"""
-    if not is_allowed_user(update):
-        await update.message.reply_text('Нет доступа')
+def report_parse_errors(source, problems):
+    """Пишет в лог строки, которые не удалось разобрать, - каждую только один раз"""
+    reported = current_tenant().reported_parse_errors
+    new_problems = [(row_number, problem) for row_number, problem in problems if (source, row_number, problem) not in reported]
+    if not new_problems:
         return
-    args = context.args
-    message = update.message if update.message else update.callback_query.message
+    reported.update((source, row_number, problem) for row_number, problem in new_problems)
+    increment_metric("ledger.parse_errors", len(new_problems))
+    examples = "; ".join(f"строка {row_number}: {problem}" for row_number, problem in new_problems[:5])
+    more = f" и еще {len(new_problems) - 5}" if len(new_problems) > 5 else ""
+    logger.warning(f"Лист '{source}': не разобрано строк - {len(new_problems)} ({examples}{more})")
+
+def ingest_finance_rows(values, source, projected=False):
+    """Превращает значения листа (первая строка - заголовок) в список FinanceRecord.
+
+    Колонки ищутся по заголовку; пустые строки пропускаются, а строки с ошибками
+    остаются в данных и попадают в лог (report_parse_errors). projected - прочитаны
+    не все колонки: пустые поля ожидаемы, и о них не сообщается.
+    """
+    if not values:
+        return []
+    header = values[0]
+    positions = [header.index(column) if column in header else None for column in FINANCE_COLUMNS]
+    records, problems = [], []
+    for row_number, row in enumerate(values[1:], 2):
+        row_values = [row[position] if position is not None and position < len(row) else '' for position in positions]
+        if not any(str(value).strip() for value in row_values):
+            continue
+        record, problem = parse_finance_record(row_values)
+        records.append(record)
+        if problem:
+            problems.append((row_number, problem))
+    if not projected:
+        report_parse_errors(source, problems)
+    return records
+
+def records_from_mappings(mappings, source):
+    """Записи из словарей get_all_records() (архивы, JSON-копии)"""
+    return ingest_finance_rows([FINANCE_COLUMNS] + [[mapping.get(column, '') for column in FINANCE_COLUMNS] for mapping in mappings], source)
+
+def ledger_snapshot():
+    """Снимок данных текущей организации"""
+    return current_tenant().ledger
+
+def get_worksheet(title, create=False, header=FINANCE_COLUMNS):
+    """Возвращает лист таблицы по названию (открытые листы кэшируются)"""
+    tenant = current_tenant()
+    worksheet = tenant.worksheets.get(title)
+    if worksheet is None:
+        try:
+            worksheet = tenant_spreadsheet(tenant).worksheet(title)
+        except gspread.exceptions.WorksheetNotFound:
+            if not create:
+                raise
+            worksheet = tenant_spreadsheet(tenant).add_worksheet(title=title, rows=1000, cols=len(header))
+            worksheet.append_row(header)
+        tenant.worksheets[title] = worksheet
+    return worksheet
+
+def is_partitioned():
+    """Разбита ли таблица текущей организации по месяцам"""
+    return current_tenant().partitioning == 'month'
+
+def partition_title(day):
+    """Название месячного раздела для даты"""
+    return f"Финансы {day.strftime('%Y-%m')}"
+
+def month_bounds(day):
+    """Первый и последний день месяца"""
+    start = day.replace(day=1)
+    next_month = (start + timedelta(days=32)).replace(day=1)
+    return start, next_month - timedelta(days=1)
+
+def load_partition_catalog():
+    """Читает каталог разделов из листа PARTITION_CATALOG_SHEET"""
+    catalog = []
+    catalog_sheet = get_worksheet(PARTITION_CATALOG_SHEET, create=True, header=PARTITION_CATALOG_COLUMNS)
+    for row in catalog_sheet.get_all_records():
+        start = parse_record_date(str(row.get('Начало', '')))
+        end = parse_record_date(str(row.get('Конец', '')))
+        if not row.get('Лист') or start is None or end is None:
+            continue
+        catalog.append({'sheet': row['Лист'], 'start': start, 'end': end, 'status': row.get('Статус') or PARTITION_ACTIVE})
+    tenant = current_tenant()
+    tenant.catalog = sorted(catalog, key=lambda entry: (entry['start'], entry['end']))
+    tenant.catalog_loaded = True
+    return tenant.catalog
+
+def get_partition_catalog():
+    """Каталог разделов (читается из таблицы при первом обращении)"""
+    tenant = current_tenant()
+    if not tenant.catalog_loaded:
+        load_partition_catalog()
+    return tenant.catalog
+
+def register_partition(title, start, end, status=PARTITION_ACTIVE):
+    """Добавляет раздел в каталог (и в лист каталога)"""
+    catalog = get_partition_catalog()
+    get_worksheet(PARTITION_CATALOG_SHEET).append_row([title, start.strftime('%d.%m.%Y'), end.strftime('%d.%m.%Y'), status])
+    catalog.append({'sheet': title, 'start': start, 'end': end, 'status': status})
+    catalog.sort(key=lambda entry: (entry['start'], entry['end']))
+
+def existing_partition(day=None):
+    """Название раздела для записи операции, если он уже есть (иначе None); ничего не создает"""
+    if not is_partitioned():
+        return current_tenant().sheet_name
+    title = partition_title(day or get_moscow_time().date())
+    return title if any(entry['sheet'] == title for entry in get_partition_catalog()) else None
+
+def current_partition(day=None):
+    """Возвращает название раздела для записи операции, создавая лист при необходимости"""
+    if not is_partitioned():
+        return current_tenant().sheet_name
+    day = day or get_moscow_time().date()
+    title = partition_title(day)
+    if not any(entry['sheet'] == title for entry in get_partition_catalog()):
+        get_worksheet(title, create=True)
+        start, end = month_bounds(day)
+        register_partition(title, start, end)
+    return title
+
+def partitions_for_range(start=None, end=None):
+    """Названия разделов, пересекающихся с периодом [start, end] (в хронологическом порядке)"""
+    if not is_partitioned():
+        return [current_tenant().sheet_name]
+    return [
+        entry['sheet'] for entry in get_partition_catalog()
+        if (start is None or entry['end'] >= start) and (end is None or entry['start'] <= end)
+    ]
 
-    if not args:
-        help_text = """
-🔍 **Супер-поиск операций:**
+def partition_archive_path(title):
+    tenant = current_tenant()
+    if tenant.name == DEFAULT_TENANT:
+        return os.path.join(PARTITION_ARCHIVE_DIR, f"{title}.json.gz")
+    return os.path.join(PARTITION_ARCHIVE_DIR, tenant.name, f"{title}.json.gz")
 
-**По имени/компании:**
-• `/search Петров` - все операции с Петровым
-• `/search Интигам` - все операции с Интигамом
+def is_frozen_partition(title):
+    if not is_partitioned():
+        return False
+    return any(entry['sheet'] == title and entry['status'] == PARTITION_FROZEN for entry in get_partition_catalog())
+
+def load_partition_records(title):
+    """Читает записи раздела: замороженный - из локального архива, остальные - из таблицы"""
+    archive_path = partition_archive_path(title)
+    if is_frozen_partition(title) and os.path.exists(archive_path):
+        with gzip.open(archive_path, 'rt', encoding='utf-8') as f:
+            return records_from_mappings(json.load(f), title)
+
+    started = time.monotonic()
+    values = get_worksheet(title).get_all_values()
+    current_tenant().row_counts[title] = len(values)
+    records = ingest_finance_rows(values, title)
+    record_timing("ledger.load", time.monotonic() - started)
+    return records
+
+# Чтение диапазонами: числа - как есть (без форматирования), даты - строками как в таблице
+SHEET_READ_OPTIONS = {'value_render_option': 'UNFORMATTED_VALUE', 'date_time_render_option': 'FORMATTED_STRING'}
+
+# Колонки, которые нужны обработчикам, читающим лист напрямую (проекции)
+HISTORY_COLUMNS = ['Дата', 'Описание/Получатель', 'Сумма']
+
+def sheet_header(title):
+    """Заголовок листа (читается один раз)"""
+    headers = current_tenant().sheet_headers
+    if title not in headers:
+        rows = get_worksheet(title).get('1:1', **SHEET_READ_OPTIONS)
+        headers[title] = [str(value) for value in rows[0]] if rows else []
+    return headers[title]
+
+def sheet_row_count(title):
+    """Число занятых строк листа вместе с заголовком.
+
+    Известно после полной загрузки и поддерживается при дописывании строк; иначе
+    читается одна колонка дат, а не весь лист.
+    """
+    row_counts = current_tenant().row_counts
+    if title not in row_counts:
+        row_counts[title] = shared_state().get(state_key('rows', title)) or len(get_worksheet(title).col_values(1))
+    return row_counts[title]
+
+def note_appended_rows(title, response, count=1):
+    """Обновляет число строк листа по ответу append_row(s): "'Лист'!A15:F15" -> 15"""
+    row_counts = current_tenant().row_counts
+    updated_range = ((response or {}).get('updates') or {}).get('updatedRange', '')
+    match = re.search(r'(\d+)$', updated_range)
+    if match:
+        row_counts[title] = int(match.group(1))
+    elif title in row_counts:
+        row_counts[title] += count
+    if title in row_counts:
+        shared_state().set(state_key('rows', title), row_counts[title])
+    return row_counts.get(title)
+
+def read_sheet_rows(title, first_row=2, last_row=None, columns=None):
+    """Строки листа с first_row по last_row (до конца листа, если None) - только колонки columns.
+
+    Возвращает значения с заголовком первой строкой (как get_all_values), которые
+    понимает ingest_finance_rows. Каждая колонка проекции читается своим диапазоном
+    в одном запросе batch_get.
+    """
+    header = sheet_header(title)
+    end = last_row if last_row is not None else ''
+    if columns is None:
+        rows = get_worksheet(title).get(f"A{first_row}:{column_letter(len(header))}{end}", **SHEET_READ_OPTIONS)
+        return [header] + rows
+    columns = [column for column in columns if column in header]
+    letters = [column_letter(header.index(column) + 1) for column in columns]
+    ranges = get_worksheet(title).batch_get([f"{letter}{first_row}:{letter}{end}" for letter in letters], **SHEET_READ_OPTIONS)
+    cells = [[row[0] if row else '' for row in column_range] for column_range in ranges]
+    length = max((len(column_cells) for column_cells in cells), default=0)
+    rows = [[column_cells[i] if i < len(column_cells) else '' for column_cells in cells] for i in range(length)]
+    return [columns] + rows
+
+def read_sheet_tail(title, count, columns=None):
+    """Последние count записей листа, прочитанные диапазоном в конце листа"""
+    last_row = sheet_row_count(title)
+    window = count
+    while True:
+        first_row = max(2, last_row - window + 1)
+        if first_row > last_row:
+            return []
+        records = ingest_finance_rows(read_sheet_rows(title, first_row, last_row, columns), title, projected=columns is not None)
+        # Пустые строки в конце окна не считаются - окно расширяется, пока записей не хватит
+        if len(records) >= count or first_row == 2:
+            return records[-count:]
+        window *= 2
+
+def store_ledger_part(title, records):
+    """Кладет записи листа в снимок, соблюдая бюджет памяти организации.
+
+    Бюджет мягкий: сверх TENANT_RECORD_BUDGET вытесняются давно не читанные листы,
+    а только что прочитанный лист остается всегда.
+    """
+    tenant = current_tenant()
+    with tenant.ledger_lock:
+        snapshot = ledger_snapshot()
+        parts = snapshot['parts']
+        part = parts.get(title)
+        if part is None or records != part['records']:
+            snapshot['version'] += 1
+            index = tenant.recipient_index
+            if part is not None and index is not None and title in index.sources:
+                # Лист изменился (например, вручную) - указатель соберется заново из снимка
+                tenant.recipient_index = None
+        parts[title] = {'records': records, 'loaded_at': time.monotonic()}
+        parts.move_to_end(title)
+
+        total = sum(len(part['records']) for part in parts.values())
+        for cached_title in list(parts):
+            if total <= TENANT_RECORD_BUDGET or cached_title == title:
+                break
+            total -= len(parts.pop(cached_title)['records'])
+            increment_metric("ledger.parts_evicted")
+
+def refresh_ledger_snapshot(titles=None):
+    """Перечитывает разделы таблицы финансов в снимок (по умолчанию - все изменяемые загруженные)"""
+    if titles is None:
+        with current_tenant().ledger_lock:
+            titles = [title for title in ledger_snapshot()['parts'] if not is_frozen_partition(title)]
+        titles = titles or partitions_for_range(get_moscow_time().date(), None)
+
+    for title in titles:
+        store_ledger_part(title, load_partition_records(title))
+
+def snapshot_part_records(title, max_age, frozen):
+    """Записи раздела из снимка, если он там есть и не устарел (иначе None); вызывается под ledger_lock"""
+    parts = ledger_snapshot()['parts']
+    part = parts.get(title)
+    if part is None or (time.monotonic() - part['loaded_at'] > max_age and not frozen):
+        return None
+    parts.move_to_end(title)
+    return part['records']
+
+def get_partition_records(title, max_age):
+    """Записи одного раздела из снимка (замороженные разделы не устаревают).
+
+    Лист, который уже читает другой поток (например, упреждающая загрузка), не читается
+    второй раз: поток дожидается его загрузки и берет записи из снимка.
+    """
+    tenant = current_tenant()
+    frozen = is_frozen_partition(title)
+    with tenant.ledger_lock:
+        records = snapshot_part_records(title, max_age, frozen)
+        loading = tenant.loading_parts.setdefault(title, threading.Lock())
+    if records is None:
+        with loading:
+            with tenant.ledger_lock:
+                records = snapshot_part_records(title, max_age, frozen)
+            if records is None:
+                increment_metric("ledger.snapshot_misses")
+                records = load_partition_records(title)
+                store_ledger_part(title, records)
+                return records
+    increment_metric("ledger.snapshot_hits")
+    return records
+
+def get_finance_records(max_age=None, start=None, end=None, category=None):
+    """Возвращает записи таблицы финансов из снимка, перечитывая его при устаревании.
+
+    start/end (даты) ограничивают, какие разделы читать; сами записи по дате не фильтруются -
+    это делает вызывающий код, как и раньше. При локальной базе записи читаются из нее
+    (с отбором по дате и категории по индексам).
+    """
+    if uses_ledger_store():
+        return query_ledger_store(start, end, category)
+    max_age = LEDGER_SNAPSHOT_TTL if max_age is None else max_age
+    titles = partitions_for_range(start, end)
+    if len(titles) == 1:
+        records = get_partition_records(titles[0], max_age)
+    else:
+        records = []
+        for title in titles:
+            records.extend(get_partition_records(title, max_age))
+    if category is not None:
+        records = [record for record in records if record.category == category]
+    return records
+
+def get_recent_finance_records(count, columns=None):
+    """Последние count записей (при разбиении читаются только последние разделы).
+
+    Раздел, которого нет в свежем снимке, не загружается целиком: читаются только
+    последние строки и только колонки columns (остальные поля записей пустые).
+    """
+    if uses_ledger_store():
+        return query_ledger_store(limit=count)
+    recent = []
+    parts = ledger_snapshot()['parts']
+    for title in reversed(partitions_for_range()):
+        part = parts.get(title)
+        needed = count - len(recent)
+        if part is not None and (time.monotonic() - part['loaded_at'] <= LEDGER_SNAPSHOT_TTL or is_frozen_partition(title)):
+            increment_metric("ledger.snapshot_hits")
+            tail = part['records'][-needed:]
+        elif is_frozen_partition(title):
+            tail = get_partition_records(title, LEDGER_SNAPSHOT_TTL)[-needed:]
+        else:
+            increment_metric("ledger.tail_reads")
+            tail = read_sheet_tail(title, needed, columns)
+        recent = tail + recent
+        if len(recent) >= count:
+            break
+    return recent
+
+def iter_finance_records(start=None, end=None, chunk_size=1000):
+    """Записи за период [start, end] пачками по chunk_size (для выгрузок без загрузки всего в память).
+
+    В отличие от get_finance_records() записи отбираются по дате; без периода выдаются все,
+    включая записи без даты. При разбиении по месяцам разделы читаются по одному.
+    """
+    if uses_ledger_store():
+        yield from iter_ledger_store(start, end, chunk_size)
+        return
 
-**По категории:**
-• `/search зарплаты` - все зарплаты
-• `/search поставщик` - все оплаты поставщикам
+    def in_period(record):
+        day = record.day
+        return day is not None and (start is None or day >= start) and (end is None or day <= end)
+
+    for title in partitions_for_range(start, end):
+        records = get_partition_records(title, LEDGER_SNAPSHOT_TTL)
+        if start is not None or end is not None:
+            records = [record for record in records if in_period(record)]
+        for i in range(0, len(records), chunk_size):
+            yield records[i:i + chunk_size]
+
+def append_to_ledger_snapshot(row, title):
+    """Добавляет записанную строку в снимок, чтобы не перечитывать всю таблицу"""
+    with current_tenant().ledger_lock:
+        snapshot = ledger_snapshot()
+        snapshot['version'] += 1
+        part = snapshot['parts'].get(title)
+        if part is not None:
+            part['records'].append(parse_finance_record(row)[0])
+
+def freeze_partition(title):
+    """Замораживает раздел: сохраняет записи в локальный сжатый архив и помечает в каталоге"""
+    records = load_partition_records(title)
+    archive_path = partition_archive_path(title)
+    os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+    with gzip.open(archive_path + '.tmp', 'wt', encoding='utf-8') as f:
+        json.dump([record.as_dict() for record in records], f, ensure_ascii=False)
+    os.replace(archive_path + '.tmp', archive_path)
+
+    catalog_sheet = get_worksheet(PARTITION_CATALOG_SHEET)
+    titles = catalog_sheet.col_values(1)
+    row_number = titles.index(title) + 1
+    catalog_sheet.update(f"D{row_number}", [[PARTITION_FROZEN]])
+    for entry in get_partition_catalog():
+        if entry['sheet'] == title:
+            entry['status'] = PARTITION_FROZEN
+    store_ledger_part(title, records)
+    return len(records)
+
+# Локальная база операций (store == 'sqlite'): основное хранилище, из которого читают обработчики.
+# Google Таблица становится зеркалом: новые и измененные записи уходят в нее через очередь outbox,
+# а ручные правки в таблице забираются обратно сверкой (reconcile_ledger_store). Ключ записи
+# хранится в колонке "ID" таблицы - по нему повторная отправка не задваивает строки.
+LEDGER_KEY_COLUMN = 'ID'
+OUTBOX_BATCH_SIZE = 500
+# Пауза перед повторной отправкой растет вдвое после каждой ошибки, но не больше часа
+OUTBOX_RETRY_SECONDS = 30
+OUTBOX_MAX_BACKOFF = 3600
+
+LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ledger (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    sheet TEXT,
+    day TEXT,
+    date TEXT NOT NULL,
+    operation_type TEXT NOT NULL,
+    category TEXT NOT NULL,
+    description TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    amount NUMERIC,
+    comment TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ledger_day ON ledger(day);
+CREATE INDEX IF NOT EXISTS ledger_category ON ledger(category, day);
+CREATE INDEX IF NOT EXISTS ledger_recipient ON ledger(recipient);
+CREATE INDEX IF NOT EXISTS ledger_sheet ON ledger(sheet);
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    action TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_key ON outbox(key);
+"""
 
-**По периоду:**
-• `/search неделя` - операции за неделю
-• `/search месяц` - операции за месяц
+LEDGER_FIELDS = ['date', 'operation_type', 'category', 'description', 'amount', 'comment']
+
+def uses_ledger_store():
+    """Хранятся ли операции текущей организации в локальной базе"""
+    return current_tenant().store == 'sqlite'
+
+def ledger_db_path(tenant):
+    if tenant.name == DEFAULT_TENANT:
+        return os.path.join(LEDGER_DB_DIR, 'ledger.sqlite3')
+    return os.path.join(LEDGER_DB_DIR, f"{tenant.name}.sqlite3")
+
+def ledger_db():
+    """Соединение с базой текущей организации (общее для потоков, запись - под db_lock)"""
+    tenant = current_tenant()
+    if tenant.db is None:
+        path = ledger_db_path(tenant)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        db = sqlite3.connect(path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(LEDGER_SCHEMA)
+        tenant.db = db
+    return tenant.db
+
+def ledger_row_values(row):
+    """Значения колонок базы для строки таблицы (первые 6 колонок FINANCE_COLUMNS).
+
+    problem - описание ошибки разбора строки (или None), в базу не пишется.
+    """
+    row = list(row[:len(FINANCE_COLUMNS)]) + [''] * (len(FINANCE_COLUMNS) - len(row))
+    record, problem = parse_finance_record(row)
+    amount = row[4]
+    return {
+        'day': record.day.isoformat() if record.day else None,
+        'date': str(row[0]),
+        'operation_type': record.operation_type,
+        'category': record.category,
+        'description': record.description,
+        'recipient': record.description.strip().casefold(),
+        # Числа - как у get_all_records(): "1500" -> 1500
+        'amount': numericise(amount) if isinstance(amount, str) else amount,
+        'comment': record.comment,
+        'problem': problem
+    }
 
-**По сумме:**
-• `/search >50000` - операции больше 50к
-• `/search <10000` - операции меньше 10к
+def insert_ledger_row(db, row, key=None, sheet=None, action='append'):
+    """Вставляет строку в базу (и в очередь отправки, если action задан). Возвращает ключ"""
+    key = key or uuid.uuid4().hex
+    values = ledger_row_values(row)
+    db.execute(
+        "INSERT INTO ledger (key, sheet, day, date, operation_type, category, description, recipient, amount, comment)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (key, sheet, values['day'], values['date'], values['operation_type'], values['category'],
+         values['description'], values['recipient'], values['amount'], values['comment'])
+    )
+    if action:
+        db.execute("INSERT INTO outbox (key, action) VALUES (?, ?)", (key, action))
+    return key
+
+def update_ledger_row(db, key, values):
+    """Перезаписывает поля строки базы значениями ledger_row_values()"""
+    db.execute(
+        "UPDATE ledger SET day = ?, date = ?, operation_type = ?, category = ?, description = ?,"
+        " recipient = ?, amount = ?, comment = ? WHERE key = ?",
+        (values['day'], values['date'], values['operation_type'], values['category'],
+         values['description'], values['recipient'], values['amount'], values['comment'], key)
+    )
 
-**Комбинированный поиск:**
-• `/search Петров месяц` - операции с Петровым за месяц
-        """
-        await message.reply_text(help_text, parse_mode='Markdown')
+def add_to_ledger_store(row):
+    """Записывает операцию в базу и ставит ее в очередь отправки в таблицу"""
+    tenant = current_tenant()
+    db = ledger_db()
+    with tenant.db_lock, db:
+        key = insert_ledger_row(db, row)
+    tenant.ledger['version'] += 1
+    return key
+
+def update_ledger_store(key, row):
+    """Меняет операцию в базе и ставит изменение в очередь отправки в таблицу"""
+    tenant = current_tenant()
+    db = ledger_db()
+    with tenant.db_lock, db:
+        update_ledger_row(db, key, ledger_row_values(row))
+        db.execute("INSERT INTO outbox (key, action) VALUES (?, 'update')", (key,))
+    tenant.ledger['version'] += 1
+    publish_data_change()
+
+def ensure_ledger_store():
+    """При первом обращении к пустой базе загружает в нее записи из таблицы"""
+    tenant = current_tenant()
+    if tenant.store_ready:
         return
-
-    search_query = " ".join(args).lower()
-
+    if ledger_db().execute("SELECT 1 FROM ledger LIMIT 1").fetchone() is None:
+        reconcile_ledger_store()
+    tenant.store_ready = True
+
+def ledger_store_filter(start=None, end=None, category=None, recipient=None):
+    """Условие WHERE и параметры отбора записей базы"""
+    conditions, params = [], []
+    if start is not None:
+        conditions.append("day >= ?")
+        params.append(start.isoformat())
+    if end is not None:
+        conditions.append("day <= ?")
+        params.append(end.isoformat())
+    if category is not None:
+        conditions.append("category = ?")
+        params.append(category)
+    if recipient is not None:
+        conditions.append("recipient = ?")
+        params.append(recipient.strip().casefold())
+    return (" WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+LEDGER_STORE_SELECT = "SELECT date, operation_type, category, description, amount, comment FROM ledger"
+
+def query_ledger_store(start=None, end=None, category=None, recipient=None, limit=None):
+    """Записи из базы в формате get_all_records() (в порядке добавления).
+
+    start/end отбирают записи по дате (записи без даты в период не попадают),
+    recipient - точное совпадение получателя без учета регистра.
+    """
+    ensure_ledger_store()
+    where, params = ledger_store_filter(start, end, category, recipient)
+    sql = LEDGER_STORE_SELECT + where
+    if limit is not None:
+        sql += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+    else:
+        sql += " ORDER BY id"
+
+    started = time.monotonic()
+    rows = ledger_db().execute(sql, params).fetchall()
+    record_timing("ledger.store_query", time.monotonic() - started)
+    if limit is not None:
+        rows.reverse()
+    return [parse_finance_record(row)[0] for row in rows]
+
+def iter_ledger_store(start=None, end=None, chunk_size=1000):
+    """Записи из базы пачками по chunk_size через отдельное соединение (снимок WAL на время чтения)"""
+    ensure_ledger_store()
+    where, params = ledger_store_filter(start, end)
+    db = sqlite3.connect(ledger_db_path(current_tenant()))
     try:
-        await message.reply_text(f"🔍 Ищу операции по запросу: '{search_query}'...")
+        cursor = db.execute(LEDGER_STORE_SELECT + where + " ORDER BY id", params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [parse_finance_record(row)[0] for row in rows]
+    finally:
+        db.close()
+
+def mirror_key_column(worksheet, values=None):
+    """Номер колонки "ID" в листе (добавляет заголовок, если его еще нет)"""
+    header = values[0] if values else worksheet.row_values(1)
+    if LEDGER_KEY_COLUMN in header:
+        return header.index(LEDGER_KEY_COLUMN) + 1
+    column = max(len(header), len(FINANCE_COLUMNS)) + 1
+    worksheet.update(f"{column_letter(column)}1", [[LEDGER_KEY_COLUMN]])
+    return column
+
+def column_letter(index):
+    """Переводит номер колонки (с 1) в буквенное обозначение A1"""
+    letters = ''
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+def mirror_row(record, key, key_column):
+    row = [record[field] for field in LEDGER_FIELDS]
+    return row + [''] * (key_column - 1 - len(row)) + [key]
+
+def replicate_ledger_outbox():
+    """Отправляет в таблицу записи из очереди outbox.
+
+    Новые записи добавляются пачками append_rows, измененные - обновлением строки по ключу.
+    При повторной отправке сначала проверяется колонка "ID": если строка уже дошла до таблицы
+    (ответ потерялся по таймауту), второй раз она не добавляется. Ошибка откладывает запись
+    с растущей паузой. Возвращает число отправленных записей.
+    """
+    tenant = current_tenant()
+    db = ledger_db()
+    now = time.time()
+    pending = db.execute(
+        "SELECT o.id, o.key, o.action, o.attempts, l.date, l.operation_type, l.category, l.description, l.amount, l.comment, l.sheet"
+        " FROM outbox o JOIN ledger l ON l.key = o.key WHERE o.next_attempt_at <= ? ORDER BY o.id LIMIT ?",
+        (now, OUTBOX_BATCH_SIZE)
+    ).fetchall()
+    # Записи, удаленные из базы сверкой, отправлять уже не нужно
+    with tenant.db_lock, db:
+        db.execute("DELETE FROM outbox WHERE key NOT IN (SELECT key FROM ledger)")
+    if not pending:
+        return 0
+
+    # Разбиваем по листам: новые записи - в раздел месяца операции, измененные - туда, где они лежат
+    batches = {}
+    for outbox_id, key, action, attempts, *fields, sheet in pending:
+        record = dict(zip(LEDGER_FIELDS, fields))
+        if action == 'append':
+            day = parse_record_date(record['date'])
+            sheet = sheet or current_partition(day)
+        batches.setdefault(sheet, []).append((outbox_id, key, action, attempts, record))
+
+    sent = 0
+    for title, items in batches.items():
+        try:
+            worksheet = get_worksheet(title)
+            key_column = mirror_key_column(worksheet)
+            sheet_keys = {}
+            if any(attempts or action == 'update' for _, _, action, attempts, _ in items):
+                # Проекция: нужна только колонка ID
+                sheet_keys = {
+                    key: row_number
+                    for row_number, key in enumerate(worksheet.col_values(key_column, value_render_option='UNFORMATTED_VALUE'), 1)
+                    if key
+                }
+
+            appends = [item for item in items if item[2] == 'append' and item[1] not in sheet_keys]
+            if appends:
+                worksheet.append_rows([mirror_row(record, key, key_column) for _, key, _, _, record in appends])
+            updates = []
+            for _, key, action, _, record in items:
+                if action != 'update':
+                    continue
+                row_number = sheet_keys.get(key)
+                if row_number is None:
+                    raise LookupError(f"строка {key} не найдена в листе {title}")
+                updates.append({'range': f"A{row_number}:{column_letter(len(LEDGER_FIELDS))}{row_number}", 'values': [[record[field] for field in LEDGER_FIELDS]]})
+            if updates:
+                worksheet.batch_update(updates)
+        except Exception as e:
+            increment_metric("ledger.outbox_errors")
+            logger.error(f"Ошибка отправки записей в лист '{title}': {e}")
+            with tenant.db_lock, db:
+                for outbox_id, _, _, attempts, _ in items:
+                    delay = min(OUTBOX_RETRY_SECONDS * 2 ** attempts, OUTBOX_MAX_BACKOFF)
+                    db.execute(
+                        "UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                        (attempts + 1, now + delay, str(e), outbox_id)
+                    )
+            continue
 
-        finance_records = finance_sheet.get_all_records()
-        found_records = []
+        with tenant.db_lock, db:
+            for outbox_id, key, _, _, _ in items:
+                db.execute("DELETE FROM outbox WHERE id = ?", (outbox_id,))
+                db.execute("UPDATE ledger SET sheet = ? WHERE key = ?", (title, key))
+        sent += len(items)
+        increment_metric("ledger.outbox_sent", len(items))
+    return sent
+
+def reconcile_ledger_store():
+    """Сверяет базу с таблицей и забирает ручные правки.
+
+    Строки, измененные в таблице, обновляются в базе; строки, добавленные вручную,
+    получают ключ (он дописывается в колонку "ID") и попадают в базу; записи, удаленные
+    из таблицы, удаляются из базы. Записи, которые еще ждут отправки, не трогаются -
+    локальное изменение новее. Замороженные разделы загружаются из архива один раз.
+    """
+    tenant = current_tenant()
+    db = ledger_db()
+    pending_keys = {key for key, in db.execute("SELECT DISTINCT key FROM outbox")}
+    changes = {'added': 0, 'updated': 0, 'deleted': 0}
+
+    for title in partitions_for_range():
+        if is_frozen_partition(title):
+            if db.execute("SELECT 1 FROM ledger WHERE sheet = ? LIMIT 1", (title,)).fetchone() is None:
+                with tenant.db_lock, db:
+                    for i, record in enumerate(load_partition_records(title), 2):
+                        insert_ledger_row(db, record.as_row(), key=f"{title}:{i}", sheet=title, action=None)
+                        changes['added'] += 1
+            continue
+
+        worksheet = get_worksheet(title)
+        started = time.monotonic()
+        values = worksheet.get_all_values()
+        record_timing("ledger.load", time.monotonic() - started)
+        if not values or values[0][:len(FINANCE_COLUMNS)] != FINANCE_COLUMNS:
+            logger.warning(f"Лист '{title}' пропущен при сверке: неожиданные заголовки")
+            continue
+        key_column = mirror_key_column(worksheet, values)
 
-        # Анализируем поисковый запрос
-        filters = parse_search_query(search_query)
+        local = {
+            key: list(fields)
+            for key, *fields in db.execute(
+                "SELECT key, date, operation_type, category, description, amount, comment FROM ledger WHERE sheet = ?", (title,)
+            )
+        }
+        new_keys = []
+        problems = []
+        with tenant.db_lock, db:
+            for row_number, row in enumerate(values[1:], 2):
+                row = row + [''] * (key_column - len(row))
+                fields = row[:len(FINANCE_COLUMNS)]
+                if not any(str(value).strip() for value in fields):
+                    continue
+                sheet_values = ledger_row_values(fields)
+                if sheet_values['problem']:
+                    problems.append((row_number, sheet_values['problem']))
+                key = row[key_column - 1]
+                if not key:
+                    key = insert_ledger_row(db, fields, sheet=title, action=None)
+                    new_keys.append({'range': f"{column_letter(key_column)}{row_number}", 'values': [[key]]})
+                    changes['added'] += 1
+                    continue
+                known = local.pop(key, None)
+                if key in pending_keys:
+                    continue
+                if known is None:
+                    # Ключ есть в таблице, но не в базе (например, база создана заново)
+                    db.execute("DELETE FROM ledger WHERE key = ?", (key,))
+                    insert_ledger_row(db, fields, key=key, sheet=title, action=None)
+                    changes['added'] += 1
+                    continue
+                if known != [sheet_values[field] for field in LEDGER_FIELDS]:
+                    update_ledger_row(db, key, sheet_values)
+                    changes['updated'] += 1
+            for key in local:
+                if key not in pending_keys:
+                    db.execute("DELETE FROM ledger WHERE key = ?", (key,))
+                    changes['deleted'] += 1
+
+        report_parse_errors(title, problems)
+        for i in range(0, len(new_keys), OUTBOX_BATCH_SIZE):
+            worksheet.batch_update(new_keys[i:i + OUTBOX_BATCH_SIZE])
+
+    if any(changes.values()):
+        tenant.ledger['version'] += 1
+        publish_data_change()
+        for name, count in changes.items():
+            increment_metric(f"ledger.reconcile_{name}", count)
+        logger.info(f"Сверка с таблицей ({tenant.name}): {changes}")
+    return changes
 
-        for record in finance_records:
-            if matches_filters(record, filters):
-                found_records.append(record)
+def update_user_context(user_id, operation_data):
+    """Обновляет контекст пользователя (в общем состоянии процессов)"""
+    user_context = get_user_context(user_id) or {'recent_operations': []}
 
-        if not found_records:
-            await message.reply_text(f"❌ По запросу '{search_query}' ничего не найдено.")
-            return
+    # Формируем строку операции для контекста
+    context_line = f"{operation_data['data']['description']}: {operation_data['data']['amount']:,.0f} ₽ ({operation_data['data']['category']})"
 
-        # Сортируем по дате (новые сверху)
-        found_records = sorted(found_records, key=lambda x: datetime.strptime(x.get('Дата', '01.01.2000'), '%d.%m.%Y'), reverse=True)
+    user_context['recent_operations'].append(context_line)
 
-        # Формируем результат
-        result = f"🔍 **Найдено: {len(found_records)} операций**\n"
-        result += f"📊 **Запрос:** {search_query}\n\n"
+    # Храним только последние 10 операций
+    user_context['recent_operations'] = user_context['recent_operations'][-10:]
+    shared_state().set(state_key('context', user_id), user_context)
 
-        # Группируем результаты
-        if len(found_records) > 15:
-            result += "📋 **Последние 15 операций:**\n"
-            display_records = found_records[:15]
+def add_finance_record(data, user_id):
+    """Добавляет финансовую запись в таблицу"""
+    try:
+        row = [
+            format_moscow_date(),  # Московское время
+            data['operation_type'],
+            data['category'],
+            data['description'],
+            data['amount'],
+            data.get('comment', '')
+        ]
+        if uses_ledger_store():
+            # В таблицу запись попадет фоновой отправкой очереди
+            location = {'key': add_to_ledger_store(row)}
         else:
-            display_records = found_records
+            title = current_partition()
+            worksheet = get_worksheet(title)
+            # Процессы дописывают лист по очереди - номер строки и счетчик строк остаются верными
+            with shared_state().lock(state_key('append', title)):
+                response = worksheet.append_row(row)
+                location = {'sheet': title, 'row': note_appended_rows(title, response) or sheet_row_count(title)}
+            append_to_ledger_snapshot(row, title)
+        publish_data_change([row])
+    except Exception as e:
+        logger.error(f"Ошибка записи финансов: {e}")
+        return False
 
-        for record in display_records:
-            emoji = "📈" if record.get('Сумма', 0) > 0 else "📉"
-            category = record.get('Категория', 'Прочее')
-            date = record.get('Дата', '')
-            description = record.get('Описание/Получатель', '')
-            amount = record.get('Сумма', 0)
+    # Операция уже записана: ошибки дальше только в логе, иначе пользователь запишет ее повторно
+    note_recorded_rows([row])
+    try:
+        # Сохраняем последнюю операцию
+        last_operation = {
+            'type': 'finance',
+            'data': data,
+            **location,
+            'timestamp': get_moscow_time().isoformat()
+        }
+        shared_state().set(state_key('last_operation', user_id), last_operation)
 
-            result += f"{emoji} {date}: {description} - {amount:,.0f} ₽ ({category})\n"
+        # Обновляем контекст
+        update_user_context(user_id, last_operation)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения последней операции: {e}")
+    return True
 
-        if len(found_records) > 15:
-            result += f"\n... и ещё {len(found_records) - 15} операций"
+def note_recorded_rows(rows):
+    """Добавляет записанные строки в указатель получателей, расходы бюджетов, поиск повторов и профили.
 
-        # Аналитика результатов
-        total_amount = sum(record.get('Сумма', 0) for record in found_records)
-        income = sum(record.get('Сумма', 0) for record in found_records if record.get('Сумма', 0) > 0)
-        expense = sum(record.get('Сумма', 0) for record in found_records if record.get('Сумма', 0) < 0)
+    Ошибка здесь не отменяет записи: она пишется в лог, а производные данные сбрасываются
+    и соберутся заново при следующем обращении.
+    """
+    try:
+        for row in rows:
+            note_recipient(row[3])
+            note_budget_spending(row)
+            note_duplicate_key(row)
+            note_recipient_profile(row)
+    except Exception as e:
+        logger.error(f"Ошибка учета записанных операций: {e}")
+        tenant = current_tenant()
+        with tenant.ledger_lock:
+            tenant.recipient_index = None
+        tenant.budget_spending = None
+        tenant.duplicate_index = None
+        tenant.recipient_profiles = None
+
+# Сколько строк записывать в таблицу одним запросом append_rows
+LEDGER_APPEND_BATCH_SIZE = 500
+
+def add_finance_records_bulk(rows):
+    """Записывает много операций сразу: в базу - одной транзакцией, в таблицу - пачками append_rows.
+
+    При разбиении по месяцам строки раскладываются по разделам месяцев операций.
+    Возвращает число записанных строк.
+    """
+    if uses_ledger_store():
+        tenant = current_tenant()
+        db = ledger_db()
+        with tenant.db_lock, db:
+            for row in rows:
+                insert_ledger_row(db, row)
+        tenant.ledger['version'] += 1
+        publish_data_change(rows)
+        note_recorded_rows(rows)
+        return len(rows)
+
+    rows_by_title = {}
+    for row in rows:
+        rows_by_title.setdefault(current_partition(parse_record_date(row[0])), []).append(row)
+    for title, title_rows in rows_by_title.items():
+        worksheet = get_worksheet(title)
+        for i in range(0, len(title_rows), LEDGER_APPEND_BATCH_SIZE):
+            batch = title_rows[i:i + LEDGER_APPEND_BATCH_SIZE]
+            with shared_state().lock(state_key('append', title)):
+                note_appended_rows(title, worksheet.append_rows(batch), len(batch))
+            for row in batch:
+                append_to_ledger_snapshot(row, title)
+            note_recorded_rows(batch)
+        publish_data_change(title_rows)
+    return len(rows)
+
+class PhraseMatcher:
+    """Автомат Ахо-Корасик: находит все вхождения набора фраз за один проход по тексту"""
+
+    def __init__(self, phrases):
+        """phrases - пары (фраза, метка); метка возвращается при каждом вхождении фразы"""
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+
+        for phrase, tag in phrases:
+            node = 0
+            for char in phrase:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                    self._goto[node][char] = next_node
+                node = next_node
+            self._out[node] += (tag,)
+
+        # Ссылки неудач строим обходом в ширину
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, next_node in self._goto[node].items():
+                queue.append(next_node)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[next_node] = fail if fail != next_node else 0
+                self._out[next_node] += self._out[self._fail[next_node]]
+
+    def iter_tags(self, text):
+        """Возвращает метки всех найденных в тексте фраз (включая перекрывающиеся)"""
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node]:
+                yield from out[node]
+
+# Голосовые команды в порядке приоритета: при совпадении нескольких побеждает верхняя
+VOICE_COMMAND_PHRASES = [
+    # Команды по получателям (НОВОЕ!)
+    ('recipients', ['кому платили', 'анализ получателей', 'по получателям', 'кому больше', 'топ получателей']),
+    # Команды по поставщикам (ПРИОРИТЕТ!)
+    ('suppliers', ['анализ поставщика', 'по поставщику', 'история с', 'поставщик']),
+    # Команды аналитики
+    ('analytics', ['анализ', 'аналитика', 'отчет', 'покажи траты', 'сколько потратили']),
+    # Команды поиска
+    ('search', ['найди', 'найти', 'поиск', 'покажи операции', 'когда платили']),
+    # Команды по категориям
+    ('categories', ['по категориям', 'категории', 'расходы по']),
+    # Команды истории
+    ('history', ['история', 'последние операции', 'что было']),
+    # Команды бэкапа
+    ('backup', ['бэкап', 'резервная копия', 'сохрани', 'backup']),
+]
+
+# Периоды в порядке приоритета
+VOICE_PERIOD_PHRASES = [
+    ('неделя', ['неделя', 'неделю']),
+    ('месяц', ['месяц']),
+] + [(month, [month]) for month in [
+    'январь', 'февраль', 'март', 'апрель', 'май', 'июнь',
+    'июль', 'август', 'сентябрь', 'октябрь', 'ноябрь', 'декабрь'
+]]
+
+# Категории в порядке приоритета
+VOICE_CATEGORY_PHRASES = [
+    ('зарплаты', ['зарплат', 'зарплаты']),
+    ('поставщик', ['поставщик', 'поставщиков']),
+    ('процент', ['процент', 'проценты']),
+]
+
+VOICE_SCAN_KINDS = ('command', 'period', 'category')
+
+def _build_voice_matcher():
+    phrases = []
+    for kind, table in zip(VOICE_SCAN_KINDS, (VOICE_COMMAND_PHRASES, VOICE_PERIOD_PHRASES, VOICE_CATEGORY_PHRASES)):
+        for priority, (value, kind_phrases) in enumerate(table):
+            for phrase in kind_phrases:
+                phrases.append((phrase, (kind, priority, value)))
+    return PhraseMatcher(phrases)
+
+VOICE_MATCHER = _build_voice_matcher()
+
+# Имена после ключевых слов в командах поставщиков (в порядке приоритета)
+SUPPLIER_NAME_PATTERNS = tuple(re.compile(pattern, re.IGNORECASE) for pattern in [
+    r'поставщика\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?)',
+    r'поставщику\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?)',
+    r'история\s+с\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?)',
+    r'по\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?)',
+    r'анализ\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?)'
+])
+
+# Любые имена с большой буквы
+CAPITALIZED_NAME_PATTERN = re.compile(r'\b[А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?\b')
+
+# Известные падежные формы поставщиков
+SUPPLIER_NAME_FORMS = {
+    'интигаму': 'Интигам', 'интигама': 'Интигам',
+    'балтики': 'Балтика', 'балтике': 'Балтика', 'балтику': 'Балтика',
+    'петрову': 'Петров', 'петрова': 'Петров',
+    'рустаму': 'Рустам', 'рустама': 'Рустам',
+}
+
+def strip_case_ending(name):
+    """Убирает падежное окончание у нового имени"""
+    if name.endswith('у') or name.endswith('а') or name.endswith('е'):
+        return name[:-1]
+    return name
+
+# Слова описаний (без цифр и знаков)
+NAME_WORD_PATTERN = re.compile(r'[^\W\d_]+')
+NAME_CONSONANTS = frozenset('бвгджзклмнпрстфхцчшщ')
+# Слово из таблицы считается падежной формой другого, если то встречается хотя бы во столько раз чаще
+RECIPIENT_DOMINANCE = 3
+# Версии указателей получателей уникальны для всех организаций - по ним кэшируются планы поиска
+RECIPIENT_INDEX_VERSIONS = itertools.count(1)
+# Латинские буквы, которые распознавание речи и раскладка подставляют вместо похожих русских
+NAME_HOMOGLYPHS = str.maketrans('aceopxykё', 'асеорхуке')
+# Минимальное сходство по триграммам для "Возможно, вы имели в виду"
+FUZZY_MATCH_THRESHOLD = 0.3
+
+def fold_name(word):
+    """Слово в нижнем регистре; в русских словах латинские двойники букв заменены русскими"""
+    word = word.lower()
+    if re.search('[а-яё]', word):
+        return word.translate(NAME_HOMOGLYPHS)
+    return word
+
+def name_trigrams(word):
+    """Триграммы слова с отступами по краям (как в pg_trgm): начало слова весит больше"""
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def name_case_forms(word):
+    """Падежные формы слова-имени в нижнем регистре (вместе с самим словом)"""
+    forms = {word}
+    if len(word) < 3:
+        return forms
+    stem, last = word[:-1], word[-1]
+    if word.endswith('ия'):
+        endings = ('и', 'ю', 'ей', 'ею')
+    elif last == 'а':
+        endings = ('и' if stem[-1] in 'гкхжшчщ' else 'ы', 'е', 'у', 'ой', 'ою')
+    elif last == 'я':
+        endings = ('и', 'е', 'ю', 'ей', 'ею')
+    elif last == 'й':
+        endings = ('я', 'ю', 'ем', 'е')
+    elif last == 'ь':
+        endings = ('я', 'ю', 'ем', 'е', 'и')
+    elif last in NAME_CONSONANTS:
+        stem = word
+        endings = ('а', 'у', 'ом', 'ем', 'е', 'ым') if word.endswith(('ов', 'ев', 'ин', 'ын')) else ('а', 'у', 'ом', 'ем', 'е')
+    else:
+        return forms  # несклоняемые: Шоу, Кафе, Рено
+    forms.update(stem + ending for ending in endings)
+    return forms
+
+class RecipientIndex:
+    """Указатель получателей: падежная форма слова -> слово, как оно записано в таблице.
+
+    Формы порождаются правилами склонения для каждого слова описаний, поэтому
+    "Рустаму" или "Балтике" находят "Рустам" и "Балтика" одним обращением к словарю.
+    Для опечаток ("Интегам") слова дополнительно разложены по триграммам.
+    """
 
-        result += f"\n\n📊 **Итоги поиска:**\n"
-        result += f"💰 Общая сумма: {total_amount:,.0f} ₽\n"
-        if income > 0:
-            result += f"📈 Доходы: +{income:,.0f} ₽\n"
-        if expense < 0:
-            result += f"📉 Расходы: {expense:,.0f} ₽\n"
+    def __init__(self, ledger_version=None):
+        self.counts = {}    # слово в нижнем регистре -> сколько раз встречается
+        self.spelling = {}  # слово в нижнем регистре -> написание из таблицы
+        self.forms = {}     # форма -> слова, от которых она образована
+        self.trigrams = {}  # триграмма -> слова, в которых она есть
+        self.trigram_counts = {}  # слово -> число его триграмм
+        self.ledger_version = ledger_version
+        self.version = next(RECIPIENT_INDEX_VERSIONS)
+        self.sources = set()  # листы снимка (или локальная база), описания которых уже учтены
+
+    def add(self, description, count=1):
+        """Учитывает описание операции, встретившееся count раз"""
+        for word in NAME_WORD_PATTERN.findall(description):
+            key = fold_name(word)
+            if len(key) < 3:
+                continue
+            if key not in self.counts:
+                self.counts[key] = 0
+                self.spelling[key] = word
+                for form in name_case_forms(key):
+                    self.forms.setdefault(form, set()).add(key)
+                trigrams = name_trigrams(key)
+                for trigram in trigrams:
+                    self.trigrams.setdefault(trigram, []).append(key)
+                self.trigram_counts[key] = len(trigrams)
+                self.version = next(RECIPIENT_INDEX_VERSIONS)
+            self.counts[key] += count
+
+    def resolve_word(self, word):
+        """Слово из таблицы для формы word (None, если такого слова в описаниях нет).
+
+        Слово, само записанное в таблице, остается собой, пока другое слово с той же
+        формой не встречается в RECIPIENT_DOMINANCE раз чаще ("Рустаму" -> "Рустам").
+        """
+        form = fold_name(word)
+        candidates = self.forms.get(form)
+        if not candidates:
+            return None
+        best = max(candidates, key=lambda key: (self.counts[key], key))
+        if form in candidates and self.counts[best] < self.counts[form] * RECIPIENT_DOMINANCE:
+            best = form
+        return self.spelling[best]
+
+    def similar_words(self, word, limit=3):
+        """Похожие слова из таблицы: [(написание, сходство)] по убыванию сходства.
+
+        Сходство - доля общих триграмм (Жаккар), у слова в косвенном падеже сравнивается
+        и форма без окончания. Кандидаты собираются только по спискам триграмм запроса,
+        поэтому поиск не перебирает все слова таблицы.
+        """
+        scores = {}
+        for variant in {fold_name(word), fold_name(strip_case_ending(word))}:
+            query = name_trigrams(variant)
+            shared = Counter()
+            for trigram in query:
+                shared.update(self.trigrams.get(trigram, ()))
+            for key, count in shared.items():
+                score = count / (len(query) + self.trigram_counts[key] - count)
+                if score > scores.get(key, 0):
+                    scores[key] = score
+        best = heapq.nlargest(limit, (
+            (score, self.counts[key], key) for key, score in scores.items() if score >= FUZZY_MATCH_THRESHOLD
+        ))
+        return [(self.spelling[key], round(score, 2)) for score, _, key in best]
+
+    def resolve_name(self, name):
+        """Имя из таблицы для имени в любом падеже (None, если какое-то слово не найдено)"""
+        resolved = [self.resolve_word(word) for word in name.split()]
+        if not resolved or None in resolved:
+            return None
+        return " ".join(resolved)
+
+    def canonical_description(self, description):
+        """Описание, в котором падежные формы известных слов заменены исходными.
+
+        Слово, которое само записано в таблице, не заменяется: "Петрова" может быть
+        другим получателем, чем "Петров", и при группировке их суммы не смешиваются.
+        """
+        def replace(match):
+            word = match.group(0)
+            if fold_name(word) in self.counts:
+                return word
+            resolved = self.resolve_word(word)
+            return resolved if resolved and resolved.lower() != word.lower() else word
+        return NAME_WORD_PATTERN.sub(replace, description)
+
+    def suggest(self, words):
+        """Замена неизвестных слов самыми похожими из таблицы (None, если заменять нечего)"""
+        suggestion = []
+        for word in words:
+            if len(word) >= 3 and NAME_WORD_PATTERN.fullmatch(word) and self.resolve_word(word) is None:
+                candidates = self.similar_words(word, 1)
+                if candidates:
+                    suggestion.append(candidates[0][0])
+                    continue
+            suggestion.append(word)
+        return " ".join(suggestion) if suggestion != list(words) else None
 
-        await message.reply_text(result, parse_mode='Markdown')
+# Источник указателя получателей при локальной базе (вместо листов снимка)
+RECIPIENT_SOURCE_DB = 'ledger.sqlite3'
 
-    except Exception as e:
-        logger.error(f"Ошибка продвинутого поиска: {e}")
-        await message.reply_text("❌ Ошибка при поиске операций.")
+def build_recipient_index():
+    """Строит указатель получателей по уже прочитанным данным, не обращаясь к таблице.
 
-def parse_search_query(query):
-    """Парсит поисковый запрос и извлекает фильтры"""
-    filters = {
-        'text': [],
-        'categories': [],
-        'amount_min': None,
-        'amount_max': None,
-        'amount_exact': None,
-        'period': None
-    }
+    При локальной базе описания берутся одним GROUP BY (если база уже заполнена),
+    иначе указатель пуст - листы снимка добавляет recipient_index().
+    """
+    started = time.monotonic()
+    tenant = current_tenant()
+    index = RecipientIndex(tenant.ledger['version'])
+    if uses_ledger_store() and tenant.store_ready:
+        descriptions = ledger_db().execute("SELECT description, COUNT(*) FROM ledger GROUP BY description").fetchall()
+        for description, count in descriptions:
+            index.add(description or '', count)
+        index.sources.add(RECIPIENT_SOURCE_DB)
+    record_timing("recipients.index_build", time.monotonic() - started)
+    return index
+
+def recipient_index():
+    """Указатель получателей текущей организации по уже прочитанным данным.
+
+    Листы, прочитанные после построения, добавляются в указатель при следующем
+    обращении; ради указателя таблица не читается.
+    """
+    tenant = current_tenant()
+    # Построение и дополнение указателя - под блокировкой снимка: его могут звать и потоки пула
+    with tenant.ledger_lock:
+        index = tenant.recipient_index
+        if index is None or (uses_ledger_store() and tenant.store_ready and RECIPIENT_SOURCE_DB not in index.sources):
+            index = tenant.recipient_index = build_recipient_index()
+        if not uses_ledger_store():
+            for title, part in tenant.ledger['parts'].items():
+                if title not in index.sources:
+                    for description, count in Counter(record.description for record in part['records']).items():
+                        index.add(description, count)
+                    index.sources.add(title)
+    return index
+
+def note_recipient(description):
+    """Добавляет в построенный указатель получателя только что записанной операции"""
+    tenant = current_tenant()
+    with tenant.ledger_lock:
+        if tenant.recipient_index is not None:
+            tenant.recipient_index.add(description)
+
+def refresh_recipient_index():
+    """Перестраивает указатель по локальной базе, если она менялась (в том числе сверкой с таблицей).
+
+    Для листов снимка это делает store_ledger_part: измененный лист сбрасывает указатель.
+    """
+    tenant = current_tenant()
+    with tenant.ledger_lock:
+        index = tenant.recipient_index
+        if uses_ledger_store() and index is not None and index.ledger_version != tenant.ledger['version']:
+            tenant.recipient_index = build_recipient_index()
+
+def resolve_recipient_name(name):
+    """Имя получателя, как оно записано в таблице, для имени в любом падеже (или None)"""
+    return recipient_index().resolve_name(name)
+
+# Доли бюджета, при достижении которых бот предупреждает (по убыванию)
+BUDGET_ALERT_SHARES = (1.0, 0.8)
+
+def build_budget_spending():
+    """Пересчитывает по таблице расходы текущего месяца в категориях с бюджетом"""
+    tenant = current_tenant()
+    today = get_moscow_time().date()
+    spent = dict.fromkeys(tenant.budgets, 0.0)
+    for record in get_finance_records(start=today.replace(day=1), end=today):
+        if (record.amount < 0 and record.category in spent and record.day is not None
+                and (record.day.year, record.day.month) == (today.year, today.month)):
+            spent[record.category] -= record.amount
+    tenant.budget_spending = {'month': (today.year, today.month), 'spent': spent}
+    return tenant.budget_spending
+
+def budget_spending():
+    """Счетчики расходов текущего месяца (пересчитываются при смене месяца или чужих изменениях)"""
+    tenant = current_tenant()
+    spending = tenant.budget_spending
+    today = get_moscow_time().date()
+    if spending is None or spending['month'] != (today.year, today.month):
+        spending = build_budget_spending()
+    return spending
+
+def note_budget_spending(row):
+    """Прибавляет только что записанную строку к счетчику ее категории (если у нее есть бюджет)"""
+    tenant = current_tenant()
+    amount = parse_amount(row[4]) or 0
+    if amount >= 0 or row[2] not in tenant.budgets:
+        return
+    spending = tenant.budget_spending
+    day = parse_record_date(str(row[0]))
+    if spending is None or day is None or spending['month'] != (day.year, day.month):
+        # Несчитанные счетчики пересчитаются из таблицы уже с этой строкой
+        return
+    spending['spent'][row[2]] += -amount
+
+def budget_alert(category, amount):
+    """Предупреждение, если записанный расход amount довел категорию до 80% или 100% бюджета (или None)"""
+    limit = current_tenant().budgets.get(category)
+    if not limit or amount >= 0:
+        return None
+    spent = budget_spending()['spent'].get(category, 0)
+    before = spent + amount
+    for share in BUDGET_ALERT_SHARES:
+        if before < limit * share <= spent:
+            if share >= 1:
+                return f"🚨 **Бюджет «{category}» превышен:** {spent:,.0f} из {limit:,.0f} ₽"
+            return f"⚠️ **Бюджет «{category}» израсходован на {spent / limit:.0%}:** {spent:,.0f} из {limit:,.0f} ₽"
+    return None
 
-    tokens = query.split()
+# Сколько последних дней (включая сегодняшний) проверять на повтор перед записью
+DUPLICATE_WINDOW_DAYS = 1
+# Сколько минут ждать подтверждения записи, похожей на повтор
+DUPLICATE_CONFIRM_MINUTES = 30
+
+def duplicate_key(description, amount):
+    """Ключ повтора: получатель без регистра, знаков и подмененных латинских букв, и сумма"""
+    words = NAME_WORD_PATTERN.findall(str(description).lower().translate(NAME_HOMOGLYPHS))
+    return ' '.join(words), round(float(amount), 2)
+
+def build_duplicate_index():
+    """Строит по таблице указатель операций за последние DUPLICATE_WINDOW_DAYS дней"""
+    tenant = current_tenant()
+    today = get_moscow_time().date()
+    start = today - timedelta(days=DUPLICATE_WINDOW_DAYS - 1)
+    days = {}
+    for record in get_finance_records(start=start, end=today):
+        if record.day is not None and start <= record.day <= today:
+            days.setdefault(record.day, Counter())[duplicate_key(record.description, record.amount)] += 1
+    tenant.duplicate_index = {'start': start, 'days': days}
+    return tenant.duplicate_index
+
+def duplicate_index():
+    """Указатель повторов: {'start': первый день окна, 'days': {день: Counter(ключ повтора)}}.
+
+    Строится при первом обращении, а со сменой дня окно сдвигается - старые дни выпадают.
+    """
+    tenant = current_tenant()
+    index = tenant.duplicate_index
+    if index is None:
+        return build_duplicate_index()
+    start = get_moscow_time().date() - timedelta(days=DUPLICATE_WINDOW_DAYS - 1)
+    if index['start'] != start:
+        for day in [day for day in index['days'] if day < start]:
+            del index['days'][day]
+        index['start'] = start
+    return index
+
+def note_duplicate_key(row):
+    """Добавляет только что записанную строку в построенный указатель повторов"""
+    index = current_tenant().duplicate_index
+    if index is None:
+        return  # указатель построится из таблицы уже с этой строкой
+    day = parse_record_date(str(row[0]))
+    amount = parse_amount(row[4])
+    if day is None or amount is None or day < index['start']:
+        return
+    index['days'].setdefault(day, Counter())[duplicate_key(row[3], amount)] += 1
 
-    for token in tokens:
-        # Поиск по сумме
-        if token.startswith('>'):
-            try:
-                filters['amount_min'] = float(token[1:])
-                continue
-            except:
-                pass
+def find_duplicate(description, amount):
+    """Сколько таких же операций (получатель и сумма) уже записано за окно - проверка перед записью"""
+    key = duplicate_key(description, amount)
+    return sum(counter.get(key, 0) for counter in duplicate_index()['days'].values())
 
-        if token.startswith('<'):
-            try:
-                filters['amount_max'] = float(token[1:])
-                continue
-            except:
-                pass
+async def prepare_write_checks(category):
+    """Строит вне цикла событий то, что нужно проверкам перед записью, если этого еще нет.
 
-        # Точная сумма
-        if token.isdigit():
-            filters['amount_exact'] = float(token)
+    Указатель повторов и счетчики бюджета обычно готовы и дополняются записями, но после
+    чужой правки или смены месяца их пересчет читает таблицу - это делается в потоке,
+    чтобы не задерживать остальные чаты.
+    """
+    tenant = current_tenant()
+    if tenant.duplicate_index is None:
+        await asyncio.to_thread(build_duplicate_index)
+    today = get_moscow_time().date()
+    spending = tenant.budget_spending
+    if category in tenant.budgets and (spending is None or spending['month'] != (today.year, today.month)):
+        await asyncio.to_thread(build_budget_spending)
+
+def find_ledger_duplicates(records):
+    """Один проход по записям: [(первая запись, сколько раз повторена)] для одинаковых операций одного дня"""
+    counts = Counter()
+    first = {}
+    for record in records:
+        if record.day is None:
             continue
-
-        # Категории
-        if token in ['зарплат', 'зарплаты', 'зарплата']:
-            filters['categories'].append('Зарплаты сотрудникам')
-        elif token in ['поставщик', 'поставщику', 'поставщиков']:
-            filters['categories'].append('Оплата поставщику')
-        elif token in ['материал', 'материалы']:
-            filters['categories'].append('Материалы')
-        elif token in ['такси']:
-            filters['categories'].append('Такси')
-        elif token in ['транспорт']:
-            filters['categories'].append('Транспорт')
-        elif token in ['связь']:
-            filters['categories'].append('Связь')
-        elif token in ['благотворительность', 'сво']:
-            filters['categories'].append('Благотворительность')
-        elif token in ['общественн', 'хоз', 'хозяйственные']:
-            filters['categories'].append('Общественные расходы')
-        elif token in ['учредител', 'учредители', 'лично']:
-            filters['categories'].append('Выплаты учредителям')
-
-        # Периоды
-        elif token in ['неделя', 'неделю']:
-            filters['period'] = 'week'
-        elif token in ['месяц']:
-            filters['period'] = 'month'
-
-        # Обычный текстовый поиск
+        key = (record.day, *duplicate_key(record.description, record.amount))
+        counts[key] += 1
+        first.setdefault(key, record)
+    return [(first[key], count) for key, count in counts.items() if count > 1]
+
+def get_duplicates_report(limit=20):
+    """Отчет /duplicates: повторяющиеся операции за всю историю, свежие сверху"""
+    started = time.monotonic()
+    duplicates = find_ledger_duplicates(get_finance_records())
+    record_timing("duplicates.scan", time.monotonic() - started)
+    if not duplicates:
+        return "✅ Повторяющихся операций не найдено."
+    duplicates.sort(key=lambda item: item[0].day, reverse=True)
+    extra = sum(count - 1 for _, count in duplicates)
+    report = f"🔁 **Возможные повторы:** {len(duplicates)}, лишних записей: {extra}\n\n"
+    for record, count in duplicates[:limit]:
+        report += f"• {record.date} {escape_markdown(record.description)}: {record.amount:,.0f} ₽ × {count}\n"
+    if len(duplicates) > limit:
+        report += f"\n... и еще {len(duplicates) - limit}"
+    return report
+
+# Фразы, которые ссылаются на прошлые операции (см. resolve_context_phrase)
+SAME_AMOUNT_PATTERN = re.compile(r'\b(?:так(?:ая|ую) же сумм\w*|ту же сумму|столько же)\b')
+SAME_RECIPIENT_PATTERN = re.compile(r'\b(?:тому же|той же|ему же|ей же)\b')
+USUAL_AMOUNT_PATTERN = re.compile(r'\b(?:обычн\w*|как обычно|как всегда)\b')
+# Такие сообщения разбирает модель: пополнения и ссылки на другие дни
+CONTEXT_MODEL_ONLY_PATTERN = re.compile(r'пополн|получил|снял|взял|вчера|позавчера|прошл')
+# Сумма в сообщении: "5000", "5 000", "2,5 тыс", "5к"
+MESSAGE_AMOUNT_PATTERN = re.compile(r'(\d+(?:[ \xa0]\d{3})*(?:[.,]\d+)?)\s*(тыс\w*|к\b)?')
+# Строка контекста пользователя (как ее пишет update_user_context)
+CONTEXT_LINE_PATTERN = re.compile(r'^(?P<description>.+): (?P<amount>-?[\d,]+) ₽ \((?P<category>.*)\)$')
+# Слова контекстных фраз и глаголы оплаты - не имена получателей
+CONTEXT_STOP_WORDS = frozenset({
+    'такая', 'такую', 'сумма', 'сумму', 'суммой', 'столько', 'тому', 'той', 'ему', 'человеку', 'сотруднику',
+    'обычная', 'обычную', 'обычный', 'обычно', 'как', 'всегда', 'зарплата', 'зарплату', 'зарплаты',
+    'заплатил', 'заплати', 'запиши', 'дал', 'дай', 'перевел', 'перевёл', 'отправил', 'оплатил', 'еще', 'ещё', 'тыс'
+})
+
+def build_recipient_profiles():
+    """Суммы и категории расходов каждого получателя по всей таблице"""
+    started = time.monotonic()
+    tenant = current_tenant()
+    profiles = {'ledger_version': tenant.ledger['version'], 'recipients': {}, 'by_word': {}}
+    for record in get_finance_records():
+        add_recipient_profile(profiles, record.description, record.amount, record.category)
+    record_timing("recipients.profiles_build", time.monotonic() - started)
+    return profiles
+
+def add_recipient_profile(profiles, description, amount, category):
+    """Учитывает расход получателя в profiles (пополнения не учитываются)"""
+    if not description or amount is None or amount >= 0:
+        return
+    profile = profiles['recipients'].get(description)
+    if profile is None:
+        profile = profiles['recipients'][description] = {'amounts': Counter(), 'categories': Counter()}
+        for word in NAME_WORD_PATTERN.findall(description):
+            profiles['by_word'].setdefault(fold_name(word), set()).add(description)
+    profile['amounts'][-amount] += 1
+    profile['categories'][category] += 1
+
+def recipient_profiles():
+    """Профили получателей текущей организации: {'recipients': {получатель: {amounts, categories}}, 'by_word': ...}"""
+    tenant = current_tenant()
+    if tenant.recipient_profiles is None:
+        tenant.recipient_profiles = build_recipient_profiles()
+    return tenant.recipient_profiles
+
+def note_recipient_profile(row):
+    """Добавляет только что записанную строку в построенные профили получателей"""
+    profiles = current_tenant().recipient_profiles
+    if profiles is not None:
+        add_recipient_profile(profiles, row[3], parse_amount(row[4]), row[2])
+
+def refresh_recipient_profiles():
+    """Перестраивает построенные профили, если данные менялись (в том числе вручную в таблице)"""
+    tenant = current_tenant()
+    profiles = tenant.recipient_profiles
+    if profiles is not None and profiles['ledger_version'] != tenant.ledger['version']:
+        tenant.recipient_profiles = build_recipient_profiles()
+
+def user_recipient_profiles(user_context):
+    """Последние операции пользователя из контекста: (профили получателей, последняя операция)"""
+    recipients = {}
+    last = None
+    for line in (user_context or {}).get('recent_operations', []):
+        match = CONTEXT_LINE_PATTERN.match(line)
+        if match is None:
+            continue
+        amount = float(match.group('amount').replace(',', ''))
+        last = {'description': match.group('description'), 'amount': amount, 'category': match.group('category')}
+        add_recipient_profile({'recipients': recipients, 'by_word': {}}, last['description'], amount, last['category'])
+    return recipients, last
+
+def typical_value(counter):
+    """Самое частое значение (None, если значений нет или самых частых несколько)"""
+    top = counter.most_common(2)
+    if not top or (len(top) > 1 and top[0][1] == top[1][1]):
+        return None
+    return top[0][0]
+
+def parse_message_amount(text):
+    """Единственная сумма в тексте сообщения (None, если суммы нет или их несколько)"""
+    matches = MESSAGE_AMOUNT_PATTERN.findall(text)
+    if len(matches) != 1:
+        return None
+    number, multiplier = matches[0]
+    amount = float(re.sub(r'[ \xa0]', '', number).replace(',', '.'))
+    return amount * 1000 if multiplier else amount
+
+def find_named_recipient(words, user_recipients):
+    """Получатель, названный в сообщении: сначала среди операций пользователя, затем в таблице.
+
+    Каждое слово дает своих кандидатов, подходит получатель, общий для всех узнанных слов.
+    None - если никто не назван или подходят несколько.
+    """
+    forms = {}
+    for description in user_recipients:
+        for word in NAME_WORD_PATTERN.findall(description):
+            for form in name_case_forms(fold_name(word)):
+                forms.setdefault(form, set()).add(description)
+    candidates = [forms[fold_name(word)] for word in words if fold_name(word) in forms]
+    if not candidates:
+        by_word = recipient_profiles()['by_word']
+        for word in words:
+            resolved = resolve_recipient_name(word)
+            if resolved and fold_name(resolved) in by_word:
+                candidates.append(by_word[fold_name(resolved)])
+    if not candidates:
+        return None
+    found = set.intersection(*candidates)
+    return found.pop() if len(found) == 1 else None
+
+def resolve_context_phrase(text, user_context=None):
+    """Разбирает "такая же сумма", "тому же" и "обычная зарплата Петрову" без модели.
+
+    Сумма и получатель берутся из последних операций пользователя (контекста), обычная
+    сумма - самая частая у получателя сначала в контексте, затем по всей таблице.
+    Возвращает операцию в виде ответа validate_analysis или None - если контекстной
+    фразы нет или разбор неоднозначен (тогда сообщение разбирает модель).
+    """
+    lowered = text.lower()
+    same_amount = SAME_AMOUNT_PATTERN.search(lowered)
+    same_recipient = SAME_RECIPIENT_PATTERN.search(lowered)
+    usual = USUAL_AMOUNT_PATTERN.search(lowered)
+    if not (same_amount or same_recipient or usual):
+        return None
+    increment_metric("context.phrases")
+    if CONTEXT_MODEL_ONLY_PATTERN.search(lowered):
+        return None
+
+    user_recipients, last = user_recipient_profiles(user_context)
+    if same_recipient:
+        if last is None:
+            return None
+        description = last['description']
+    else:
+        words = [
+            word for word in NAME_WORD_PATTERN.findall(text)
+            if len(word) >= 3 and word.lower() not in CONTEXT_STOP_WORDS
+        ]
+        description = find_named_recipient(words, user_recipients)
+        if description is None:
+            return None
+    profile = user_recipients.get(description) or recipient_profiles()['recipients'].get(description)
+
+    message_amount = parse_message_amount(lowered)
+    if same_amount or usual:
+        if message_amount is not None:
+            return None  # сумма названа и одновременно взята из контекста
+        if same_amount:
+            amount = -last['amount'] if last else None
         else:
-            filters['text'].append(token)
-
-    return filters
-
-def matches_filters(record, filters):
-    """Проверяет соответствие записи фильтрам"""
+            amount = typical_value(profile['amounts']) if profile else None
+    else:
+        amount = message_amount
+    if not amount or amount < 0:
+        return None
+
+    # Категория: явная в сообщении, иначе обычная для получателя
+    if 'зарплат' in lowered:
+        category = 'Зарплаты сотрудникам'
+    else:
+        category = categorize_locally(text) or (typical_value(profile['categories']) if profile else None)
+    if category not in FINANCE_CATEGORIES:
+        return None
+
+    increment_metric("context.resolved_locally")
+    return {
+        "type": "finance",
+        "operation_type": "Расход",
+        "amount": -amount,
+        "category": category,
+        "description": description,
+        "comment": "",
+        "confidence": 0.9
+    }
 
-    # Текстовый поиск
-    if filters['text']:
-        text_to_search = f"{record.get('Описание/Получатель', '')} {record.get('Категория', '')}".lower()
-        for text_filter in filters['text']:
-            if text_filter not in text_to_search:
-                return False
+@lru_cache(maxsize=256)
+def scan_voice_text(text):
+    """Один проход по тексту: возвращает (команда, период, категория) или None для каждого.
 
-    # Фильтр по категориям
-    if filters['categories']:
-        if record.get('Категория', '') not in filters['categories']:
-            return False
+    Приоритеты совпадают с прежней цепочкой if: при нескольких совпадениях
+    одного вида побеждает то, что стоит выше в таблице фраз.
+    """
+    best = {}
+    for kind, priority, value in VOICE_MATCHER.iter_tags(text.lower()):
+        current = best.get(kind)
+        if current is None or priority < current[0]:
+            best[kind] = (priority, value)
+    return tuple(best[kind][1] if kind in best else None for kind in VOICE_SCAN_KINDS)
 
-    # Фильтр по сумме
-    amount = abs(record.get('Сумма', 0))
+def parse_voice_command(text):
+    """Парсит голосовые команды и возвращает соответствующую команду"""
+    command = scan_voice_text(text)[0]
+    if command:
+        return {"type": "voice_command", "command": command, "params": text}
+    return None
 
-    if filters['amount_min'] is not None:
-        if amount < filters['amount_min']:
-            return False
+def extract_params_from_voice(text, command_type, index=None):
+    """Извлекает параметры из голосового запроса.
 
-    if filters['amount_max'] is not None:
-        if amount > filters['amount_max']:
-            return False
+    index - указатель получателей: имена приводятся к записанным в таблице (без него - как есть).
+    """
+    _, period, category = scan_voice_text(text)
+    params = {}
 
-    if filters['amount_exact'] is not None:
-        if amount != filters['amount_exact']:
-            return False
+    # Извлекаем имена/компании для команд поставщиков
+    if command_type == 'suppliers':
+        # Ищем после ключевых слов "поставщика", "поставщику", "с"
+        for pattern in SUPPLIER_NAME_PATTERNS:
+            match = pattern.search(text)
+            if match:
+                name = match.group(1).strip()
+                # Приводим к виду, в котором имя записано в таблице
+                resolved = index.resolve_name(name) if index is not None else None
+                params['name'] = resolved or SUPPLIER_NAME_FORMS.get(name.lower()) or strip_case_ending(name)
+                break
 
-    # Фильтр по периоду
-    if filters['period']:
-        record_date_str = record.get('Дата', '')
-        if record_date_str:
-            try:
-                record_date = datetime.strptime(record_date_str, '%d.%m.%Y')
+    # Для других команд - общий поиск имен
+    if 'name' not in params:
+        match = CAPITALIZED_NAME_PATTERN.search(text)
+        if match:
+            resolved = index.resolve_name(match.group(0)) if index is not None else None
+            params['name'] = resolved or strip_case_ending(match.group(0))
 
-                if filters['period'] == 'week':
-                    week_ago = datetime.now() - timedelta(days=7)
-                    if record_date < week_ago:
-                        return False
+    if period:
+        params['period'] = period
+    if category:
+        params['category'] = category
 
-                elif filters['period'] == 'month':
-                    month_ago = datetime.now() - timedelta(days=30)
-                    if record_date < month_ago:
-                        return False
+    return params
 
-            except:
-                return False
+# Локальные правила категорий (как в AI_SYSTEM_PROMPT) - проверяются до обращения к модели.
+# Фраза с пробелом в начале совпадает с началом слова, с пробелом в конце - только целым словом.
+LOCAL_CATEGORY_RULES = [
+    ('Выплаты учредителям', [' лично ']),
+    ('Оплата поставщику', [' поставщик']),
+    ('Процент', [' процент']),
+    ('Такси', [' такси', ' убер', ' uber', ' яндекс такси', ' yandex go']),
+    ('Транспорт', [' транспорт', ' бензин', ' топливо', ' авто ', ' автомобил', ' герасимов']),
+    ('Связь', [' связь', ' интернет', ' телефон', ' мобильн']),
+    ('Благотворительность', [' благотвор', ' донат', ' помощь ', ' сво ']),
+    ('Общественные расходы', [' хоз ', ' хозяйствен', ' хозрасход', ' офис', ' канцеляр']),
+    ('Материалы', [' материал', ' закупка', ' товар']),
+]
+
+LOCAL_CATEGORY_MATCHER = PhraseMatcher(
+    (phrase, (priority, category))
+    for priority, (category, phrases) in enumerate(LOCAL_CATEGORY_RULES)
+    for phrase in phrases
+)
 
-    return True
+def categorize_locally(text):
+    """Определяет категорию расхода по ключевым словам без ИИ (или None)"""
+    normalized = " " + " ".join(re.findall(r'\w+', text.lower())) + " "
+    best = min(LOCAL_CATEGORY_MATCHER.iter_tags(normalized), default=None)
+    return best[1] if best else None
 
-async def category_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Анализ по категориям"""
-    if not is_allowed_user(update):
-        await update.message.reply_text('Нет доступа')
-        return
-    args = context.args
-    message = update.message if update.message else update.callback_query.message
+# Сколько описаний отправлять модели за один запрос при массовой категоризации
+AI_BATCH_SIZE = 50
 
-    try:
-        await message.reply_text("📊 Анализирую категории...")
+AI_BATCH_SYSTEM_PROMPT = f"""Ты эксперт по учету финансовых операций. Тебе передают пронумерованный список описаний расходов.
+Для каждого описания выбери одну категорию из {json.dumps(FINANCE_CATEGORIES, ensure_ascii=False)}.
+Имя человека без других признаков - "Зарплаты сотрудникам"; "Имя лично" - "Выплаты учредителям"; компании - "Оплата поставщику".
+Верни только JSON: {{"items": [{{"id": номер, "category": "категория"}}, ...]}} - по одному элементу на каждое описание."""
 
-        finance_records = finance_sheet.get_all_records()
+def categorize_batch_with_ai(descriptions):
+    """Категоризирует список описаний одним запросом к модели.
 
-        # Определяем период
-        if args and args[0] in ['месяц', 'неделя']:
-            if args[0] == 'месяц':
-                cutoff_date = datetime.now() - timedelta(days=30)
-                period_name = "месяц"
-            else:
-                cutoff_date = datetime.now() - timedelta(days=7)
-                period_name = "неделю"
+    Возвращает список категорий той же длины; None - если модель не дала корректную категорию.
+    """
+    numbered = "\n".join(f"{i}. {description}" for i, description in enumerate(descriptions, 1))
+    started = time.monotonic()
+    response = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": AI_BATCH_SYSTEM_PROMPT},
+            {"role": "user", "content": numbered}
+        ],
+        temperature=0,
+        max_tokens=30 * len(descriptions) + 50,
+        response_format={"type": "json_object"}
+    )
+    record_ai_usage('categorize_batch', started, response)
 
-            filtered_records = []
-            for record in finance_records:
-                try:
-                    record_date = datetime.strptime(record.get('Дата', ''), '%d.%m.%Y')
-                    if record_date >= cutoff_date:
-                        filtered_records.append(record)
-                except:
-                    continue
+    categories = [None] * len(descriptions)
+    result = json.loads(response.choices[0].message.content)
+    for item in result.get('items', []):
+        if not isinstance(item, dict):
+            continue
+        index = item.get('id')
+        if isinstance(index, int) and 1 <= index <= len(descriptions) and item.get('category') in FINANCE_CATEGORIES:
+            categories[index - 1] = item['category']
+    return categories
+
+def categorize_descriptions_in_bulk(descriptions, chunk_size=AI_BATCH_SIZE, concurrency=4, on_chunk_done=None):
+    """Массово категоризирует описания: сначала локальные правила, затем модель пачками.
+
+    Одинаковые описания отправляются модели один раз; одновременно выполняется не
+    больше concurrency запросов. on_chunk_done(dict) вызывается после каждой пачки
+    с ее результатами - так вызывающий код может сохранять прогресс.
+    Возвращает словарь {описание: категория или None}.
+    """
+    results = {}
+    pending = []
+    for description in dict.fromkeys(descriptions):
+        category = categorize_locally(description)
+        if category:
+            results[description] = category
         else:
-            filtered_records = finance_records
-            period_name = "все время"
-
-        # Группируем по категориям
-        categories = {}
-        total_expense = 0
-
-        for record in filtered_records:
-            amount = record.get('Сумма', 0)
-            if amount < 0:  # Только расходы
-                category = record.get('Категория', 'Прочее')
-                categories[category] = categories.get(category, 0) + abs(amount)
-                total_expense += abs(amount)
-
-        if not categories:
-            await message.reply_text("📊 Нет данных о расходах за выбранный период.")
-            return
-
-        # Сортируем по убыванию
-        sorted_categories = sorted(categories.items(), key=lambda x: x[1], reverse=True)
+            pending.append(description)
 
-        result = f"📊 **Анализ расходов за {period_name}**\n\n"
-        result += f"💰 **Общие расходы:** {total_expense:,.0f} ₽\n\n"
+    chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
 
-        for i, (category, amount) in enumerate(sorted_categories, 1):
-            percentage = (amount / total_expense) * 100
-            bar_length = int(percentage / 5)  # Шкала из 20 символов
-            bar = "█" * bar_length + "░" * (20 - bar_length)
+    def run_chunk(chunk):
+        try:
+            return dict(zip(chunk, categorize_batch_with_ai(chunk)))
+        except Exception as e:
+            increment_metric("ai.categorize_batch.errors")
+            logger.error(f"Ошибка пакетной категоризации: {e}")
+            return dict.fromkeys(chunk)
 
-            result += f"{i}. **{category}**\n"
-            result += f"   💰 {amount:,.0f} ₽ ({percentage:.1f}%)\n"
-            result += f"   {bar}\n\n"
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for chunk_result in executor.map(run_chunk, chunks):
+            results.update(chunk_result)
+            if on_chunk_done:
+                on_chunk_done(chunk_result)
 
-        # Топ-3 категории
-        if len(sorted_categories) >= 3:
-            top3_total = sum(amount for _, amount in sorted_categories[:3])
-            top3_percentage = (top3_total / total_expense) * 100
-            result += f"🔝 **Топ-3 категории:** {top3_percentage:.1f}% от всех трат"
+    return results
 
-        await message.reply_text(result, parse_mode='Markdown')
+def create_quick_buttons():
+    """Создает быстрые кнопки для частых действий"""
+    keyboard = [
+        [
+            InlineKeyboardButton("📊 Отчет", callback_data="quick_analytics"),
+            InlineKeyboardButton("🔍 Поиск", callback_data="quick_search")
+        ],
+        [
+            InlineKeyboardButton("📋 История", callback_data="quick_history"),
+            InlineKeyboardButton("💾 Бэкап", callback_data="quick_backup")
+        ],
+        [
+            InlineKeyboardButton("📂 Категории", callback_data="quick_categories"),
+            InlineKeyboardButton("👥 Получатели", callback_data="quick_recipients")
+        ],
+        [
+            InlineKeyboardButton("🏭 Поставщики", callback_data="quick_suppliers")
+        ]
+    ]
+    return InlineKeyboardMarkup(keyboard)
 
-    except Exception as e:
-        logger.error(f"Ошибка анализа категорий: {e}")
-        await message.reply_text("❌ Ошибка при анализе категорий.")
+def create_search_buttons():
+    """Создает кнопки для популярных поисковых запросов"""
+    keyboard = [
+        [
+            InlineKeyboardButton("👥 Петров", callback_data="search_петров"),
+            InlineKeyboardButton("🏭 Интигам", callback_data="search_интигам")
+        ],
+        [
+            InlineKeyboardButton("💰 Зарплаты", callback_data="search_зарплаты"),
+            InlineKeyboardButton("📊 Процент", callback_data="search_процент")
+        ],
+        [
+            InlineKeyboardButton("📅 За неделю", callback_data="search_неделя"),
+            InlineKeyboardButton("💸 >50000", callback_data="search_>50000")
+        ]
+    ]
+    return InlineKeyboardMarkup(keyboard)
 
-async def supplier_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Анализ поставщиков"""
+async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик голосовых сообщений"""
     if not is_allowed_user(update):
         await update.message.reply_text('Нет доступа')
         return
-    args = context.args
-    message = update.message if update.message else update.callback_query.message
-
-    if not args:
-        await message.reply_text("🏭 Использование: /suppliers [название]\nПример: /suppliers Интигам")
-        return
-
-    supplier_name = " ".join(args).lower()
-
+    status = None
+    recognized = False
     try:
-        await message.reply_text(f"🏭 Анализирую операции с поставщиком '{supplier_name}'...")
+        user_id = update.effective_user.id
 
-        finance_records = finance_sheet.get_all_records()
-        supplier_records = []
+        # Показываем что бот обрабатывает голосовое
+        status = StatusMessage(update.message, "🎤 Распознаю голосовое сообщение...", delay=0)
 
-        for record in finance_records:
-            if (record.get('Категория', '') == 'Оплата поставщику' and
-                supplier_name in record.get('Описание/Получатель', '').lower()):
-                supplier_records.append(record)
+        # Пока голос скачивается и распознается, загружаем данные для привычного действия
+        prefetch = start_prefetch(user_id)
 
-        if not supplier_records:
-            await message.reply_text(f"❌ Операции с поставщиком '{supplier_name}' не найдены.")
-            return
+        # Получаем файл голосового сообщения
+        voice_file = await context.bot.get_file(update.message.voice.file_id)
 
-        # Сортируем по дате
-        supplier_records = sorted(supplier_records, key=lambda x: datetime.strptime(x.get('Дата', '01.01.2000'), '%d.%m.%Y'))
+        # Скачиваем файл
+        voice_path = f"voice_{update.message.voice.file_id}.ogg"
+        await voice_file.download_to_drive(voice_path)
 
-        total_paid = sum(abs(record.get('Сумма', 0)) for record in supplier_records)
+        # Конвертируем в текст через Whisper (в потоке - чтобы не держать остальные чаты)
+        def transcribe():
+            with open(voice_path, "rb") as audio_file:
+                return client.audio.transcriptions.create(
+                    model="whisper-1",
+                    file=audio_file,
+                    language="ru"
+                )
+        transcript = await asyncio.to_thread(transcribe)
 
-        result = f"🏭 **Анализ поставщика: {supplier_name.title()}**\n\n"
-        result += f"📊 **Всего операций:** {len(supplier_records)}\n"
-        result += f"💰 **Общая сумма:** {total_paid:,.0f} ₽\n\n"
+        # Удаляем временный файл
+        os.remove(voice_path)
 
-        if len(supplier_records) > 0:
-            avg_amount = total_paid / len(supplier_records)
-            result += f"📈 **Средняя оплата:** {avg_amount:,.0f} ₽\n"
+        recognized_text = transcript.text
 
-            # Последние операции
-            result += f"\n📋 **Последние операции:**\n"
-            for record in supplier_records[-5:]:
-                date = record.get('Дата', '')
-                amount = abs(record.get('Сумма', 0))
-                result += f"• {date}: {amount:,.0f} ₽\n"
+        # Показываем что распознали
+        await status.finish(f"📝 Распознал: \"{recognized_text}\"")
+        recognized = True
 
-        await message.reply_text(result, parse_mode='Markdown')
+        # Обрабатываем с контекстом
+        user_context = get_user_context(user_id)
+        analysis = await analyze_message_streaming(recognized_text, user_context)
+        if prefetch is not None:
+            await prefetch.resolve(analysis_action(analysis))
 
-    except Exception as e:
-        logger.error(f"Ошибка анализа поставщика: {e}")
-        await message.reply_text("❌ Ошибка при анализе поставщика.")
+        await process_analysis_result(update, analysis, user_id, f"🎤 \"{recognized_text}\"", context)
 
-async def create_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Создает резервную копию данных"""
-    if not is_allowed_user(update):
-        await update.message.reply_text('Нет доступа')
-        return
-    message = update.message if update.message else update.callback_query.message
+    except Exception as e:
+        logger.error(f"Ошибка обработки голосового: {e}")
+        if status is not None and not recognized:
+            await status.finish("❌ Ошибка при обработке голосового сообщения.")
+        else:
+            # Сообщение "Распознал" остается на месте - об ошибке пишем отдельно
+            await update.message.reply_text("❌ Ошибка при обработке голосового сообщения.")
 
-    try:
-        await message.reply_text("💾 Создаю резервную копию...")
+async def handle_voice_command(update: Update, context: ContextTypes.DEFAULT_TYPE, analysis):
+    """Обрабатывает голосовые команды"""
+    command = analysis["command"]
+    params_text = analysis["params"]
+    params = extract_params_from_voice(params_text, command, recipient_index())
 
-        # Получаем все данные
-        finance_records = finance_sheet.get_all_records()
+    # Получаем message объект
+    message = get_message_from_update(update)
 
-        backup_data = {
-            'created': get_moscow_time().strftime('%d.%m.%Y %H:%M'),
-            'finance_records': len(finance_records),
-            'finance': finance_records
-        }
+    if command == "analytics":
+        period = params.get('period')
+        context.args = [period] if period in ANALYTICS_PERIODS else []
+        await show_analytics(update, context)
 
-        # Создаем файл
-        backup_filename = f"backup_{get_moscow_time().strftime('%Y%m%d_%H%M')}.json"
-        with open(backup_filename, 'w', encoding='utf-8') as f:
-            json.dump(backup_data, f, ensure_ascii=False, indent=2)
+    elif command == "search":
+        # Формируем поисковый запрос из параметров
+        search_terms = []
+        if 'name' in params:
+            search_terms.append(params['name'])
+        if 'period' in params:
+            search_terms.append(params['period'])
+        if 'category' in params:
+            search_terms.append(params['category'])
 
-        # Отправляем файл пользователю
-        with open(backup_filename, 'rb') as f:
-            await context.bot.send_document(
-                chat_id=update.effective_chat.id,
-                document=f,
-                filename=backup_filename,
-                caption=f"💾 **Резервная копия создана!**\n\n📊 Финансовых записей: {len(finance_records)}\n📅 Дата: {backup_data['created']}"
+        if search_terms:
+            # Имитируем команду search
+            context.args = search_terms
+            await advanced_search(update, context)
+        else:
+            await message.reply_text(
+                "🔍 **Голосовой поиск**\n\nПопробуйте сказать:\n• 'Найди Петрова'\n• 'Покажи операции за неделю'\n• 'Когда платили Интигаму'",
+                reply_markup=create_search_buttons()
             )
 
-        # Удаляем временный файл
-        os.remove(backup_filename)
+    elif command == "categories":
+        period = params.get('period', None)
+        if period:
+            context.args = [period]
+        else:
+            context.args = []
+        await category_analysis(update, context)
 
-    except Exception as e:
-        logger.error(f"Ошибка создания backup: {e}")
-        await message.reply_text("❌ Ошибка при создании резервной копии.")
+    elif command == "suppliers":
+        if 'name' in params:
+            context.args = [params['name']]
+            await supplier_analysis(update, context)
+        else:
+            await message.reply_text("🏭 Назовите поставщика для анализа.\nНапример: 'Анализ поставщика Интигам'")
 
-async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик ошибок"""
-    logger.error(f"Ошибка: {context.error}")
+    elif command == "recipients":
+        period = params.get('period', None)
+        if period:
+            context.args = [period]
+        else:
+            context.args = []
+        await description_analysis(update, context)
 
-def main():
-    """Запуск продвинутого ИИ-бота"""
-    print("🚀 Запускаю продвинутый ИИ финансовый бот...")
+    elif command == "history":
+        await show_context_history(update, context)
 
-    # Создаем приложение
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    elif command == "backup":
+        await create_backup(update, context)
 
-    # Добавляем обработчики
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("search", advanced_search))
-    application.add_handler(CommandHandler("categories", category_analysis))
-    application.add_handler(CommandHandler("recipients", description_analysis))
-    application.add_handler(CommandHandler("suppliers", supplier_analysis))
-    application.add_handler(CommandHandler("history", show_context_history))
-    application.add_handler(CommandHandler("analytics", show_analytics))
-    application.add_handler(CommandHandler("backup", create_backup))
-    application.add_handler(CallbackQueryHandler(handle_callback_query))
-    application.add_handler(MessageHandler(filters.VOICE, handle_voice))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    application.add_error_handler(error_handler)
+async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обрабатывает нажатия на кнопки"""
+    if not is_allowed_user(update):
+        await update.callback_query.answer()
+        await update.callback_query.edit_message_text('Нет доступа')
+        return
+    query = update.callback_query
+    await query.answer()
 
-    # Запускаем бота
-    print("🧠 Продвинутый ИИ-бот готов к работе!")
-    print("🎤 Поддержка голосовых сообщений включена!")
-    print("🧠 Контекстное понимание активировано!")
-    print("📊 Умная аналитика доступна!")
-    print("🔍 Продвинутый поиск включен!")
-    
-    # Запускаем приложение
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    data = query.data
 
-if __name__ == '__main__':
-    main()import logging
-import json
-import os
-import re
-from datetime import datetime, timedelta
-import pytz
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
-import gspread
-from google.oauth2.service_account import Credentials
-from openai import OpenAI
-from config import TELEGRAM_TOKEN, GOOGLE_SHEET_ID, SHEET_NAME, OPENAI_API_KEY
+    # Быстрые команды
+    if data == "quick_analytics":
+        await show_analytics(update, context)
 
-# Московское время
-MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+    elif data == "quick_search":
+        await query.edit_message_text(
+            "🔍 **Быстрый поиск**\n\nВыберите категорию или скажите что ищете:",
+            reply_markup=create_search_buttons()
+        )
 
-def get_moscow_time():
-    """Возвращает текущее московское время"""
-    return datetime.now(MOSCOW_TZ)
+    elif data == "quick_history":
+        await show_context_history(update, context)
 
-def format_moscow_date():
-    """Возвращает дату в московском времени в формате ДД.ММ.ГГГГ"""
-    return get_moscow_time().strftime('%d.%m.%Y')
+    elif data == "quick_backup":
+        await create_backup(update, context)
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
+    elif data == "quick_categories":
+        context.args = []
+        await category_analysis(update, context)
 
-# Настройка OpenAI
-client = OpenAI(api_key=OPENAI_API_KEY)
+    elif data == "quick_recipients":
+        context.args = []
+        await description_analysis(update, context)
 
-# Настройка Google Sheets
-SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+    elif data == "quick_suppliers":
+        await query.edit_message_text(
+            "🏭 **Анализ поставщиков**\n\nСкажите: 'Анализ поставщика [название]'\nНапример: 'Анализ поставщика Интигам'"
+        )
 
-# Читаем credentials из переменной окружения
-creds_json = os.getenv('GOOGLE_CREDENTIALS')
-if creds_json:
-    creds_info = json.loads(creds_json)
-    creds = Credentials.from_service_account_info(creds_info, scopes=SCOPES)
-else:
-    # Fallback на файл для локальной разработки
-    creds = Credentials.from_service_account_file('credentials.json', scopes=SCOPES)
+    # Импорт выписки
+    elif data.startswith("import_confirm_") or data.startswith("import_cancel_"):
+        await confirm_import(update, context, data.rsplit("_", 1)[1], data.startswith("import_confirm_"))
 
-gc = gspread.authorize(creds)
+    # Запись операции, похожей на повтор
+    elif data.startswith("duplicate_confirm_") or data.startswith("duplicate_cancel_"):
+        await confirm_duplicate(update, context, data.rsplit("_", 1)[1], data.startswith("duplicate_confirm_"))
 
-# Открываем таблицы
-finance_sheet = gc.open_by_key(GOOGLE_SHEET_ID).worksheet(SHEET_NAME)
+    # Поисковые запросы
+    elif data.startswith("search_"):
+        search_term = data.replace("search_", "")
+        context.args = [search_term]
+        await advanced_search(update, context)
 
-# Хранилище последних операций и контекста
-USER_LAST_OPERATIONS = {}
-USER_CONTEXT = {}
+def format_recorded_operation(analysis, source_info=""):
+    """Подтверждение записанной операции (с предупреждением о бюджете категории)"""
+    emoji = "📈" if analysis["operation_type"] == "Пополнение" else "📉"
+    response = f"""
+{emoji} **Финансовая операция записана:**
 
-# Добавляем функцию проверки username
-ALLOWED_USERNAME = 'antigorevich'
+{source_info}
+📅 Дата: {format_moscow_date()}
+🔄 Тип: {analysis['operation_type']}
+📂 Категория: {analysis['category']}
+📝 Описание: {analysis['description']}
+💰 Сумма: {analysis['amount']:,.0f} ₽
 
-def is_allowed_user(update: Update):
-    user = update.effective_user
-    return user and user.username and user.username.lower() == ALLOWED_USERNAME
+✅ **Записано в Google Таблицу!**
+    """
+    alert = budget_alert(analysis['category'], analysis['amount'])
+    if alert:
+        response += f"\n{alert}\n"
+    return response
+
+async def confirm_duplicate(update: Update, context: ContextTypes.DEFAULT_TYPE, record_id, confirmed):
+    """Записывает (или отбрасывает) операцию, похожую на повтор, после нажатия кнопки"""
+    query = update.callback_query
+    pending_records = current_tenant().pending_records
+    pending = pending_records.get(update.effective_user.id)
+    if not pending or pending['id'] != record_id or time.monotonic() - pending['created'] > DUPLICATE_CONFIRM_MINUTES * 60:
+        await query.edit_message_text("⌛ Вопрос устарел - отправьте операцию заново.")
+        return
+    del pending_records[update.effective_user.id]
+
+    if not confirmed:
+        increment_metric("duplicates.skipped")
+        await query.edit_message_text("❌ Повтор не записан.")
+        return
+
+    analysis = pending['analysis']
+    await prepare_write_checks(analysis['category'])
+    if add_finance_record(analysis, update.effective_user.id):
+        await query.edit_message_text(
+            format_recorded_operation(analysis, pending['source_info']),
+            parse_mode='Markdown',
+            reply_markup=create_quick_buttons()
+        )
+    else:
+        await query.edit_message_text("❌ Ошибка при записи в таблицу финансов.")
+
+async def process_analysis_result(update, analysis, user_id, source_info="", context=None, status=None):
+    """Обрабатывает результат анализа ИИ; status - заглушка, которую заменит ответ"""
+    if not is_allowed_user(update):
+        await update.message.reply_text('Нет доступа')
+        return
+    reply = status.finish if status else update.message.reply_text
+    note_user_action(user_id, analysis_action(analysis))
+
+    # Обрабатываем голосовые команды
+    if analysis["type"] == "voice_command":
+        if status:
+            await status.delete()
+        await handle_voice_command(update, context, analysis)
+        return
+
+    if analysis["type"] == "finance":
+        confidence = analysis.get('confidence', 1.0)
+
+        # Если уверенность низкая - запрашиваем подтверждение
+        if confidence < 0.7:
+            confirm_text = f"""
+❓ **Проверьте правильность:**
+
+{source_info}
+🔄 Тип: {analysis['operation_type']}
+📂 Категория: {analysis['category']}
+📝 Описание: {analysis['description']}
+💰 Сумма: {analysis['amount']:,.0f} ₽
+
+✅ Записать? Или уточните что не так.
+            """
+            await reply(confirm_text, parse_mode='Markdown')
+            return
+
+        # Такая же операция уже записана - вероятно, повтор голосового или сообщения
+        await prepare_write_checks(analysis['category'])
+        if find_duplicate(analysis['description'], analysis['amount']):
+            record_id = uuid.uuid4().hex[:8]
+            current_tenant().pending_records[user_id] = {
+                'id': record_id, 'analysis': analysis, 'source_info': source_info, 'created': time.monotonic()
+            }
+            keyboard = [[
+                InlineKeyboardButton("✅ Записать всё равно", callback_data=f"duplicate_confirm_{record_id}"),
+                InlineKeyboardButton("❌ Не записывать", callback_data=f"duplicate_cancel_{record_id}")
+            ]]
+            await reply(
+                f"🔁 **Похоже на повтор:** сегодня уже записано «{escape_markdown(analysis['description'])}» на {analysis['amount']:,.0f} ₽.\n\n"
+                "Записать всё равно?",
+                parse_mode='Markdown',
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+            return
+
+        # Записываем операцию
+        if add_finance_record(analysis, user_id):
+            # Добавляем быстрые кнопки после записи операции
+            await reply(
+                format_recorded_operation(analysis, source_info),
+                parse_mode='Markdown',
+                reply_markup=create_quick_buttons()
+            )
+        else:
+            await reply("❌ Ошибка при записи в таблицу финансов.")
+
+    else:  # clarification
+        suggestions = analysis.get('suggestions', [])
+        response = f"❓ {analysis.get('message', 'Не понял ваше сообщение.')}"
+
+        if suggestions:
+            response += "\n\n💡 **Возможно, вы имели в виду:**\n"
+            for i, suggestion in enumerate(suggestions[:3], 1):
+                response += f"{i}. {suggestion}\n"
+
+        await reply(response, parse_mode='Markdown')
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /start"""
+    welcome_text = """
+💰 **Умный финансовый помощник с ИИ!**
+
+🎤 **Новинка: Голосовое управление!**
+
+💸 **Записывайте операции:**
+• "Дал Петрову 40000 за работу"
+• "Таня лично 30000"
+• "Оплатил поставщику Интигаму 300000"
+
+🗣️ **Управляйте голосом:**
+• 🎤 "Покажи траты за неделю"
+• 🎤 "Найди все операции с Петровым"
+• 🎤 "Анализ по категориям за месяц"
+• 🎤 "Когда платили Интигаму"
+
+🏭 **11 категорий:**
+• Зарплаты, Учредители, Поставщики
+• Процент, Закупка товара, Материалы
+• Транспорт, Связь, Такси, Общественные, СВО
+
+**Говорите естественно - бот всё поймет!**
+    """
+
+    await update.message.reply_text(
+        welcome_text,
+        parse_mode='Markdown',
+        reply_markup=create_quick_buttons()
+    )
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик текстовых сообщений с контекстом"""
+    if not is_allowed_user(update):
+        await update.message.reply_text('Нет доступа')
+        return
+    user_id = update.effective_user.id
+    user_message = update.message.text
+
+    # Показываем что бот думает
+    status = StatusMessage(update.message, "🤔 Анализирую с учетом контекста...", delay=0)
+
+    # Пока модель разбирает текст, данные для вероятного действия уже читаются
+    prefetch = start_prefetch(user_id, user_message)
+
+    # Анализируем с контекстом
+    user_context = get_user_context(user_id)
+    analysis = await analyze_message_streaming(user_message, user_context, status)
+    if prefetch is not None:
+        await prefetch.resolve(analysis_action(analysis))
+
+    await process_analysis_result(update, analysis, user_id, context=context, status=status)
+
+async def show_context_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает историю с контекстом"""
+    if not is_allowed_user(update):
+        await update.message.reply_text('Нет доступа')
+        return
+    user_id = update.effective_user.id
+    message = get_message_from_update(update)
+
+    status = None
+    try:
+        status = StatusMessage(message, "📊 Получаю историю с контекстом...")
+
+        # История из контекста
+        user_context = get_user_context(user_id) or {}
+        recent_ops = user_context.get('recent_operations', [])
+
+        if recent_ops:
+            history = "🧠 **Контекст последних операций:**\n\n"
+            for i, op in enumerate(reversed(recent_ops[-5:]), 1):
+                history += f"{i}. {op}\n"
+        else:
+            history = "📊 **Контекст пуст** - начните добавлять операции!\n\n"
+
+        # Последние из таблицы
+        recent_finance = get_recent_finance_records(3, HISTORY_COLUMNS)
+
+        if recent_finance:
+            history += "\n💰 **Последние финансовые операции:**\n"
+            for record in reversed(recent_finance):
+                emoji = "📈" if record.amount > 0 else "📉"
+                history += f"{emoji} {record.description}: {record.amount:,.0f} ₽\n"
+
+        await status.finish(history, parse_mode='Markdown')
+
+    except Exception as e:
+        logger.error(f"Ошибка истории: {e}")
+        if status is not None:
+            await status.finish("❌ Ошибка при получении истории.")
+        else:
+            await message.reply_text("❌ Ошибка при получении истории.")
+
+# Периоды /analytics: аргумент -> (дней, подпись в заголовке)
+ANALYTICS_PERIODS = {
+    'день': (1, 'сегодня'),
+    'неделя': (7, '7 дней'),
+    'месяц': (30, '30 дней'),
+}
+ANALYTICS_DEFAULT_PERIOD = 'месяц'
+
+# Готовые отчеты /analytics хранятся в TenantState.reports: период -> (версия данных, дата, текст)
+
+def build_analytics_report(finance_records, start_date, end_date, title):
+    """Строит текст аналитики за период [start_date, end_date] (или None, если данных нет)"""
+    recent_records = [
+        record for record in finance_records
+        if record.day is not None and start_date <= record.day <= end_date
+    ]
+
+    if not recent_records:
+        return None
+
+    # Анализируем
+    total_income = sum(record.amount for record in recent_records if record.amount > 0)
+    total_expense = sum(record.amount for record in recent_records if record.amount < 0)
+
+    # По категориям
+    categories = {}
+    for record in recent_records:
+        if record.amount < 0:
+            cat = record.category or 'Прочее'
+            categories[cat] = categories.get(cat, 0) + record.amount
+
+    # Самые частые получатели зарплат
+    salaries = {}
+    for record in recent_records:
+        if record.category == 'Зарплаты сотрудникам':
+            person = record.description or 'Неизвестно'
+            salaries[person] = salaries.get(person, 0) + abs(record.amount)
+
+    report = f"""
+📊 **{title}**
+
+💰 **Общие итоги:**
+📈 Доходы: +{total_income:,.0f} ₽
+📉 Расходы: {total_expense:,.0f} ₽
+💼 Чистый результат: {total_income + total_expense:,.0f} ₽
+📊 Операций: {len(recent_records)}
+
+💸 **Расходы по категориям:**
+"""
+
+    for cat, amount in sorted(categories.items(), key=lambda x: x[1]):
+        percent = abs(amount) / abs(total_expense) * 100 if total_expense != 0 else 0
+        report += f"• {cat}: {amount:,.0f} ₽ ({percent:.1f}%)\n"
+
+    if salaries:
+        report += f"\n👥 **Зарплаты сотрудникам:**\n"
+        for person, amount in sorted(salaries.items(), key=lambda x: x[1], reverse=True):
+            report += f"• {person}: {amount:,.0f} ₽\n"
+
+    # Средние траты
+    days = (end_date - start_date).days + 1
+    avg_daily = abs(total_expense) / days
+    report += f"\n📈 **Средние траты в день:** {avg_daily:,.0f} ₽"
+
+    # Найти самую затратную категорию
+    if categories:
+        top_category = min(categories.items(), key=lambda x: x[1])
+        report += f"\n🔝 **Больше всего тратите на:** {top_category[0]}"
+
+    return report
+
+def render_analytics_period(finance_records, period, today=None):
+    """Строит отчет /analytics за один из периодов ANALYTICS_PERIODS"""
+    today = today or datetime.now().date()
+    return build_analytics_report(
+        finance_records,
+        analytics_period_start(period, today),
+        today,
+        f"Умная аналитика за {ANALYTICS_PERIODS[period][1]}"
+    )
+
+def analytics_period_start(period, today):
+    """Первый день периода /analytics"""
+    return today - timedelta(days=ANALYTICS_PERIODS[period][0] - 1)
+
+def prerender_analytics_reports():
+    """Заранее строит отчеты /analytics по всем периодам для текущей версии данных"""
+    today = datetime.now().date()
+    longest = max(ANALYTICS_PERIODS, key=lambda period: ANALYTICS_PERIODS[period][0])
+    finance_records = get_finance_records(start=analytics_period_start(longest, today))
+    version = ledger_snapshot()['version']
+    reports = current_tenant().reports
+    for period in ANALYTICS_PERIODS:
+        reports[period] = (version, today, render_analytics_period(finance_records, period, today))
+
+def get_analytics_report(period):
+    """Возвращает отчет /analytics: готовый, если данные не менялись, иначе строит заново"""
+    today = datetime.now().date()
+    # Готовый отчет проверяется до чтения записей: попадание отвечает без обращения к данным
+    prerendered = current_tenant().reports.get(period)
+    if prerendered and prerendered[0] == ledger_snapshot()['version'] and prerendered[1] == today:
+        increment_metric("analytics.prerendered_hits")
+        return prerendered[2]
+    increment_metric("analytics.prerendered_misses")
+    finance_records = get_finance_records(start=analytics_period_start(period, today))
+    return render_analytics_period(finance_records, period, today)
+
+def build_analytics_answer(period, job, brief=False):
+    """Отчет /analytics и данные графика по дням: (текст или None без данных, (подписи, суммы) или None).
+
+    brief - упрощенный ответ, когда полный не успел к сроку: без графика, а если есть
+    подготовленный сегодня отчет по прежней версии данных - он, без пересчета.
+    """
+    if brief:
+        prerendered = current_tenant().reports.get(period)
+        if prerendered and prerendered[1] == datetime.now().date() and prerendered[2]:
+            return prerendered[2] + "\n\n⏳ Отчет не успел пересчитаться - показан по данным до последних изменений.", None
+        report = get_analytics_report(period)
+        return (report + "\n\n⏳ Полный отчет не успел посчитаться - показан без графика." if report else None), None
+
+    report = get_analytics_report(period)
+    job.check()
+    # График трат по дням (за один день рисовать нечего)
+    if report is None or ANALYTICS_PERIODS[period][0] <= 1:
+        return report, None
+    today = datetime.now().date()
+    start = analytics_period_start(period, today)
+    return report, daily_expenses(get_finance_records(start=start), start, today)
+
+async def show_analytics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Умная аналитика трат"""
+    if not is_allowed_user(update):
+        await update.message.reply_text('Нет доступа')
+        return
+    message = get_message_from_update(update)
+    status = None
+    try:
+        args = context.args if context and context.args else []
+        period = args[0] if args and args[0] in ANALYTICS_PERIODS else ANALYTICS_DEFAULT_PERIOD
+
+        status = StatusMessage(message, "📊 Анализирую ваши финансы...")
+
+        key = rendered_key('analytics', period)
+        rendered = get_rendered(key)
+        if rendered is not None:
+            await send_rendered(update, context, status, rendered, cached=True)
+            return
+
+        brief = False
 
-def analyze_message_with_ai(text, user_context=None):
-    """Анализирует сообщение с помощью ИИ с учетом контекста"""
+        def build_brief(job):
+            nonlocal brief
+            brief = True
+            return build_analytics_answer(period, job, brief=True)
+
+        # Считается в пуле потоков; не успел к сроку - отчет без графика, новый запрос отменяет старый
+        try:
+            report, daily = await run_report(
+                update, 'analytics',
+                lambda job: build_analytics_answer(period, job),
+                fallback=build_brief,
+                status=status
+            )
+        except ReportCancelled:
+            await status.delete()
+            return
+
+        if report is None:
+            reply = "📊 Недостаточно данных для аналитики."
+            await send_rendered(update, context, status, {'text': reply, 'kwargs': {}, 'chart': None} if brief else store_rendered(key, reply))
+            return
+
+        chart = None
+        if daily is not None:
+            chart = await try_render_chart('analytics', period, 'line', f"Расходы по дням за {ANALYTICS_PERIODS[period][1]}", *daily)
+
+        rendered = {'text': report, 'kwargs': {'parse_mode': 'Markdown'}, 'chart': chart}
+        # Упрощенный ответ не запоминается: следующий запрос снова попробует посчитать полный
+        if not brief:
+            rendered = store_rendered(key, report, chart, parse_mode='Markdown')
+        await send_rendered(update, context, status, rendered)
+
+    except asyncio.TimeoutError:
+        if status is not None:
+            await status.finish("⏳ Отчет считается слишком долго, попробуйте позже.")
+        else:
+            await message.reply_text("⏳ Отчет считается слишком долго, попробуйте позже.")
+    except Exception as e:
+        logger.error(f"Ошибка аналитики: {e}")
+        if status is not None:
+            await status.finish("❌ Ошибка при создании аналитики.")
+        else:
+            await message.reply_text("❌ Ошибка при создании аналитики.")
+
+# /trends: месяцев в динамике и окно скользящего среднего (в месяцах)
+TRENDS_MONTHS = 6
+TRENDS_ROLLING_MONTHS = 3
+# Необычные платежи: отличаются от остальных платежей получателю на TRENDS_OUTLIER_Z сигм и больше
+TRENDS_OUTLIER_Z = 3.0
+TRENDS_OUTLIER_MIN_PAYMENTS = 5
+TRENDS_OUTLIER_DAYS = 90
+# Разброс остальных платежей считается не меньше этой доли их средней (иначе любой отличный платеж - выброс)
+TRENDS_OUTLIER_MIN_SPREAD = 0.1
+# Регулярные платежи: не меньше 3 платежей, средний интервал 5-35 дней, разброс интервалов до 25%
+TRENDS_RECURRING_MIN_PAYMENTS = 3
+TRENDS_RECURRING_INTERVAL = (5, 35)
+TRENDS_RECURRING_SPREAD = 0.25
+
+def compute_trends(finance_records, today=None):
+    """Тренды расходов за всю историю векторными операциями numpy (или None, если расходов нет).
+
+    Возвращает словарь:
+    months - [(месяц как год*12+номер-1, расходы, скользящее среднее или None)] за последние полные месяцы;
+    categories - [(категория, расходы за прошлый месяц, за позапрошлый, изменение в % или None)];
+    outliers - [(дата, получатель, сумма, средняя остальных платежей, z)];
+    recurring - [(получатель, интервал в днях, средняя сумма, ожидаемая дата следующего платежа)].
+    """
+    import numpy as np
+
+    today = today or datetime.now().date()
+    current_month = today.year * 12 + today.month - 1
+    expenses = [
+        record for record in finance_records
+        if record.amount < 0 and record.day is not None and record.day <= today
+    ]
+    if not expenses:
+        return None
+
+    category_codes, recipient_codes = {}, {}
+    days = np.fromiter((record.day.toordinal() for record in expenses), dtype=np.int64, count=len(expenses))
+    months = np.fromiter((record.day.year * 12 + record.day.month - 1 for record in expenses), dtype=np.int64, count=len(expenses))
+    amounts = -np.fromiter((record.amount for record in expenses), dtype=np.float64, count=len(expenses))
+    categories = np.fromiter(
+        (category_codes.setdefault(record.category or 'Прочее', len(category_codes)) for record in expenses),
+        dtype=np.int64, count=len(expenses)
+    )
+    recipients = np.fromiter(
+        (recipient_codes.setdefault(record.description.strip() or 'Без описания', len(recipient_codes)) for record in expenses),
+        dtype=np.int64, count=len(expenses)
+    )
+    category_names = list(category_codes)
+    recipient_names = list(recipient_codes)
+
+    # Матрица категория x месяц: расходы суммируются одним bincount
+    first_month = int(months.min())
+    month_count = current_month - first_month + 1
+    by_category = np.bincount(
+        categories * month_count + (months - first_month),
+        weights=amounts,
+        minlength=len(category_names) * month_count
+    ).reshape(len(category_names), month_count)
+
+    # Текущий месяц еще не закончился - в динамике и сравнении только полные месяцы
+    totals = by_category[:, :-1].sum(axis=0)
+    window = TRENDS_ROLLING_MONTHS
+    rolling = np.full(len(totals), np.nan)
+    if len(totals) >= window:
+        rolling[window - 1:] = np.convolve(totals, np.ones(window) / window, mode='valid')
+    shown = range(max(0, len(totals) - TRENDS_MONTHS), len(totals))
+    month_rows = [
+        (first_month + i, float(totals[i]), None if np.isnan(rolling[i]) else float(rolling[i]))
+        for i in shown
+    ]
+
+    category_rows = []
+    if month_count >= 3:
+        last, previous = by_category[:, -2], by_category[:, -3]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change = np.where(previous > 0, (last - previous) / previous * 100, np.nan)
+        for i in np.argsort(-last):
+            if last[i] or previous[i]:
+                category_rows.append((
+                    category_names[i], float(last[i]), float(previous[i]),
+                    None if np.isnan(change[i]) else float(change[i])
+                ))
+
+    # Выбросы: каждый платеж сравнивается со средней и разбросом остальных платежей того же получателя
+    counts = np.bincount(recipients, minlength=len(recipient_names))
+    sums = np.bincount(recipients, weights=amounts, minlength=len(recipient_names))
+    squares = np.bincount(recipients, weights=amounts ** 2, minlength=len(recipient_names))
+    n = counts[recipients]
+    eligible = (n >= TRENDS_OUTLIER_MIN_PAYMENTS) & (days >= today.toordinal() - TRENDS_OUTLIER_DAYS + 1)
+    others = np.maximum(n - 1, 1)
+    others_mean = (sums[recipients] - amounts) / others
+    others_var = (squares[recipients] - amounts ** 2) / others - others_mean ** 2
+    others_std = np.maximum(np.sqrt(np.maximum(others_var, 0)), others_mean * TRENDS_OUTLIER_MIN_SPREAD)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where(eligible & (others_std > 0), (amounts - others_mean) / others_std, 0)
+    flagged = np.flatnonzero(np.abs(z) >= TRENDS_OUTLIER_Z)
+    flagged = flagged[np.argsort(-days[flagged], kind='stable')]
+    outlier_rows = [
+        (expenses[i].date, recipient_names[recipients[i]], float(amounts[i]), float(others_mean[i]), float(z[i]))
+        for i in flagged
+    ]
+
+    # Регулярные платежи: интервалы между соседними по дате платежами одного получателя
+    order = np.lexsort((days, recipients))
+    sorted_recipients, sorted_days = recipients[order], days[order]
+    gaps = np.diff(sorted_days)
+    same = (sorted_recipients[1:] == sorted_recipients[:-1]) & (gaps > 0)
+    gap_recipients, gaps = sorted_recipients[1:][same], gaps[same].astype(np.float64)
+    gap_counts = np.bincount(gap_recipients, minlength=len(recipient_names))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gap_mean = np.bincount(gap_recipients, weights=gaps, minlength=len(recipient_names)) / gap_counts
+        gap_var = np.bincount(gap_recipients, weights=gaps ** 2, minlength=len(recipient_names)) / gap_counts - gap_mean ** 2
+        gap_spread = np.sqrt(np.maximum(gap_var, 0)) / gap_mean
+    last_day = np.zeros(len(recipient_names), dtype=np.int64)
+    np.maximum.at(last_day, recipients, days)
+    next_day = last_day + np.rint(np.nan_to_num(gap_mean)).astype(np.int64)
+    low, high = TRENDS_RECURRING_INTERVAL
+    regular = (
+        (gap_counts >= TRENDS_RECURRING_MIN_PAYMENTS - 1)
+        & (gap_mean >= low) & (gap_mean <= high)
+        & (gap_spread <= TRENDS_RECURRING_SPREAD)
+        # Платеж, пропущенный больше чем на интервал, считается прекратившимся
+        & (next_day + np.nan_to_num(gap_mean) >= today.toordinal())
+    )
+    recurring_rows = [
+        (recipient_names[i], float(gap_mean[i]), float(sums[i] / counts[i]), datetime.fromordinal(int(next_day[i])).date())
+        for i in np.flatnonzero(regular)[np.argsort(next_day[regular], kind='stable')]
+    ]
+
+    return {
+        'months': month_rows,
+        'categories': category_rows,
+        'outliers': outlier_rows,
+        'recurring': recurring_rows,
+    }
+
+def format_trend_month(month):
+    """Месяц (год*12+номер-1) в виде ММ.ГГГГ"""
+    return f"{month % 12 + 1:02d}.{month // 12}"
+
+def render_trends_report(trends, limit=10):
+    """Текст отчета /trends по результату compute_trends()"""
+    report = "📈 **Тренды расходов за всю историю**\n"
+
+    if trends['months']:
+        report += f"\n📅 **Расходы по месяцам** (среднее за {TRENDS_ROLLING_MONTHS} мес.):\n"
+        for month, total, rolling in trends['months']:
+            average = f" (среднее {rolling:,.0f} ₽)" if rolling is not None else ""
+            report += f"• {format_trend_month(month)}: {total:,.0f} ₽{average}\n"
+
+    if trends['categories']:
+        report += "\n🔄 **Прошлый месяц к позапрошлому:**\n"
+        for category, last, previous, change in trends['categories'][:limit]:
+            change_text = f"{change:+.0f}%" if change is not None else "новое"
+            report += f"• {escape_markdown(category)}: {last:,.0f} ₽ ({change_text})\n"
+
+    if trends['outliers']:
+        report += f"\n⚠️ **Необычные платежи за {TRENDS_OUTLIER_DAYS} дней:**\n"
+        for date, recipient, amount, usual, z in trends['outliers'][:limit]:
+            report += f"• {date} {escape_markdown(recipient)}: {amount:,.0f} ₽, обычно {usual:,.0f} ₽ (z={z:.1f})\n"
+
+    if trends['recurring']:
+        report += "\n🔁 **Регулярные платежи:**\n"
+        for recipient, interval, amount, next_date in trends['recurring'][:limit]:
+            report += (f"• {escape_markdown(recipient)}: ~{amount:,.0f} ₽ каждые {interval:.0f} дн., "
+                       f"следующий ≈ {next_date.strftime('%d.%m.%Y')}\n")
+
+    return report
+
+def get_trends_report():
+    """Отчет /trends: готовый, если данные не менялись, иначе строит заново (или None без расходов)"""
+    today = datetime.now().date()
+    reports = current_tenant().reports
+    # Готовый отчет проверяется до чтения записей: попадание отвечает без чтения всей истории
+    cached = reports.get('trends')
+    if cached and cached[0] == ledger_snapshot()['version'] and cached[1] == today:
+        increment_metric("trends.cache_hits")
+        return cached[2]
+    finance_records = get_finance_records()
+    started = time.monotonic()
+    trends = compute_trends(finance_records, today)
+    report = render_trends_report(trends) if trends else None
+    record_timing("trends.compute", time.monotonic() - started)
+    reports['trends'] = (ledger_snapshot()['version'], today, report)
+    return report
+
+async def show_duplicates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Повторяющиеся операции (тот же получатель, сумма и день) за всю историю"""
+    if not is_allowed_user(update):
+        await update.message.reply_text('Нет доступа')
+        return
+    message = get_message_from_update(update)
+
+    status = None
+    try:
+        status = StatusMessage(message, "🔁 Ищу повторы по всей истории...")
+        report = await asyncio.to_thread(get_duplicates_report)
+        await status.finish(report, parse_mode='Markdown')
+    except Exception as e:
+        logger.error(f"Ошибка поиска повторов: {e}")
+        if status is not None:
+            await status.finish("❌ Ошибка при поиске повторов.")
+        else:
+            await message.reply_text("❌ Ошибка при поиске повторов.")
+
+async def show_trends(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Тренды, необычные и регулярные платежи за всю историю"""
+    if not is_allowed_user(update):
+        await update.message.reply_text('Нет доступа')
+        return
+    message = get_message_from_update(update)
+
+    status = None
+    try:
+        status = StatusMessage(message, "📈 Считаю тренды по всей истории...")
+        report = await asyncio.to_thread(get_trends_report)
+        if report is None:
+            await status.finish("📈 Недостаточно данных для трендов.")
+            return
+        await status.finish(report, parse_mode='Markdown')
+
+    except ImportError as e:
+        if status is not None:
+            await status.finish(f"❌ Тренды недоступны: не установлен модуль {e.name}.")
+        else:
+            await message.reply_text(f"❌ Тренды недоступны: не установлен модуль {e.name}.")
+    except Exception as e:
+        logger.error(f"Ошибка трендов: {e}")
+        if status is not None:
+            await status.finish("❌ Ошибка при расчете трендов.")
+        else:
+            await message.reply_text("❌ Ошибка при расчете трендов.")
+
+# Расчет отчетов вне цикла событий: пул потоков, срок на отчет и отмена устаревших запросов
+REPORT_POOL = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix='report')
+# Как часто (в записях) расчет проверяет, не отменен ли он
+REPORT_CHECK_EVERY = 5000
+# Сколько ждать упрощенный отчет после того, как полный не успел
+REPORT_FALLBACK_SECONDS = 5
+# Упрощенные /categories, /search и /suppliers читают только последние BRIEF_REPORT_DAYS дней
+BRIEF_REPORT_DAYS = 30
+# Идущие расчеты: (организация, пользователь, отчет) -> ReportJob
+RUNNING_REPORTS = {}
+
+class ReportCancelled(Exception):
+    """Расчет отчета отменен: истек срок или пользователь запросил отчет заново"""
+
+class ReportJob:
+    """Флаг отмены и прогресс расчета; функция отчета вызывает check() в длинных циклах"""
+
+    def __init__(self):
+        self._cancelled = threading.Event()
+        self.progress = None  # доля выполненного (0..1), если отчет ее сообщает
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self, done=None, total=None):
+        """Прерывает расчет исключением ReportCancelled, если он отменен; done/total - прогресс"""
+        if self._cancelled.is_set():
+            raise ReportCancelled()
+        if done is not None and total:
+            self.progress = done / total
+
+async def wait_report(future, job, timeout, status):
+    """Ждет расчет не дольше timeout секунд, показывая прогресс в заглушке status"""
+    loop = asyncio.get_running_loop()
+    deadline_at = loop.time() + timeout
+    while True:
+        remaining = deadline_at - loop.time()
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        done, _ = await asyncio.wait({future}, timeout=min(remaining, STATUS_EDIT_INTERVAL))
+        if done:
+            return future.result()
+        if status is not None and job.progress is not None:
+            await status.progress(f"{status.text} {job.progress:.0%}")
+
+async def run_report(update, name, build, fallback=None, deadline=None, status=None):
+    """Считает отчет build(job) в пуле потоков не дольше deadline секунд (REPORT_DEADLINE_SECONDS).
+
+    Новый запрос того же отчета тем же пользователем отменяет предыдущий: тот получает
+    ReportCancelled и ничего не отвечает. Если build не успел, он отменяется и вместо него
+    считается fallback(job) - упрощенный ответ; без fallback (или если и он не успел)
+    бросается asyncio.TimeoutError. Прогресс долгого расчета показывается в заглушке status.
+    """
+    deadline = REPORT_DEADLINE_SECONDS if deadline is None else deadline
+    key = (current_tenant().name, update.effective_user.id if update.effective_user else None, name)
+    previous = RUNNING_REPORTS.get(key)
+    if previous is not None:
+        previous.cancel()
+        increment_metric(f"reports.{name}.superseded")
+    job = RUNNING_REPORTS[key] = ReportJob()
+    loop = asyncio.get_running_loop()
+
+    def submit(func):
+        # Поток пула видит текущую организацию (ContextVar) так же, как обработчик
+        return loop.run_in_executor(REPORT_POOL, contextvars.copy_context().run, func, job)
+
+    started = time.monotonic()
+    try:
+        try:
+            result = await wait_report(submit(build), job, deadline, status)
+            job.check()  # досчитался, но пока считался, пользователь запросил отчет заново
+            return result
+        except asyncio.TimeoutError:
+            job.cancel()
+            increment_metric(f"reports.{name}.deadline_exceeded")
+            if fallback is None:
+                raise
+        # Полный расчет остановится на ближайшей проверке; упрощенный идет со своим флагом
+        job = RUNNING_REPORTS[key] = ReportJob()
+        increment_metric(f"reports.{name}.fallbacks")
+        result = await wait_report(submit(fallback), job, REPORT_FALLBACK_SECONDS, status)
+        job.check()
+        return result
+    except asyncio.TimeoutError:
+        job.cancel()
+        raise
+    finally:
+        record_timing(f"reports.{name}", time.monotonic() - started)
+        if RUNNING_REPORTS.get(key) is job:
+            del RUNNING_REPORTS[key]
+
+# Упреждающая загрузка: пока распознается голос или модель разбирает текст, данные для
+# вероятного действия читаются в пуле отчетов. Догадка строится по ключевым словам
+# команд и последним действиям пользователя; не совпала с разбором - загрузка отменяется.
+PREFETCH_HISTORY = 10
+# Доля последних действий, с которой действие считается вероятным
+PREFETCH_MIN_SHARE = 0.5
+
+def analysis_action(analysis):
+    """Действие по результату разбора: команда ('analytics', 'search', ...), 'finance' или 'clarification'"""
+    return analysis['command'] if analysis['type'] == 'voice_command' else analysis['type']
+
+def note_user_action(user_id, action):
+    """Запоминает действие пользователя для следующих догадок"""
+    actions = current_tenant().recent_actions
+    if user_id not in actions:
+        actions[user_id] = deque(maxlen=PREFETCH_HISTORY)
+    actions[user_id].append(action)
+
+def predict_user_action(user_id, text=None):
+    """Вероятное действие до разбора сообщения (или None, если угадывать не по чему).
+
+    Для текста с ключевыми словами команды разбор мгновенный и догадка не нужна; без
+    них модель вернет операцию или уточнение. До распознавания голоса текста нет -
+    тогда берется преобладающее из последних действий пользователя.
+    """
+    if text is not None:
+        return None if parse_voice_command(text) else 'finance'
+    actions = current_tenant().recent_actions.get(user_id)
+    if not actions:
+        return None
+    action, count = Counter(actions).most_common(1)[0]
+    return action if count / len(actions) >= PREFETCH_MIN_SHARE else None
+
+def prefetch_data(action):
+    """Заранее читает данные и готовит отчеты, которые понадобятся действию"""
+    if action == 'finance':
+        # Запись операции: лист текущего раздела и указатель получателей. Догадка может не
+        # сбыться, поэтому загрузка только читает: раздел нового месяца создаст сама запись,
+        # а пустую локальную базу заполнит (сверкой с таблицей) тоже она
+        if not uses_ledger_store():
+            title = existing_partition()
+            if title is not None:
+                get_worksheet(title)
+        recipient_index()
+    elif action == 'analytics':
+        prerendered = current_tenant().reports.get(ANALYTICS_DEFAULT_PERIOD)
+        if not prerendered or prerendered[0] != ledger_snapshot()['version'] or prerendered[1] != datetime.now().date():
+            prerender_analytics_reports()
+    elif action == 'history':
+        get_recent_finance_records(3, HISTORY_COLUMNS)
+    elif action in ('categories', 'recipients', 'search', 'suppliers'):
+        get_finance_records()
+        recipient_index()
+
+class Prefetch:
+    """Упреждающая загрузка для предполагаемого действия; resolve() сверяет ее с итогом разбора"""
+
+    def __init__(self, action):
+        self.action = action
+        self.started = None
+        self.duration = None
+        increment_metric("prefetch.started")
+        # Поток пула видит текущую организацию (ContextVar) так же, как обработчик
+        self.future = REPORT_POOL.submit(contextvars.copy_context().run, self._run)
+
+    def _run(self):
+        self.started = time.monotonic()
+        prefetch_data(self.action)
+        self.duration = time.monotonic() - self.started
+
+    async def resolve(self, action):
+        """Догадка верна - дожидается загрузки (данные нужны обработчику), иначе отменяет ее"""
+        if action != self.action:
+            increment_metric("prefetch.misses")
+            # Уже идущую загрузку не прервать - ее результат просто останется в снимке
+            increment_metric("prefetch.cancelled" if self.future.cancel() else "prefetch.discarded")
+            return
+        increment_metric("prefetch.hits")
+        needed_at = time.monotonic()
+        try:
+            await asyncio.wrap_future(self.future)
+        except Exception as e:
+            logger.warning(f"Упреждающая загрузка '{self.action}' не удалась: {e}")
+            return
+        # Сэкономлено столько загрузки, сколько успело пройти до момента, когда данные понадобились
+        record_timing("prefetch.saved", max(0.0, min(self.duration, needed_at - self.started)))
+
+def start_prefetch(user_id, text=None):
+    """Запускает упреждающую загрузку для вероятного действия (None, если догадки нет)"""
+    action = predict_user_action(user_id, text)
+    return Prefetch(action) if action else None
+
+def report_period(period_arg):
+    """Период /recipients и /categories: (дата, после которой берутся записи, или None - все время; название)"""
+    if period_arg == 'месяц':
+        return datetime.now().date() - timedelta(days=30), "месяц"
+    if period_arg == 'неделя':
+        return datetime.now().date() - timedelta(days=7), "неделю"
+    return None, "все время"
+
+def build_recipients_report(period_arg, job, brief=False):
+    """Текст /recipients и топ получателей для графика: (текст или None без данных, [(получатель, данные)]).
+
+    brief - упрощенный отчет, когда полный не успел к сроку: только суммы топ-10.
+    """
+    cutoff_date, period_name = report_period(period_arg)
+
+    if cutoff_date:
+        # Последние 30 (7) дней, включая сегодня; записи без даты в период не попадают
+        finance_records = get_finance_records(start=cutoff_date)
+        filtered_records = [record for record in finance_records if record.day is not None and record.day > cutoff_date]
+    else:
+        filtered_records = get_finance_records()
+    job.check()
+
+    # Группируем по описанию (получателям); записанные в таблице слова не склеиваются
+    # с похожими ("Петрова" и "Петров" - разные люди), приводятся только незнакомые формы
+    recipients = {}
+    total_expense = 0
+    index = recipient_index()
+    canonical = {}
+
+    for i, record in enumerate(filtered_records):
+        if not i % REPORT_CHECK_EVERY:
+            job.check(i, len(filtered_records))
+        amount = record.amount
+        if amount < 0:  # Только расходы
+            description = record.description.strip()
+            if description not in canonical:
+                canonical[description] = index.canonical_description(description)
+            description = canonical[description]
+            category = record.category or 'Прочее'
+
+            if description and description != 'Без описания':
+                recipients[description] = recipients.get(description, {
+                    'total': 0,
+                    'count': 0,
+                    'categories': {}
+                })
+                recipients[description]['total'] += abs(amount)
+                recipients[description]['count'] += 1
+                if not brief:
+                    recipients[description]['categories'][category] = recipients[description]['categories'].get(category, 0) + abs(amount)
+                total_expense += abs(amount)
+
+    if not recipients:
+        return None, []
+
+    # Сортируем по убыванию суммы
+    sorted_recipients = sorted(recipients.items(), key=lambda x: x[1]['total'], reverse=True)
+
+    result = f"👥 **Анализ трат по получателям за {period_name}**\n\n"
+    result += f"💰 **Общие расходы:** {total_expense:,.0f} ₽\n"
+    result += f"👤 **Уникальных получателей:** {len(recipients)}\n\n"
+
+    if brief:
+        result += "🔝 **Топ получателей:**\n"
+        for i, (recipient, data) in enumerate(sorted_recipients[:10], 1):
+            result += f"{i}. **{recipient}**: {data['total']:,.0f} ₽ ({data['count']} операций)\n"
+        result += "\n⏳ Полный отчет не успел посчитаться - показан краткий."
+        return result, sorted_recipients[:10]
+
+    # Топ получателей
+    result += "🔝 **Топ получателей:**\n"
+    for i, (recipient, data) in enumerate(sorted_recipients[:10], 1):
+        percentage = (data['total'] / total_expense) * 100
+        avg_payment = data['total'] / data['count']
+
+        # Определяем основную категорию
+        main_category = max(data['categories'].items(), key=lambda x: x[1])[0]
+
+        # Эмодзи по категориям
+        emoji_map = {
+            'Зарплаты сотрудникам': '👨‍💼',
+            'Выплаты учредителям': '👔',
+            'Оплата поставщику': '🏭',
+            'Процент': '📊',
+            'Закупка товара': '🛒',
+            'Транспорт': '🚗',
+            'Такси': '🚕',
+            'Связь': '📱',
+            'Материалы': '📦',
+            'Общественные расходы': '🏢',
+            'Благотворительность': '❤️'
+        }
+
+        emoji = emoji_map.get(main_category, '💰')
+
+        result += f"{i}. {emoji} **{recipient}**\n"
+        result += f"   💰 {data['total']:,.0f} ₽ ({percentage:.1f}%)\n"
+        result += f"   📊 {data['count']} операций, ~{avg_payment:,.0f} ₽ за раз\n"
+        result += f"   📂 Основная категория: {main_category}\n\n"
+
+    # Статистика
+    if len(sorted_recipients) > 10:
+        others_total = sum(data['total'] for _, data in sorted_recipients[10:])
+        others_count = len(sorted_recipients) - 10
+        result += f"... и ещё {others_count} получателей на {others_total:,.0f} ₽\n\n"
+
+    # Топ-3 анализ
+    if len(sorted_recipients) >= 3:
+        top3_total = sum(data['total'] for _, data in sorted_recipients[:3])
+        top3_percentage = (top3_total / total_expense) * 100
+        result += f"📈 **Топ-3 получателя:** {top3_percentage:.1f}% от всех трат\n"
+
+    # Средний чек по категориям
+    category_avg = {}
+    for recipient, data in recipients.items():
+        for category, amount in data['categories'].items():
+            if category not in category_avg:
+                category_avg[category] = []
+            category_avg[category].append(amount / recipients[recipient]['count'])
+
+    if category_avg:
+        result += f"\n💳 **Средний чек по типам:**\n"
+        for category, amounts in category_avg.items():
+            avg = sum(amounts) / len(amounts)
+            result += f"• {category}: {avg:,.0f} ₽\n"
+
+    return result, sorted_recipients[:10]
+
+async def description_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Анализ трат по описанию (кому больше всего платите)"""
+    if not is_allowed_user(update):
+        await update.message.reply_text('Нет доступа')
+        return
+    args = context.args
+    message = get_message_from_update(update)
+
+    status = None
+    try:
+        status = StatusMessage(message, "👥 Анализирую траты по получателям...")
+
+        period_arg = args[0] if args and args[0] in ['месяц', 'неделя'] else None
+        period_name = {'месяц': "месяц", 'неделя': "неделю"}.get(period_arg, "все время")
+        key = rendered_key('recipients', period_arg)
+        rendered = get_rendered(key)
+        if rendered is not None:
+            await send_rendered(update, context, status, rendered, cached=True)
+            return
+
+        brief = False
+
+        def build_brief(job):
+            nonlocal brief
+            brief = True
+            return build_recipients_report(period_arg, job, brief=True)
+
+        # Считается в пуле потоков; не успел к сроку - краткий отчет, новый запрос отменяет старый
+        try:
+            result, top_recipients = await run_report(
+                update, 'recipients',
+                lambda job: build_recipients_report(period_arg, job),
+                fallback=build_brief,
+                status=status
+            )
+        except ReportCancelled:
+            await status.delete()
+            return
+
+        if result is None:
+            await send_rendered(update, context, status, store_rendered(key, "👥 Нет данных о получателях за выбранный период."))
+            return
+
+        chart = await try_render_chart(
+            'recipients', period_name, 'barh', f"Топ получателей за {period_name}",
+            [recipient for recipient, _ in top_recipients], [data['total'] for _, data in top_recipients]
+        )
+        rendered = {'text': result, 'kwargs': {'parse_mode': 'Markdown'}, 'chart': chart}
+        # Краткий отчет не запоминается: следующий запрос снова попробует посчитать полный
+        if not brief:
+            rendered = store_rendered(key, result, chart, parse_mode='Markdown')
+        await send_rendered(update, context, status, rendered)
+
+    except asyncio.TimeoutError:
+        if status is not None:
+            await status.finish("⏳ Отчет считается слишком долго, попробуйте позже.")
+        else:
+            await message.reply_text("⏳ Отчет считается слишком долго, попробуйте позже.")
+    except Exception as e:
+        logger.error(f"Ошибка анализа по описанию: {e}")
+        if status is not None:
+            await status.finish("❌ Ошибка при анализе получателей.")
+        else:
+            await message.reply_text("❌ Ошибка при анализе получателей.")
+
+def build_search_report(search_query, job, brief=False):
+    """Ответ /search: (текст, параметры отправки).
+
+    brief - упрощенный поиск, когда полный не успел к сроку: только последние BRIEF_REPORT_DAYS дней.
+    """
+    # Анализируем поисковый запрос (скомпилированный план берется из кэша): период читается
+    # по фильтрам, а имена приводятся по указателю уже после чтения нужных листов
+    start, end = search_date_range(compile_search_query(search_query)[0])
+    if brief:
+        recent = datetime.now().date() - timedelta(days=BRIEF_REPORT_DAYS - 1)
+        start = max(start, recent) if start else recent
+    finance_records = get_finance_records(start=start, end=end)
+    job.check()
+    index = recipient_index()
+    filters, predicate = compile_search_query(search_query, index)
+    found_records = []
+    for i, record in enumerate(finance_records):
+        if not i % REPORT_CHECK_EVERY:
+            job.check(i, len(finance_records))
+        if predicate(record) and (not brief or (record.day is not None and record.day >= start)):
+            found_records.append(record)
+    note = f"\n\n⏳ Поиск по всей истории не успел - показаны операции за последние {BRIEF_REPORT_DAYS} дней." if brief else ""
+
+    if not found_records:
+        reply = f"❌ По запросу '{search_query}' ничего не найдено."
+        keyboard = None
+        suggestion = suggest_search_query(search_query, finance_records, index)
+        if suggestion:
+            reply += f"\n💡 Возможно, вы имели в виду: {suggestion}"
+            callback_data = f"search_{suggestion}"
+            if len(callback_data.encode()) <= CALLBACK_DATA_LIMIT:
+                keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(f"🔍 {suggestion}", callback_data=callback_data)]])
+        return reply + note, {'reply_markup': keyboard}
+
+    # Сортируем по дате (новые сверху)
+    found_records = sorted(found_records, key=lambda record: record.day or SEARCH_UNDATED, reverse=True)
+
+    # Формируем результат
+    result = f"🔍 **Найдено: {len(found_records)} операций**\n"
+    result += f"📊 **Запрос:** {search_query}\n\n"
+
+    # Группируем результаты
+    if len(found_records) > 15:
+        result += "📋 **Последние 15 операций:**\n"
+        display_records = found_records[:15]
+    else:
+        display_records = found_records
+
+    for record in display_records:
+        emoji = "📈" if record.amount > 0 else "📉"
+        category = record.category or 'Прочее'
+        date = record.date
+        description = record.description
+        amount = record.amount
+
+        result += f"{emoji} {date}: {description} - {amount:,.0f} ₽ ({category})\n"
+
+    if len(found_records) > 15:
+        result += f"\n... и ещё {len(found_records) - 15} операций"
+
+    # Аналитика результатов
+    total_amount = sum(record.amount for record in found_records)
+    income = sum(record.amount for record in found_records if record.amount > 0)
+    expense = sum(record.amount for record in found_records if record.amount < 0)
+
+    result += f"\n\n📊 **Итоги поиска:**\n"
+    result += f"💰 Общая сумма: {total_amount:,.0f} ₽\n"
+    if income > 0:
+        result += f"📈 Доходы: +{income:,.0f} ₽\n"
+    if expense < 0:
+        result += f"📉 Расходы: {expense:,.0f} ₽\n"
+
+    return result + note, {'parse_mode': 'Markdown'}
+
+async def advanced_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Продвинутый поиск операций"""
+    if not is_allowed_user(update):
+        await update.message.reply_text('Нет доступа')
+        return
+    args = context.args
+    message = get_message_from_update(update)
+
+    if not args:
+        help_text = """
+🔍 **Супер-поиск операций:**
+
+**По имени/компании:**
+• `/search Петров` - все операции с Петровым
+• `/search Интигам` - все операции с Интигамом
+
+**По категории:**
+• `/search зарплаты` - все зарплаты
+• `/search поставщик` - все оплаты поставщикам
+
+**По периоду:**
+• `/search неделя` - операции за неделю
+• `/search месяц` - операции за месяц
+• `/search декабрь` - операции за декабрь
+• `/search 2024` - операции за 2024 год
+
+**По сумме:**
+• `/search >50000` - операции больше 50к
+• `/search <10000` - операции меньше 10к
+
+**Комбинированный поиск:**
+• `/search Петров месяц` - операции с Петровым за месяц
+• `/search зарплаты или такси` - несколько категорий сразу
+        """
+        await message.reply_text(help_text, parse_mode='Markdown')
+        return
+
+    search_query = " ".join(args).lower()
+
+    status = None
+    try:
+        status = StatusMessage(message, f"🔍 Ищу операции по запросу: '{search_query}'...")
+
+        key = rendered_key('search', search_query)
+        rendered = get_rendered(key)
+        if rendered is not None:
+            await send_rendered(update, context, status, rendered, cached=True)
+            return
+
+        # Упрощенный поиск по последним дням нужен, только если запрос захватывает и более ранние
+        start, end = search_date_range(compile_search_query(search_query)[0])
+        recent = datetime.now().date() - timedelta(days=BRIEF_REPORT_DAYS - 1)
+        brief = False
+
+        def build_brief(job):
+            nonlocal brief
+            brief = True
+            return build_search_report(search_query, job, brief=True)
+
+        try:
+            text, kwargs = await run_report(
+                update, 'search',
+                lambda job: build_search_report(search_query, job),
+                fallback=build_brief if (start is None or start < recent) and (end is None or end >= recent) else None,
+                status=status
+            )
+        except ReportCancelled:
+            await status.delete()
+            return
+
+        rendered = {'text': text, 'kwargs': kwargs, 'chart': None}
+        # Поиск только по последним дням не запоминается
+        if not brief:
+            rendered = store_rendered(key, text, **kwargs)
+        await send_rendered(update, context, status, rendered)
+
+    except asyncio.TimeoutError:
+        if status is not None:
+            await status.finish("⏳ Поиск идет слишком долго, попробуйте уточнить запрос.")
+        else:
+            await message.reply_text("⏳ Поиск идет слишком долго, попробуйте уточнить запрос.")
+    except Exception as e:
+        logger.error(f"Ошибка продвинутого поиска: {e}")
+        if status is not None:
+            await status.finish("❌ Ошибка при поиске операций.")
+        else:
+            await message.reply_text("❌ Ошибка при поиске операций.")
+
+# Слова-синонимы категорий для поиска
+SEARCH_CATEGORY_WORDS = {
+    'зарплат': 'Зарплаты сотрудникам',
+    'зарплаты': 'Зарплаты сотрудникам',
+    'зарплата': 'Зарплаты сотрудникам',
+    'поставщик': 'Оплата поставщику',
+    'поставщику': 'Оплата поставщику',
+    'поставщиков': 'Оплата поставщику',
+    'материал': 'Материалы',
+    'материалы': 'Материалы',
+    'такси': 'Такси',
+    'транспорт': 'Транспорт',
+    'связь': 'Связь',
+    'благотворительность': 'Благотворительность',
+    'сво': 'Благотворительность',
+    'общественн': 'Общественные расходы',
+    'хоз': 'Общественные расходы',
+    'хозяйственные': 'Общественные расходы',
+    'учредител': 'Выплаты учредителям',
+    'учредители': 'Выплаты учредителям',
+    'лично': 'Выплаты учредителям',
+}
+
+# Названия месяцев во всех употребимых формах: "декабрь", "декабря", "декабре"
+SEARCH_MONTH_WORDS = {}
+for _number, _forms in enumerate([
+    ('январь', 'января', 'январе'),
+    ('февраль', 'февраля', 'феврале'),
+    ('март', 'марта', 'марте'),
+    ('апрель', 'апреля', 'апреле'),
+    ('май', 'мая', 'мае'),
+    ('июнь', 'июня', 'июне'),
+    ('июль', 'июля', 'июле'),
+    ('август', 'августа', 'августе'),
+    ('сентябрь', 'сентября', 'сентябре'),
+    ('октябрь', 'октября', 'октябре'),
+    ('ноябрь', 'ноября', 'ноябре'),
+    ('декабрь', 'декабря', 'декабре'),
+], 1):
+    for _form in _forms:
+        SEARCH_MONTH_WORDS[_form] = _number
+
+# Дата для сортировки записей без даты
+SEARCH_UNDATED = datetime(2000, 1, 1).date()
+
+# Telegram ограничивает callback_data кнопки 64 байтами
+CALLBACK_DATA_LIMIT = 64
+
+# Сколько дней назад (включая сегодня) покрывает период
+SEARCH_PERIOD_DAYS = {'week': 7, 'month': 30}
+
+# Разделители для "ИЛИ" между категориями: "зарплаты или такси", "зарплаты|такси", "зарплаты,такси"
+SEARCH_OR_WORDS = {'или', 'or', '|'}
+
+def parse_search_query(query):
+    """Парсит поисковый запрос и извлекает фильтры"""
+    filters = {
+        'text': [],
+        'categories': [],
+        'amount_min': None,
+        'amount_max': None,
+        'amount_exact': None,
+        'period': None,
+        'months': [],
+        'years': []
+    }
 
-    # Сначала проверяем, не является ли это командным запросом
-    command_result = parse_voice_command(text)
-    if command_result:
-        return command_result
+    tokens = re.sub(r'[|,]', ' ', query.lower()).split()
 
-    context_info = ""
-    if user_context:
-        recent_operations = user_context.get('recent_operations', [])
-        if recent_operations:
-            context_info = f"""
-КОНТЕКСТ последних операций пользователя:
-{chr(10).join(recent_operations[-5:])}
-
-Используй этот контекст для более точного понимания. Например:
-- Если говорит "такая же сумма" - ищи в контексте
-- Если "тому же человеку" - используй имя из предыдущих операций
-- Если просто "зарплата" без имени - предложи уточнить или используй контекст
-"""
+    for token in tokens:
+        if token in SEARCH_OR_WORDS:
+            continue
 
-    prompt = f"""
-Проанализируй сообщение пользователя и определи его тип и данные.
+        # Поиск по сумме
+        if token.startswith('>'):
+            try:
+                filters['amount_min'] = float(token[1:])
+                continue
+            except ValueError:
+                pass
 
-{context_info}
+        if token.startswith('<'):
+            try:
+                filters['amount_max'] = float(token[1:])
+                continue
+            except ValueError:
+                pass
 
-Сообщение: "{text}"
+        # Год: "2024"
+        if re.fullmatch(r'(19|20)\d\d', token):
+            filters['years'].append(int(token))
+            continue
 
-Верни JSON в следующем формате:
+        # Точная сумма
+        if token.isdigit():
+            filters['amount_exact'] = float(token)
+            continue
 
-Для ФИНАНСОВЫХ операций:
-{{
-    "type": "finance",
-    "operation_type": "Пополнение" или "Расход",
-    "amount": число (положительное для пополнения, отрицательное для расхода),
-    "category": одна из категорий: "Зарплаты сотрудникам", "Выплаты учредителям", "Оплата поставщику", "Процент", "Закупка товара", "Материалы", "Транспорт", "Связь", "Такси", "Общественные расходы", "Благотворительность", "-" (для пополнений),
-    "description": "краткое описание с именами людей",
-    "comment": "",
-    "confidence": число от 0 до 1 (насколько уверен в распознавании)
-}}
+        # Категории (несколько категорий объединяются через ИЛИ)
+        if token in SEARCH_CATEGORY_WORDS:
+            filters['categories'].append(SEARCH_CATEGORY_WORDS[token])
 
-Если НЕЯСНО или нужно УТОЧНЕНИЕ:
-{{
-    "type": "clarification",
-    "message": "Уточняющий вопрос пользователю",
-    "suggestions": ["вариант 1", "вариант 2", "вариант 3"]
-}}
+        # Месяцы
+        elif token in SEARCH_MONTH_WORDS:
+            filters['months'].append(SEARCH_MONTH_WORDS[token])
 
-ПРАВИЛА РАСПОЗНАВАНИЯ:
+        # Периоды
+        elif token in ['неделя', 'неделю']:
+            filters['period'] = 'week'
+        elif token in ['месяц']:
+            filters['period'] = 'month'
 
-1. ФИНАНСЫ - точные индикаторы:
-   - Пополнения: "пополнил", "снял", "взял наличку", "получил деньги" = Пополнение
-   - Расходы: "заплатил", "потратил", "дал", "купил", "оплатил", "зарплата" = Расход
+        # Обычный текстовый поиск
+        else:
+            filters['text'].append(token)
 
-2. КАТЕГОРИИ - строгие правила:
-   - "дал/заплатил/зарплата + ИМЯ" = "Зарплаты сотрудникам"
-   - "Таня лично/Игорь лично/Антон лично" = "Выплаты учредителям"
-   - "материалы/закупка/товары" = "Материалы"
-   - "такси/убер/яндекс" = "Такси"
-   - "транспорт/бензин/авто/Герасимов" = "Транспорт"
-   - "связь/интернет/телефон" = "Связь"
-   - "благотворительность/донат/помощь/СВО" = "Благотворительность"
-   - "хоз расходы/хозяйственные/офис/канцелярия" = "Общественные расходы"
+    return filters
 
-3. ОПИСАНИЕ - только суть, с заглавной буквы:
-   - Убирай: "заплатил", "дал", "потратил", "купил", "оплатил", "лично"
-   - Оставляй: имена, должности, назначение
+@lru_cache(maxsize=4096)
+def parse_record_date(date_str):
+    """Разбирает дату записи ДД.ММ.ГГГГ (с кэшем - даты в таблице часто повторяются)"""
+    try:
+        return datetime.strptime(date_str, '%d.%m.%Y').date()
+    except (TypeError, ValueError):
+        return None
 
-4. ВСЕГДА ВЫСОКАЯ УВЕРЕННОСТЬ:
-   - Если в сообщении есть ЧИСЛО - confidence = 0.9
-   - НЕ задавай уточняющих вопросов если есть сумма
-   - Лучше записать что-то чем спрашивать
+def compile_search_filters(filters, today=None):
+    """Компилирует фильтры поиска в одну функцию-предикат для записи.
 
-5. ОБРАБОТКА ПАДЕЖНЫХ ОКОНЧАНИЙ:
-   - "Балтики" → "Балтика", "Рустаму" → "Рустам", "Петрову" → "Петров"
-   - "Интигаму" → "Интигам", "Сидорову" → "Сидоров"
+    Все константы (границы периода, множества категорий, строки поиска в нижнем
+    регистре) вычисляются один раз, а проверки выстроены от самых дешевых и
+    избирательных (категория, сумма) к дорогим (дата, текст).
+    """
+    today = today or datetime.now().date()
+    checks = []
 
-ВАЖНО: НИКОГДА НЕ УТОЧНЯЙ НИЧЕГО ЕСЛИ В СООБЩЕНИИ ЕСТЬ ЧИСЛО!
+    if filters['categories']:
+        categories = frozenset(filters['categories'])
+        checks.append(lambda record: record.category in categories)
+
+    amount_min = filters['amount_min']
+    amount_max = filters['amount_max']
+    amount_exact = filters['amount_exact']
+    if amount_exact is not None:
+        checks.append(lambda record: abs(record.amount) == amount_exact)
+    if amount_min is not None and amount_max is not None:
+        checks.append(lambda record: amount_min <= abs(record.amount) <= amount_max)
+    elif amount_min is not None:
+        checks.append(lambda record: abs(record.amount) >= amount_min)
+    elif amount_max is not None:
+        checks.append(lambda record: abs(record.amount) <= amount_max)
+
+    date_checks = []
+    if filters['period']:
+        # Запись датирована полуночью, поэтому "не старше N дней" = дата не раньше сегодня-(N-1)
+        cutoff = today - timedelta(days=SEARCH_PERIOD_DAYS[filters['period']] - 1)
+        date_checks.append(lambda record_date: record_date >= cutoff)
+    if filters['years']:
+        years = frozenset(filters['years'])
+        date_checks.append(lambda record_date: record_date.year in years)
+    if filters['months']:
+        months = frozenset(filters['months'])
+        date_checks.append(lambda record_date: record_date.month in months)
+
+    if date_checks:
+        # Как и раньше, записи без даты не отбрасываются фильтром периода (но не месяца/года)
+        keep_undated = not (filters['years'] or filters['months'])
+
+        def check_date(record):
+            if not record.date:
+                return keep_undated
+            record_date = record.day
+            if record_date is None:
+                return False
+            for date_check in date_checks:
+                if not date_check(record_date):
+                    return False
+            return True
+        checks.append(check_date)
 
-6. КОНТЕКСТНЫЕ ФРАЗЫ:
-   - "такая же сумма" = ищи последнюю сумму в контексте
-   - "тому же" = используй последнего получателя
-   - "как вчера" = анализируй контекст за вчера
-   - "обычная зарплата Петрову" = если есть в контексте - используй, иначе уточни
+    if filters['text']:
+        needles = tuple(text_filter.lower() for text_filter in filters['text'])
 
-ВАЖНО: Если confidence < 0.7 или данных недостаточно - лучше уточнить чем ошибиться!
-"""
+        def check_text(record):
+            text_to_search = record.search_text
+            for needle in needles:
+                if needle not in text_to_search:
+                    return False
+            return True
+        checks.append(check_text)
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "Ты эксперт по анализу финансовых операций. Точность критически важна. При сомнениях - всегда уточняй."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.1
-        )
+    checks = tuple(checks)
 
-        result = response.choices[0].message.content.strip()
-        # Убираем markdown форматирование если есть
-        if result.startswith("```json"):
-            result = result[7:-3]
-        elif result.startswith("```"):
-            result = result[3:-3]
+    def predicate(record):
+        for check in checks:
+            if not check(record):
+                return False
+        return True
 
-        return json.loads(result)
+    return predicate
 
-    except Exception as e:
-        logger.error(f"Ошибка ИИ анализа: {e}")
-        return {"type": "clarification", "message": "Извините, произошла ошибка. Попробуйте переформулировать.", "suggestions": []}
+def search_date_range(filters, today=None):
+    """Возвращает (начало, конец) периода, который может попасть в поиск (None - без границы)"""
+    today = today or datetime.now().date()
+    start = end = None
+    if filters['period']:
+        start = today - timedelta(days=SEARCH_PERIOD_DAYS[filters['period']] - 1)
+    if filters['years']:
+        years_start = datetime(min(filters['years']), 1, 1).date()
+        start = max(start, years_start) if start else years_start
+        end = datetime(max(filters['years']), 12, 31).date()
+    return start, end
+
+@lru_cache(maxsize=256)
+def _compile_search_query(query, today, index, recipients_version):
+    filters = parse_search_query(query)
+    if index is not None:
+        # "петрову" ищет "Петров": падежные формы заменяются словами из таблицы
+        filters['text'] = [(index.resolve_word(token) or token).lower() for token in filters['text']]
+    return filters, compile_search_filters(filters, today)
+
+def compile_search_query(query, index=None):
+    """Возвращает (фильтры, предикат) для поискового запроса.
+
+    index - указатель получателей для падежных форм имен (без него слова ищутся как есть).
+    Планы запоминаются по строке запроса, текущей дате и версии указателя
+    получателей, поэтому повторные нажатия кнопок поиска не разбирают и не
+    компилируют запрос заново.
+    """
+    version = index.version if index is not None else None
+    return _compile_search_query(query.lower().strip(), datetime.now().date(), index, version)
 
-def update_user_context(user_id, operation_data):
-    """Обновляет контекст пользователя"""
-    if user_id not in USER_CONTEXT:
-        USER_CONTEXT[user_id] = {'recent_operations': []}
+def suggest_search_query(query, records, index):
+    """Запрос с исправленными опечатками в именах, если по нему что-то находится (или None)"""
+    text_words = set(parse_search_query(query)['text'])
+    tokens = query.split()
+    fixed = [(index.suggest([token]) if token in text_words else None) or token for token in tokens]
+    if fixed == tokens:
+        return None
+    suggestion = " ".join(fixed)
+    _, predicate = compile_search_query(suggestion, index)
+    return suggestion if any(predicate(record) for record in records) else None
 
-    # Формируем строку операции для контекста
-    context_line = f"{operation_data['data']['description']}: {operation_data['data']['amount']:,.0f} ₽ ({operation_data['data']['category']})"
+@lru_cache(maxsize=256)
+def _compile_frozen_filters(frozen, today):
+    return compile_search_filters({name: list(value) if isinstance(value, tuple) else value for name, value in frozen}, today)
 
-    USER_CONTEXT[user_id]['recent_operations'].append(context_line)
+def matches_filters(record, filters):
+    """Проверяет соответствие записи фильтрам.
 
-    # Храним только последние 10 операций
-    if len(USER_CONTEXT[user_id]['recent_operations']) > 10:
-        USER_CONTEXT[user_id]['recent_operations'] = USER_CONTEXT[user_id]['recent_operations'][-10:]
+    Предикат компилируется один раз для одинаковых фильтров (и текущей даты), поэтому
+    проверка списка записей по одним фильтрам не компилирует его на каждой записи.
+    """
+    frozen = tuple(sorted((name, tuple(value) if isinstance(value, list) else value) for name, value in filters.items()))
+    return _compile_frozen_filters(frozen, datetime.now().date())(record)
+
+# Графики PNG (matplotlib) рисуются в отдельных процессах, чтобы не занимать процессор бота.
+# Готовые ответы отчетов хранятся в TenantState.rendered: (обработчик, аргументы, версия данных,
+# дата) -> {'text', 'kwargs', 'chart'}. Запись операции меняет версию, поэтому повторное нажатие
+# кнопки до следующей записи отвечается без чтения данных и без расчетов.
+RENDERED_CACHE_SIZE = 64
+
+def rendered_key(handler, *args):
+    """Ключ готового ответа: аргументы без учета регистра и лишних пробелов"""
+    normalized = tuple(" ".join(str(arg).lower().split()) for arg in args if arg is not None)
+    return (handler, normalized, ledger_snapshot()['version'], datetime.now().date())
+
+def get_rendered(key):
+    """Готовый ответ по ключу (или None)"""
+    tenant = current_tenant()
+    rendered = tenant.rendered.get(key)
+    if rendered is None:
+        increment_metric(f"rendered.{key[0]}.misses")
+        return None
+    tenant.rendered.move_to_end(key)
+    increment_metric(f"rendered.{key[0]}.hits")
+    return rendered
+
+def store_rendered(key, text, chart=None, **kwargs):
+    """Запоминает ответ; ответы по прежним версиям данных больше не понадобятся"""
+    tenant = current_tenant()
+    for stale_key in [cached_key for cached_key in tenant.rendered if cached_key[2:] != key[2:]]:
+        del tenant.rendered[stale_key]
+    rendered = tenant.rendered[key] = {'text': text, 'kwargs': kwargs, 'chart': chart}
+    while len(tenant.rendered) > RENDERED_CACHE_SIZE:
+        tenant.rendered.popitem(last=False)
+    return rendered
+
+async def send_rendered(update, context, status, rendered, cached=False):
+    """Отправляет ответ отчета (на месте заглушки) и его график"""
+    text = rendered['text']
+    if cached and REPORT_CACHE_DEBUG:
+        text += "\n\n⚡ из кэша"
+    await status.finish(text, **rendered['kwargs'])
+    if rendered['chart'] is not None:
+        await send_chart(update, context, rendered['chart'])
+
+# Готовые картинки хранятся в TenantState.charts: (отчет, период, версия данных, дата) -> PNG
+CHART_CACHE_SIZE = 32
+CHART_POOL = None
+CHART_POOL_LOCK = threading.Lock()
+
+def chart_pool():
+    """Пул процессов для рисования графиков (создается при первом графике).
+
+    Процессы запускаются заново (spawn), а не копией бота (fork): к первому графику в боте
+    уже работают потоки пулов и планировщика, и копия могла бы унаследовать чужие
+    захваченные блокировки (логирование, HTTP-клиенты) и зависнуть.
+    """
+    global CHART_POOL
+    with CHART_POOL_LOCK:
+        if CHART_POOL is None:
+            CHART_POOL = ProcessPoolExecutor(max_workers=CHART_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return CHART_POOL
 
-def add_finance_record(data, user_id):
-    """Добавляет финансовую запись в таблицу"""
-    try:
-        row = [
-            format_moscow_date(),  # Московское время
-            data['operation_type'],
-            data['category'],
-            data['description'],
-            data['amount'],
-            data.get('comment', '')
-        ]
-        finance_sheet.append_row(row)
+def render_chart_png(kind, title, labels, values):
+    """Рисует график и возвращает (PNG, секунд на рисование); выполняется в процессе пула.
 
-        # Сохраняем последнюю операцию
-        USER_LAST_OPERATIONS[user_id] = {
-            'type': 'finance',
-            'data': data,
-            'row': len(finance_sheet.get_all_values()),
-            'timestamp': get_moscow_time()
-        }
+    kind: 'pie' - доли (категории), 'line' - значения по дням, 'barh' - рейтинг (получатели).
+    """
+    started = time.perf_counter()
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(8, 5), dpi=100)
+    axes = figure.subplots()
+    if kind == 'pie':
+        axes.pie(values, labels=labels, autopct='%1.0f%%', startangle=90, counterclock=False)
+        axes.axis('equal')
+    elif kind == 'line':
+        positions = range(len(values))
+        axes.plot(positions, values, marker='o')
+        axes.fill_between(positions, values, alpha=0.2)
+        step = max(1, len(labels) // 10)
+        axes.set_xticks(list(positions)[::step], labels[::step])
+        axes.set_ylabel('₽')
+        axes.grid(alpha=0.3)
+    elif kind == 'barh':
+        axes.barh(list(reversed(labels)), list(reversed(values)))
+        axes.set_xlabel('₽')
+        axes.grid(axis='x', alpha=0.3)
+    else:
+        raise ValueError(f"Неизвестный вид графика: {kind}")
+    axes.set_title(title)
+    figure.tight_layout()
+
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png')
+    return buffer.getvalue(), time.perf_counter() - started
+
+async def render_chart(report, period, kind, title, labels, values):
+    """PNG графика: из кэша организации, если данные не менялись, иначе рисуется в пуле процессов"""
+    tenant = current_tenant()
+    key = (report, period, ledger_snapshot()['version'], datetime.now().date())
+    png = tenant.charts.get(key)
+    if png is not None:
+        tenant.charts.move_to_end(key)
+        increment_metric("charts.cache_hits")
+        return png
+
+    increment_metric("charts.cache_misses")
+    started = time.monotonic()
+    loop = asyncio.get_running_loop()
+    png, render_seconds = await loop.run_in_executor(
+        chart_pool(), render_chart_png, kind, title, list(labels), list(values)
+    )
+    record_timing(f"charts.render.{report}", render_seconds)
+    # С ожиданием свободного процесса и передачей картинки
+    record_timing("charts.total", time.monotonic() - started)
 
-        # Обновляем контекст
-        update_user_context(user_id, USER_LAST_OPERATIONS[user_id])
+    tenant.charts[key] = png
+    while len(tenant.charts) > CHART_CACHE_SIZE:
+        tenant.charts.popitem(last=False)
+    return png
 
-        return True
+async def try_render_chart(report, period, kind, title, labels, values):
+    """Как render_chart(), но без исключений: график - дополнение к тексту отчета (None при ошибке)"""
+    try:
+        return await render_chart(report, period, kind, title, labels, values)
+    except ImportError as e:
+        logger.warning(f"Графики недоступны: не установлен модуль {e.name}")
     except Exception as e:
-        logger.error(f"Ошибка записи финансов: {e}")
-        return False
+        increment_metric("charts.errors")
+        logger.error(f"Ошибка рисования графика {report}: {e}")
+    return None
 
-def parse_voice_command(text):
-    """Парсит голосовые команды и возвращает соответствующую команду"""
-    text_lower = text.lower()
+async def send_chart(update, context, png):
+    """Отправляет PNG графика в чат"""
+    await context.bot.send_photo(chat_id=update.effective_chat.id, photo=png)
 
-    # Команды по получателям (НОВОЕ!)
-    if any(phrase in text_lower for phrase in ['кому платили', 'анализ получателей', 'по получателям', 'кому больше', 'топ получателей']):
-        return {"type": "voice_command", "command": "recipients", "params": text}
+def daily_expenses(finance_records, start_date, end_date):
+    """Расходы по дням периода [start_date, end_date]: (подписи ДД.ММ, суммы)"""
+    totals = {}
+    for record in finance_records:
+        if record.amount < 0 and record.day is not None and start_date <= record.day <= end_date:
+            totals[record.day] = totals.get(record.day, 0) + abs(record.amount)
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    return [day.strftime('%d.%m') for day in days], [totals.get(day, 0) for day in days]
 
-    # Команды по поставщикам (ПРИОРИТЕТ!)
-    if any(phrase in text_lower for phrase in ['анализ поставщика', 'по поставщику', 'история с', 'поставщик']):
-        return {"type": "voice_command", "command": "suppliers", "params": text}
+def build_categories_report(period_arg, job, brief=False):
+    """Расходы по категориям для /categories: (название периода, всего, [(категория, сумма)] по убыванию).
 
-    # Команды аналитики
-    if any(phrase in text_lower for phrase in ['анализ', 'аналитика', 'отчет', 'покажи траты', 'сколько потратили']):
-        return {"type": "voice_command", "command": "analytics", "params": text}
+    brief - упрощенный отчет за все время, когда полный не успел к сроку: только последние
+    BRIEF_REPORT_DAYS дней.
+    """
+    cutoff_date, period_name = report_period(period_arg)
+    if brief:
+        cutoff_date = datetime.now().date() - timedelta(days=BRIEF_REPORT_DAYS)
+        period_name = f"последние {BRIEF_REPORT_DAYS} дней"
+
+    if cutoff_date:
+        # Последние 30 (7) дней, включая сегодня; записи без даты в период не попадают
+        finance_records = get_finance_records(start=cutoff_date)
+        filtered_records = [record for record in finance_records if record.day is not None and record.day > cutoff_date]
+    else:
+        filtered_records = get_finance_records()
+    job.check()
+
+    # Группируем по категориям
+    categories = {}
+    total_expense = 0
+
+    for i, record in enumerate(filtered_records):
+        if not i % REPORT_CHECK_EVERY:
+            job.check(i, len(filtered_records))
+        amount = record.amount
+        if amount < 0:  # Только расходы
+            category = record.category or 'Прочее'
+            categories[category] = categories.get(category, 0) + abs(amount)
+            total_expense += abs(amount)
+
+    # Сортируем по убыванию
+    return period_name, total_expense, sorted(categories.items(), key=lambda x: x[1], reverse=True)
 
-    # Команды поиска
-    if any(phrase in text_lower for phrase in ['найди', 'найти', 'поиск', 'покажи операции', 'когда платили']):
-        return {"type": "voice_command", "command": "search", "params": text}
+async def category_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Анализ по категориям"""
+    if not is_allowed_user(update):
+        await update.message.reply_text('Нет доступа')
+        return
+    args = context.args
+    message = get_message_from_update(update)
 
-    # Команды по категориям
-    if any(phrase in text_lower for phrase in ['по категориям', 'категории', 'расходы по']):
-        return {"type": "voice_command", "command": "categories", "params": text}
+    status = None
+    try:
+        status = StatusMessage(message, "📊 Анализирую категории...")
 
-    # Команды истории
-    if any(phrase in text_lower for phrase in ['история', 'последние операции', 'что было']):
-        return {"type": "voice_command", "command": "history", "params": text}
+        period_arg = args[0] if args and args[0] in ['месяц', 'неделя'] else None
+        key = rendered_key('categories', period_arg)
+        rendered = get_rendered(key)
+        if rendered is not None:
+            await send_rendered(update, context, status, rendered, cached=True)
+            return
 
-    # Команды бэкапа
-    if any(phrase in text_lower for phrase in ['бэкап', 'резервная копия', 'сохрани', 'backup']):
-        return {"type": "voice_command", "command": "backup", "params": text}
+        brief = False
+
+        def build_brief(job):
+            nonlocal brief
+            brief = True
+            return build_categories_report(period_arg, job, brief=True)
+
+        # Считается в пуле потоков; отчет за все время, не успевший к сроку, заменяется
+        # отчетом за последние дни (месяц и неделя и так короткие)
+        try:
+            period_name, total_expense, sorted_categories = await run_report(
+                update, 'categories',
+                lambda job: build_categories_report(period_arg, job),
+                fallback=build_brief if period_arg is None else None,
+                status=status
+            )
+        except ReportCancelled:
+            await status.delete()
+            return
 
-    return None
+        if not sorted_categories:
+            reply = "📊 Нет данных о расходах за выбранный период."
+            await send_rendered(update, context, status, {'text': reply, 'kwargs': {}, 'chart': None} if brief else store_rendered(key, reply))
+            return
 
-def extract_params_from_voice(text, command_type):
-    """Извлекает параметры из голосового запроса"""
-    text_lower = text.lower()
-    params = {}
+        # Круговая диаграмма; без нее (нет matplotlib, ошибка) доли показываются полосами в тексте
+        chart = await try_render_chart(
+            'categories', period_name, 'pie', f"Расходы за {period_name}",
+            [category for category, _ in sorted_categories], [amount for _, amount in sorted_categories]
+        )
 
-    # Извлекаем имена/компании для команд поставщиков
-    if command_type == 'suppliers':
-        # Ищем после ключевых слов "поставщика", "поставщику", "с"
-        patterns = [
-            r'поставщика\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?)',
-            r'поставщику\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?)',
-            r'история\s+с\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?)',
-            r'по\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?)',
-            r'анализ\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?)'
-        ]
+        result = f"📊 **Анализ расходов за {period_name}**\n\n"
+        result += f"💰 **Общие расходы:** {total_expense:,.0f} ₽\n\n"
 
-        for pattern in patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
-            if match:
-                name = match.group(1).strip()
-                # Приводим к стандартному виду
-                if name.lower() in ['интигаму', 'интигама']:
-                    params['name'] = 'Интигам'
-                elif name.lower() in ['балтики', 'балтике', 'балтику']:
-                    params['name'] = 'Балтика'
-                elif name.lower() in ['петрову', 'петрова']:
-                    params['name'] = 'Петров'
-                elif name.lower() in ['рустаму', 'рустама']:
-                    params['name'] = 'Рустам'
-                else:
-                    # Убираем падежные окончания для новых имен
-                    if name.endswith('у') or name.endswith('а') or name.endswith('е'):
-                        params['name'] = name[:-1]
-                    else:
-                        params['name'] = name
-                break
+        for i, (category, amount) in enumerate(sorted_categories, 1):
+            percentage = (amount / total_expense) * 100
+            result += f"{i}. **{category}**\n"
+            result += f"   💰 {amount:,.0f} ₽ ({percentage:.1f}%)\n"
+            if chart is None:
+                bar_length = int(percentage / 5)  # Шкала из 20 символов
+                result += f"   {'█' * bar_length + '░' * (20 - bar_length)}\n"
+            result += "\n"
 
-    # Для других команд - общий поиск имен
-    if 'name' not in params:
-        # Ищем любые имена с большой буквы
-        names = re.findall(r'\b[А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?\b', text)
-        if names:
-            name = names[0]
-            # Убираем падежные окончания
-            if name.endswith('у') or name.endswith('а') or name.endswith('е'):
-                params['name'] = name[:-1]
-            else:
-                params['name'] = name
-
-    # Извлекаем периоды
-    if any(word in text_lower for word in ['неделя', 'неделю']):
-        params['period'] = 'неделя'
-    elif any(word in text_lower for word in ['месяц']):
-        params['period'] = 'месяц'
-    elif any(word in text_lower for word in ['декабрь', 'январь', 'февраль', 'март', 'апрель', 'май', 'июнь', 'июль', 'август', 'сентябрь', 'октябрь', 'ноябрь']):
-        months = ['январь', 'февраль', 'март', 'апрель', 'май', 'июнь', 'июль', 'август', 'сентябрь', 'октябрь', 'ноябрь', 'декабрь']
-        for month in months:
-            if month in text_lower:
-                params['period'] = month
-                break
+        # Топ-3 категории
+        if len(sorted_categories) >= 3:
+            top3_total = sum(amount for _, amount in sorted_categories[:3])
+            top3_percentage = (top3_total / total_expense) * 100
+            result += f"🔝 **Топ-3 категории:** {top3_percentage:.1f}% от всех трат"
 
-    # Извлекаем категории
-    if any(word in text_lower for word in ['зарплат', 'зарплаты']):
-        params['category'] = 'зарплаты'
-    elif any(word in text_lower for word in ['поставщик', 'поставщиков']):
-        params['category'] = 'поставщик'
-    elif any(word in text_lower for word in ['процент', 'проценты']):
-        params['category'] = 'процент'
+        rendered = {'text': result, 'kwargs': {'parse_mode': 'Markdown'}, 'chart': chart}
+        # Отчет за последние дни вместо всего времени не запоминается
+        if brief:
+            rendered['text'] += "\n\n⏳ Отчет за все время не успел посчитаться - показаны последние дни."
+        else:
+            rendered = store_rendered(key, result, chart, parse_mode='Markdown')
+        await send_rendered(update, context, status, rendered)
 
-    return params
+    except asyncio.TimeoutError:
+        if status is not None:
+            await status.finish("⏳ Отчет считается слишком долго, попробуйте позже.")
+        else:
+            await message.reply_text("⏳ Отчет считается слишком долго, попробуйте позже.")
+    except Exception as e:
+        logger.error(f"Ошибка анализа категорий: {e}")
+        if status is not None:
+            await status.finish("❌ Ошибка при анализе категорий.")
+        else:
+            await message.reply_text("❌ Ошибка при анализе категорий.")
 
-def create_quick_buttons():
-    """Создает быстрые кнопки для частых действий"""
-    keyboard = [
-        [
-            InlineKeyboardButton("📊 Отчет", callback_data="quick_analytics"),
-            InlineKeyboardButton("🔍 Поиск", callback_data="quick_search")
-        ],
-        [
-            InlineKeyboardButton("📋 История", callback_data="quick_history"),
-            InlineKeyboardButton("💾 Бэкап", callback_data="quick_backup")
-        ],
-        [
-            InlineKeyboardButton("📂 Категории", callback_data="quick_categories"),
-            InlineKeyboardButton("👥 Получатели", callback_data="quick_recipients")
-        ],
-        [
-            InlineKeyboardButton("🏭 Поставщики", callback_data="quick_suppliers")
-        ]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+def build_supplier_report(supplier_name, job, brief=False):
+    """Ответ /suppliers: (текст, параметры отправки).
 
-def create_search_buttons():
-    """Создает кнопки для популярных поисковых запросов"""
-    keyboard = [
-        [
-            InlineKeyboardButton("👥 Петров", callback_data="search_петров"),
-            InlineKeyboardButton("🏭 Интигам", callback_data="search_интигам")
-        ],
-        [
-            InlineKeyboardButton("💰 Зарплаты", callback_data="search_зарплаты"),
-            InlineKeyboardButton("📊 Процент", callback_data="search_процент")
-        ],
-        [
-            InlineKeyboardButton("📅 За неделю", callback_data="search_неделя"),
-            InlineKeyboardButton("💸 >50000", callback_data="search_>50000")
-        ]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    brief - упрощенный отчет, когда полный не успел к сроку: только последние BRIEF_REPORT_DAYS дней.
+    """
+    start = datetime.now().date() - timedelta(days=BRIEF_REPORT_DAYS - 1) if brief else None
+    finance_records = get_finance_records(start=start, category='Оплата поставщику')
+    job.check()
+    # Имя в любом падеже приводится к записанному в таблице ("Интигаму" -> "Интигам")
+    supplier_name = (resolve_recipient_name(supplier_name) or supplier_name).lower()
+    supplier_records = []
+
+    for i, record in enumerate(finance_records):
+        if not i % REPORT_CHECK_EVERY:
+            job.check(i, len(finance_records))
+        if supplier_name in record.description.lower() and (start is None or (record.day is not None and record.day >= start)):
+            supplier_records.append(record)
+    note = f"\n\n⏳ Полный отчет не успел посчитаться - показаны последние {BRIEF_REPORT_DAYS} дней." if brief else ""
+
+    if not supplier_records:
+        reply = f"❌ Операции с поставщиком '{supplier_name}' не найдены."
+        suggestion = recipient_index().suggest(supplier_name.split())
+        if suggestion and any(suggestion.lower() in record.description.lower() for record in finance_records):
+            reply += f"\n💡 Возможно, вы имели в виду: /suppliers {suggestion}"
+        return reply + note, {}
+
+    # Сортируем по дате
+    supplier_records = sorted(supplier_records, key=lambda record: record.day or SEARCH_UNDATED)
+
+    total_paid = sum(abs(record.amount) for record in supplier_records)
+
+    result = f"🏭 **Анализ поставщика: {supplier_name.title()}**\n\n"
+    result += f"📊 **Всего операций:** {len(supplier_records)}\n"
+    result += f"💰 **Общая сумма:** {total_paid:,.0f} ₽\n\n"
+
+    if len(supplier_records) > 0:
+        avg_amount = total_paid / len(supplier_records)
+        result += f"📈 **Средняя оплата:** {avg_amount:,.0f} ₽\n"
+
+        # Последние операции
+        result += f"\n📋 **Последние операции:**\n"
+        for record in supplier_records[-5:]:
+            date = record.date
+            amount = abs(record.amount)
+            result += f"• {date}: {amount:,.0f} ₽\n"
+
+    return result + note, {'parse_mode': 'Markdown'}
 
-async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик голосовых сообщений"""
+async def supplier_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Анализ поставщиков"""
     if not is_allowed_user(update):
         await update.message.reply_text('Нет доступа')
         return
-    try:
-        user_id = update.effective_user.id
-
-        # Показываем что бот обрабатывает голосовое
-        await update.message.reply_text("🎤 Распознаю голосовое сообщение...")
+    args = context.args
+    message = get_message_from_update(update)
 
-        # Получаем файл голосового сообщения
-        voice_file = await context.bot.get_file(update.message.voice.file_id)
+    if not args:
+        await message.reply_text("🏭 Использование: /suppliers [название]\nПример: /suppliers Интигам")
+        return
 
-        # Скачиваем файл
-        voice_path = f"voice_{update.message.voice.file_id}.ogg"
-        await voice_file.download_to_drive(voice_path)
+    supplier_name = " ".join(args).lower()
 
-        # Конвертируем в текст через Whisper
-        with open(voice_path, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                language="ru"
+    status = None
+    try:
+        status = StatusMessage(message, f"🏭 Анализирую операции с поставщиком '{supplier_name}'...")
+
+        # Считается в пуле потоков; не успел к сроку - только операции за последние дни
+        try:
+            text, kwargs = await run_report(
+                update, 'suppliers',
+                lambda job: build_supplier_report(supplier_name, job),
+                fallback=lambda job: build_supplier_report(supplier_name, job, brief=True),
+                status=status
             )
+        except ReportCancelled:
+            await status.delete()
+            return
 
-        # Удаляем временный файл
-        os.remove(voice_path)
-
-        recognized_text = transcript.text
-
-        # Показываем что распознали
-        await update.message.reply_text(f"📝 Распознал: \"{recognized_text}\"")
-
-        # Обрабатываем с контекстом
-        user_context = USER_CONTEXT.get(user_id)
-        analysis = analyze_message_with_ai(recognized_text, user_context)
-
-        await process_analysis_result(update, analysis, user_id, f"🎤 \"{recognized_text}\"", context)
+        await status.finish(text, **kwargs)
 
+    except asyncio.TimeoutError:
+        if status is not None:
+            await status.finish("⏳ Отчет считается слишком долго, попробуйте позже.")
+        else:
+            await message.reply_text("⏳ Отчет считается слишком долго, попробуйте позже.")
     except Exception as e:
-        logger.error(f"Ошибка обработки голосового: {e}")
-        await update.message.reply_text("❌ Ошибка при обработке голосового сообщения.")
-
-async def handle_voice_command(update: Update, context: ContextTypes.DEFAULT_TYPE, analysis):
-    """Обрабатывает голосовые команды"""
-    command = analysis["command"]
-    params_text = analysis["params"]
-    params = extract_params_from_voice(params_text, command)
-
-    # Получаем message объект
-    message = update.message if update.message else update.callback_query.message
-
-    if command == "analytics":
-        await show_analytics(update, context)
-
-    elif command == "search":
-        # Формируем поисковый запрос из параметров
-        search_terms = []
-        if 'name' in params:
-            search_terms.append(params['name'])
-        if 'period' in params:
-            search_terms.append(params['period'])
-        if 'category' in params:
-            search_terms.append(params['category'])
-
-        if search_terms:
-            # Имитируем команду search
-            context.args = search_terms
-            await advanced_search(update, context)
+        logger.error(f"Ошибка анализа поставщика: {e}")
+        if status is not None:
+            await status.finish("❌ Ошибка при анализе поставщика.")
         else:
-            await message.reply_text(
-                "🔍 **Голосовой поиск**\n\nПопробуйте сказать:\n• 'Найди Петрова'\n• 'Покажи операции за неделю'\n• 'Когда платили Интигаму'",
-                reply_markup=create_search_buttons()
-            )
+            await message.reply_text("❌ Ошибка при анализе поставщика.")
+
+# Выгрузка операций: формат -> расширение файла. Parquet и Excel требуют pyarrow / openpyxl
+EXPORT_FORMATS = {'csv': 'csv', 'parquet': 'parquet', 'xlsx': 'xlsx', 'excel': 'xlsx'}
+EXPORT_DEFAULT_FORMAT = 'csv'
+# Записей в одной пачке (в Parquet - одна группа строк)
+EXPORT_CHUNK_SIZE = 5000
+EXPORT_USAGE = (
+    "📤 Использование: /export [период] [формат]\n"
+    "Период: 2024-11, ноябрь, ноябрь 2024, 2024, месяц, прошлый месяц, неделя, все "
+    "(по умолчанию - прошлый месяц)\n"
+    "Формат: csv, xlsx, parquet (по умолчанию - csv)\n"
+    "Пример: /export 2024-11 xlsx"
+)
 
-    elif command == "categories":
-        period = params.get('period', None)
-        if period:
-            context.args = [period]
+def parse_export_args(args, today):
+    """Разбирает аргументы /export: (начало, конец, формат); без периода - прошлый месяц.
+
+    Бросает ValueError с понятным пользователю текстом, если аргумент не распознан.
+    """
+    export_format = EXPORT_DEFAULT_FORMAT
+    month = year = None
+    relative = None
+    previous = False
+    for token in (arg.lower() for arg in args):
+        if token in EXPORT_FORMATS:
+            export_format = EXPORT_FORMATS[token]
+        elif re.fullmatch(r'(19|20)\d\d-(0[1-9]|1[0-2])', token):
+            year, month = int(token[:4]), int(token[5:])
+        elif re.fullmatch(r'(19|20)\d\d', token):
+            year = int(token)
+        elif token in SEARCH_MONTH_WORDS:
+            month = SEARCH_MONTH_WORDS[token]
+        elif token in ('прошлый', 'прошлая', 'прошлую'):
+            previous = True
+        elif token in ('месяц', 'неделя', 'неделю', 'все', 'всё'):
+            relative = token
         else:
-            context.args = []
-        await category_analysis(update, context)
+            raise ValueError(f"Не понял «{token}»")
+
+    if relative in ('все', 'всё'):
+        return None, None, export_format
+    if relative in ('неделя', 'неделю'):
+        end = today - timedelta(days=7) if previous else today
+        return end - timedelta(days=6), end, export_format
+    if month is not None:
+        if year is None:
+            # Месяц без года - последний уже наступивший
+            year = today.year if month <= today.month else today.year - 1
+        return (*month_bounds(datetime(year, month, 1).date()), export_format)
+    if year is not None:
+        return datetime(year, 1, 1).date(), datetime(year, 12, 31).date(), export_format
+    if relative == 'месяц' and not previous:
+        return today.replace(day=1), today, export_format
+    start, _ = month_bounds(today.replace(day=1) - timedelta(days=1))
+    return start, today.replace(day=1) - timedelta(days=1), export_format
+
+def format_csv_amount(amount):
+    """Сумма для CSV с русской локалью: без ".0" у целых, дробная часть через запятую"""
+    if amount.is_integer():
+        return str(int(amount))
+    return str(amount).replace('.', ',')
+
+def write_csv_export(chunks, path):
+    """CSV для Excel с русской локалью: разделитель ";" и BOM"""
+    count = 0
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(FINANCE_COLUMNS)
+        for chunk in chunks:
+            for record in chunk:
+                row = record.as_row()
+                row[4] = format_csv_amount(record.amount)
+                writer.writerow(row)
+            count += len(chunk)
+    return count
+
+def write_parquet_export(chunks, path):
+    """Parquet со сжатием zstd: дата - датой, сумма - числом; каждая пачка - группа строк"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ('Дата', pa.date32()),
+        ('Тип операции', pa.string()),
+        ('Категория', pa.string()),
+        ('Описание/Получатель', pa.string()),
+        ('Сумма', pa.float64()),
+        ('Комментарий', pa.string())
+    ])
+    count = 0
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        for chunk in chunks:
+            columns = {
+                'Дата': [record.day for record in chunk],
+                'Тип операции': [record.operation_type for record in chunk],
+                'Категория': [record.category for record in chunk],
+                'Описание/Получатель': [record.description for record in chunk],
+                'Сумма': [record.amount for record in chunk],
+                'Комментарий': [record.comment for record in chunk]
+            }
+            writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+            count += len(chunk)
+    return count
+
+def write_xlsx_export(chunks, path):
+    """Excel в потоковом режиме openpyxl (строки сразу уходят в файл)"""
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet('Финансы')
+    worksheet.append(FINANCE_COLUMNS)
+    count = 0
+    for chunk in chunks:
+        for record in chunk:
+            if record.day is not None:
+                date_cell = WriteOnlyCell(worksheet, value=record.day)
+                date_cell.number_format = 'DD.MM.YYYY'
+            else:
+                date_cell = record.date
+            worksheet.append([date_cell, *record.as_row()[1:]])
+        count += len(chunk)
+    workbook.save(path)
+    return count
+
+EXPORT_WRITERS = {'csv': write_csv_export, 'parquet': write_parquet_export, 'xlsx': write_xlsx_export}
+
+def export_finance_records(path, export_format, start=None, end=None):
+    """Потоково пишет записи за период в файл выбранного формата. Возвращает число записей"""
+    started = time.monotonic()
+    count = EXPORT_WRITERS[export_format](iter_finance_records(start, end, EXPORT_CHUNK_SIZE), path)
+    record_timing(f"export.{export_format}", time.monotonic() - started)
+    increment_metric("export.records", count)
+    return count
+
+# Импорт банковских выписок (CSV): синонимы заголовков колонок -> поле записи.
+# Порядок важен: при нескольких подходящих колонках берется первая по списку синонимов
+IMPORT_COLUMN_SYNONYMS = {
+    'date': ['дата операции', 'дата проводки', 'дата платежа', 'дата', 'date'],
+    'amount': ['сумма операции', 'сумма в валюте счета', 'сумма платежа', 'сумма', 'amount'],
+    'debit': ['расход', 'списание', 'дебет', 'debit'],
+    'credit': ['приход', 'поступление', 'зачисление', 'кредит', 'credit'],
+    'description': ['контрагент', 'получатель', 'наименование получателя', 'описание операции', 'описание', 'description'],
+    'purpose': ['назначение платежа', 'назначение', 'комментарий', 'purpose']
+}
+IMPORT_DATE_FORMATS = ['%d.%m.%Y', '%d.%m.%Y %H:%M', '%d.%m.%Y %H:%M:%S', '%d.%m.%y', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y']
+# Категория расхода, которую не удалось определить ни правилами, ни моделью (одна из FINANCE_CATEGORIES)
+IMPORT_UNKNOWN_CATEGORY = 'Прочее'
+# Сколько минут ждать подтверждения импорта
+IMPORT_CONFIRM_MINUTES = 30
+
+def normalize_header(value):
+    return " ".join(str(value).lower().replace('﻿', '').split())
+
+def map_statement_columns(header):
+    """Сопоставляет колонки выписки полям записи: {поле: индекс колонки}.
+
+    Бросает ValueError, если нет даты или суммы (ни общей, ни раздельных расход/приход).
+    """
+    normalized = [normalize_header(value) for value in header]
+    mapping = {}
+    for field, synonyms in IMPORT_COLUMN_SYNONYMS.items():
+        for synonym in synonyms:
+            matches = [i for i, value in enumerate(normalized) if value == synonym and i not in mapping.values()]
+            if matches:
+                mapping[field] = matches[0]
+                break
+    if 'date' not in mapping:
+        raise ValueError("не найдена колонка с датой")
+    if 'amount' not in mapping and not ('debit' in mapping or 'credit' in mapping):
+        raise ValueError("не найдена колонка с суммой")
+    return mapping
+
+def parse_statement_date(value):
+    """Дата операции из выписки в виде ДД.ММ.ГГГГ (или None)"""
+    value = str(value).strip()
+    for date_format in IMPORT_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).strftime('%d.%m.%Y')
+        except ValueError:
+            continue
+    return None
 
-    elif command == "suppliers":
-        if 'name' in params:
-            context.args = [params['name']]
-            await supplier_analysis(update, context)
+def parse_statement_amount(value):
+    """Сумма из выписки: "-1 500,00 ₽" -> -1500.0 (пустая ячейка - 0, не число - None)"""
+    cleaned = re.sub(r'[^\d,.\-+]', '', str(value).replace('−', '-'))
+    if not cleaned:
+        return 0.0
+    if ',' in cleaned and '.' in cleaned:
+        # Десятичный разделитель - последний из двух, другой отделяет тысячи
+        if cleaned.rfind(',') > cleaned.rfind('.'):
+            cleaned = cleaned.replace('.', '')  # 1.500,00
         else:
-            await message.reply_text("🏭 Назовите поставщика для анализа.\nНапример: 'Анализ поставщика Интигам'")
+            cleaned = cleaned.replace(',', '')  # 1,500.00
+    try:
+        return float(cleaned.replace(',', '.'))
+    except ValueError:
+        return None
 
-    elif command == "recipients":
-        period = params.get('period', None)
-        if period:
-            context.args = [period]
+def open_statement_text(data):
+    """Текст скачанной выписки для csv.reader: UTF-8 (с BOM или без), иначе Windows-1251"""
+    try:
+        data[:65536].decode('utf-8-sig')
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError:
+        encoding = 'cp1251'
+    return io.TextIOWrapper(io.BytesIO(data), encoding=encoding, errors='replace', newline='')
+
+def parse_bank_statement(stream):
+    """Разбирает CSV-выписку (файл выписки скачивается целиком - они небольшие).
+
+    Возвращает (операции, пропущенные строки): операции - словари date, amount,
+    description, comment; пропущенные - номера строк, где нет даты или суммы.
+    """
+    sample = stream.read(8192)
+    stream.seek(0)
+    try:
+        reader = csv.reader(stream, csv.Sniffer().sniff(sample, delimiters=';,\t'))
+    except csv.Error:
+        reader = csv.reader(stream, delimiter=';')
+
+    header = next(reader, None)
+    if not header:
+        raise ValueError("файл пустой")
+    mapping = map_statement_columns(header)
+
+    def cell(row, field):
+        index = mapping.get(field)
+        return row[index].strip() if index is not None and index < len(row) else ''
+
+    operations, skipped = [], []
+    for line_number, row in enumerate(reader, 2):
+        if not any(value.strip() for value in row):
+            continue
+        date_str = parse_statement_date(cell(row, 'date'))
+        if 'amount' in mapping:
+            amount = parse_statement_amount(cell(row, 'amount'))
         else:
-            context.args = []
-        await description_analysis(update, context)
+            debit = parse_statement_amount(cell(row, 'debit'))
+            credit = parse_statement_amount(cell(row, 'credit'))
+            amount = None if debit is None or credit is None else abs(credit) - abs(debit)
+        if date_str is None or not amount:
+            skipped.append(line_number)
+            continue
+        description = cell(row, 'description') or cell(row, 'purpose') or 'Без описания'
+        comment = cell(row, 'purpose') if cell(row, 'description') else ''
+        operations.append({'date': date_str, 'amount': amount, 'description': description, 'comment': comment})
+    return operations, skipped
+
+def statement_expense_text(operation):
+    """Текст расхода для категоризации - как в recategorize.py: описание и назначение"""
+    if operation['comment']:
+        return f"{operation['description']} ({operation['comment']})"
+    return operation['description']
+
+def prepare_statement_import(data):
+    """Готовит импорт выписки: разбор, категоризация расходов пачками и строки для таблицы.
+
+    Возвращает словарь с rows (строки FINANCE_COLUMNS по возрастанию даты), skipped
+    (номера пропущенных строк файла) и frozen (операции за замороженные месяцы, не импортируются).
+    """
+    started = time.monotonic()
+    operations, skipped = parse_bank_statement(open_statement_text(data))
+
+    # Замороженные месяцы читаются из архива - записи в их листы не были бы видны
+    frozen = 0
+    importable = []
+    for operation in operations:
+        if is_frozen_partition(statement_partition(operation['date'])):
+            frozen += 1
+        else:
+            importable.append(operation)
+    operations = importable
 
-    elif command == "history":
-        await show_context_history(update, context)
+    categories = categorize_descriptions_in_bulk(
+        [statement_expense_text(operation) for operation in operations if operation['amount'] < 0]
+    )
 
-    elif command == "backup":
-        await create_backup(update, context)
+    rows = []
+    for operation in sorted(operations, key=lambda operation: parse_record_date(operation['date'])):
+        if operation['amount'] > 0:
+            operation_type, category = 'Пополнение', '-'
+        else:
+            operation_type, category = 'Расход', categories.get(statement_expense_text(operation)) or IMPORT_UNKNOWN_CATEGORY
+        rows.append([operation['date'], operation_type, category, operation['description'], operation['amount'], operation['comment']])
+
+    record_timing("import.prepare", time.monotonic() - started)
+    return {'rows': rows, 'skipped': skipped, 'frozen': frozen}
+
+def statement_partition(date_str):
+    """Раздел, в который попадет операция выписки (без создания листа)"""
+    if not is_partitioned():
+        return current_tenant().sheet_name
+    return partition_title(parse_record_date(date_str))
+
+def format_import_preview(prepared):
+    """Текст предпросмотра импорта"""
+    rows = prepared['rows']
+    income = sum(row[4] for row in rows if row[4] > 0)
+    expense = sum(row[4] for row in rows if row[4] < 0)
+    by_category = {}
+    for row in rows:
+        if row[1] == 'Расход':
+            by_category[row[2]] = by_category.get(row[2], 0) + row[4]
+
+    lines = [
+        "📥 **Предпросмотр импорта**\n",
+        f"📊 Операций: {len(rows)} ({rows[0][0]} - {rows[-1][0]})" if rows else "📊 Операций: 0",
+        f"💰 Пополнения: {income:,.0f} ₽",
+        f"💸 Расходы: {expense:,.0f} ₽"
+    ]
+    if by_category:
+        lines.append("\n📂 **По категориям:**")
+        for category, amount in sorted(by_category.items(), key=lambda item: item[1]):
+            lines.append(f"• {escape_markdown(category)}: {amount:,.0f} ₽")
+    if rows:
+        lines.append("\n📋 **Первые операции:**")
+        for row in rows[:5]:
+            lines.append(f"• {row[0]}: {escape_markdown(row[3])} - {row[4]:,.0f} ₽ ({escape_markdown(row[2])})")
+    if prepared['skipped']:
+        shown = ", ".join(str(line) for line in prepared['skipped'][:10])
+        lines.append(f"\n⚠️ Пропущено строк без даты или суммы: {len(prepared['skipped'])} ({shown}{'...' if len(prepared['skipped']) > 10 else ''})")
+    if prepared['frozen']:
+        lines.append(f"🧊 Операций за архивные месяцы (не импортируются): {prepared['frozen']}")
+    return "\n".join(lines)
 
-async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обрабатывает нажатия на кнопки"""
+async def create_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Создает резервную копию данных"""
     if not is_allowed_user(update):
-        await update.callback_query.answer()
-        await update.callback_query.edit_message_text('Нет доступа')
+        await update.message.reply_text('Нет доступа')
         return
-    query = update.callback_query
-    await query.answer()
+    message = get_message_from_update(update)
 
-    data = query.data
+    try:
+        await message.reply_text("💾 Создаю резервную копию...")
 
-    # Быстрые команды
-    if data == "quick_analytics":
-        await show_analytics(update, context)
+        # Получаем все данные
+        finance_records = get_finance_records(max_age=0)
 
-    elif data == "quick_search":
-        await query.edit_message_text(
-            "🔍 **Быстрый поиск**\n\nВыберите категорию или скажите что ищете:",
-            reply_markup=create_search_buttons()
-        )
+        backup_data = {
+            'created': get_moscow_time().strftime('%d.%m.%Y %H:%M'),
+            'finance_records': len(finance_records),
+            'finance': [record.as_dict() for record in finance_records]
+        }
 
-    elif data == "quick_history":
-        await show_context_history(update, context)
+        # Создаем файл
+        backup_filename = f"backup_{get_moscow_time().strftime('%Y%m%d_%H%M')}.json"
+        with open(backup_filename, 'w', encoding='utf-8') as f:
+            json.dump(backup_data, f, ensure_ascii=False, indent=2)
 
-    elif data == "quick_backup":
-        await create_backup(update, context)
+        # Отправляем файл пользователю
+        with open(backup_filename, 'rb') as f:
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=f,
+                filename=backup_filename,
+                caption=f"💾 **Резервная копия создана!**\n\n📊 Финансовых записей: {len(finance_records)}\n📅 Дата: {backup_data['created']}"
+            )
 
-    elif data == "quick_categories":
-        context.args = []
-        await category_analysis(update, context)
+        # Удаляем временный файл
+        os.remove(backup_filename)
 
-    elif data == "quick_recipients":
-        context.args = []
-        await description_analysis(update, context)
+    except Exception as e:
+        logger.error(f"Ошибка создания backup: {e}")
+        await message.reply_text("❌ Ошибка при создании резервной копии.")
 
-    elif data == "quick_suppliers":
-        await query.edit_message_text(
-            "🏭 **Анализ поставщиков**\n\nСкажите: 'Анализ поставщика [название]'\nНапример: 'Анализ поставщика Интигам'"
-        )
+async def export_records(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выгружает операции за период в CSV, Excel или Parquet"""
+    if not is_allowed_user(update):
+        await update.message.reply_text('Нет доступа')
+        return
+    message = get_message_from_update(update)
 
-    # Поисковые запросы
-    elif data.startswith("search_"):
-        search_term = data.replace("search_", "")
-        context.args = [search_term]
-        await advanced_search(update, context)
+    try:
+        start, end, export_format = parse_export_args(context.args or [], get_moscow_time().date())
+    except ValueError as e:
+        await message.reply_text(f"❌ {e}\n\n{EXPORT_USAGE}")
+        return
 
-async def process_analysis_result(update, analysis, user_id, source_info="", context=None):
-    """Обрабатывает результат анализа ИИ"""
+    period = f"{start.strftime('%d.%m.%Y')} - {end.strftime('%d.%m.%Y')}" if start else "все время"
+    period_slug = f"{start.strftime('%Y%m%d')}_{end.strftime('%Y%m%d')}" if start else "all"
+    export_filename = f"finance_{period_slug}.{export_format}"
+    export_path = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4().hex}_{export_filename}")
+
+    try:
+        await message.reply_text(f"📤 Выгружаю операции за {period}...")
+        count = await asyncio.to_thread(export_finance_records, export_path, export_format, start, end)
+        if not count:
+            await message.reply_text(f"📭 За {period} операций нет.")
+            return
+
+        with open(export_path, 'rb') as f:
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=f,
+                filename=export_filename,
+                caption=f"📤 Выгрузка за {period}\n📊 Записей: {count}"
+            )
+    except ImportError as e:
+        await message.reply_text(f"❌ Формат {export_format} недоступен: не установлен модуль {e.name}.")
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки: {e}")
+        await message.reply_text("❌ Ошибка при выгрузке.")
+    finally:
+        if os.path.exists(export_path):
+            os.remove(export_path)
+
+async def import_statement(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Подсказка по импорту банковской выписки"""
     if not is_allowed_user(update):
         await update.message.reply_text('Нет доступа')
         return
+    message = get_message_from_update(update)
+    await message.reply_text(
+        "📥 **Импорт выписки**\n\n"
+        "Пришлите CSV-файл выписки из банка. Нужны колонки с датой и суммой "
+        "(или отдельные «Расход»/«Приход»), описание берется из колонок «Контрагент», «Получатель» или «Описание».\n\n"
+        "Я определю категории, покажу предпросмотр и запишу операции после подтверждения.",
+        parse_mode='Markdown'
+    )
 
-    # Обрабатываем голосовые команды
-    if analysis["type"] == "voice_command":
-        await handle_voice_command(update, context, analysis)
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Принимает CSV-выписку и показывает предпросмотр импорта"""
+    if not is_allowed_user(update):
+        await update.message.reply_text('Нет доступа')
         return
+    user_id = update.effective_user.id
+    document = update.message.document
 
-    if analysis["type"] == "finance":
-        confidence = analysis.get('confidence', 1.0)
+    if not (document.file_name or '').lower().endswith('.csv'):
+        await update.message.reply_text("📄 Для импорта пришлите выписку в формате CSV.")
+        return
 
-        # Если уверенность низкая - запрашиваем подтверждение
-        if confidence < 0.7:
-            confirm_text = f"""
-❓ **Проверьте правильность:**
+    status = None
+    try:
+        status = StatusMessage(update.message, "📥 Читаю выписку и определяю категории...", delay=0)
+        telegram_file = await context.bot.get_file(document.file_id)
+        data = bytes(await telegram_file.download_as_bytearray())
+        prepared = await asyncio.to_thread(prepare_statement_import, data)
+    except ValueError as e:
+        if status is not None:
+            await status.finish(f"❌ Не удалось разобрать выписку: {e}")
+        else:
+            await update.message.reply_text(f"❌ Не удалось разобрать выписку: {e}")
+        return
+    except Exception as e:
+        logger.error(f"Ошибка импорта выписки: {e}")
+        if status is not None:
+            await status.finish("❌ Ошибка при чтении выписки.")
+        else:
+            await update.message.reply_text("❌ Ошибка при чтении выписки.")
+        return
 
-{source_info}
-🔄 Тип: {analysis['operation_type']}
-📂 Категория: {analysis['category']}
-📝 Описание: {analysis['description']}
-💰 Сумма: {analysis['amount']:,.0f} ₽
+    if not prepared['rows']:
+        await status.finish("📭 В выписке не найдено операций для импорта.\n\n" + format_import_preview(prepared), parse_mode='Markdown')
+        return
 
-✅ Записать? Или уточните что не так.
-            """
-            await update.message.reply_text(confirm_text, parse_mode='Markdown')
-            return
+    import_id = uuid.uuid4().hex[:8]
+    current_tenant().pending_imports[user_id] = {'id': import_id, 'rows': prepared['rows'], 'created': time.monotonic()}
+    keyboard = [[
+        InlineKeyboardButton("✅ Импортировать", callback_data=f"import_confirm_{import_id}"),
+        InlineKeyboardButton("❌ Отмена", callback_data=f"import_cancel_{import_id}")
+    ]]
+    await status.finish(format_import_preview(prepared), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
-        # Записываем операцию
-        if add_finance_record(analysis, user_id):
-            emoji = "📈" if analysis["operation_type"] == "Пополнение" else "📉"
-            response = f"""
-{emoji} **Финансовая операция записана:**
+async def confirm_import(update: Update, context: ContextTypes.DEFAULT_TYPE, import_id, confirmed):
+    """Записывает (или отменяет) подготовленный импорт после нажатия кнопки"""
+    query = update.callback_query
+    pending_imports = current_tenant().pending_imports
+    pending = pending_imports.get(update.effective_user.id)
+    if not pending or pending['id'] != import_id or time.monotonic() - pending['created'] > IMPORT_CONFIRM_MINUTES * 60:
+        await query.edit_message_text("⌛ Импорт устарел - пришлите выписку заново.")
+        return
+    del pending_imports[update.effective_user.id]
 
-{source_info}
-📅 Дата: {format_moscow_date()}
-🔄 Тип: {analysis['operation_type']}
-📂 Категория: {analysis['category']}
-📝 Описание: {analysis['description']}
-💰 Сумма: {analysis['amount']:,.0f} ₽
+    if not confirmed:
+        await query.edit_message_text("❌ Импорт отменен.")
+        return
 
-✅ **Записано в Google Таблицу!**
-            """
+    rows = pending['rows']
+    await query.edit_message_text(f"⏳ Записываю {len(rows)} операций...")
+    try:
+        started = time.monotonic()
+        count = await asyncio.to_thread(add_finance_records_bulk, rows)
+        record_timing("import.write", time.monotonic() - started)
+        increment_metric("import.rows", count)
+        await query.edit_message_text(f"✅ Импортировано операций: {count}")
+    except Exception as e:
+        logger.error(f"Ошибка записи импорта: {e}")
+        await query.edit_message_text("❌ Ошибка при записи операций. Часть строк могла записаться - проверьте таблицу.")
 
-            # Добавляем быстрые кнопки после записи операции
-            await update.message.reply_text(
-                response,
-                parse_mode='Markdown',
-                reply_markup=create_quick_buttons()
-            )
-        else:
-            await update.message.reply_text("❌ Ошибка при записи в таблицу финансов.")
+async def archive_partitions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Замораживает старые месячные разделы в локальный сжатый архив"""
+    if not is_allowed_user(update):
+        await update.message.reply_text('Нет доступа')
+        return
+    message = get_message_from_update(update)
 
-    else:  # clarification
-        suggestions = analysis.get('suggestions', [])
-        response = f"❓ {analysis.get('message', 'Не понял ваше сообщение.')}"
+    if not is_partitioned():
+        await message.reply_text("🗄 Архивация доступна только при разбиении по месяцам (LEDGER_PARTITIONING=month).")
+        return
 
-        if suggestions:
-            response += "\n\n💡 **Возможно, вы имели в виду:**\n"
-            for i, suggestion in enumerate(suggestions[:3], 1):
-                response += f"{i}. {suggestion}\n"
+    args = context.args or []
+    keep_months = int(args[0]) if args and args[0].isdigit() and int(args[0]) > 0 else 3
 
-        await update.message.reply_text(response, parse_mode='Markdown')
+    # Граница: первый день самого старого из оставляемых активными месяцев
+    boundary = get_moscow_time().date().replace(day=1)
+    for _ in range(keep_months - 1):
+        boundary = (boundary - timedelta(days=1)).replace(day=1)
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /start"""
-    welcome_text = """
-💰 **Умный финансовый помощник с ИИ!**
+    titles = [
+        entry['sheet'] for entry in get_partition_catalog()
+        if entry['end'] < boundary and entry['status'] != PARTITION_FROZEN and entry['sheet'] != PARTITION_UNDATED
+    ]
+    if not titles:
+        await message.reply_text(f"🗄 Нет разделов старше {boundary.strftime('%d.%m.%Y')} для архивации.")
+        return
 
-🎤 **Новинка: Голосовое управление!**
+    status = None
+    try:
+        status = StatusMessage(message, f"🗄 Архивирую разделов: {len(titles)}...", delay=0)
+        result = "🗄 **Архивация завершена:**\n\n"
+        for i, title in enumerate(titles, 1):
+            count = await asyncio.to_thread(freeze_partition, title)
+            result += f"• {title}: {count} записей\n"
+            if i < len(titles):
+                await status.progress(f"🗄 Архивировано {i} из {len(titles)}: {title}...")
+        await status.finish(result, parse_mode='Markdown')
 
-💸 **Записывайте операции:**
-• "Дал Петрову 40000 за работу"
-• "Таня лично 30000"
-• "Оплатил поставщику Интигаму 300000"
+    except Exception as e:
+        logger.error(f"Ошибка архивации: {e}")
+        if status is not None:
+            await status.finish("❌ Ошибка при архивации разделов.")
+        else:
+            await message.reply_text("❌ Ошибка при архивации разделов.")
 
-🗣️ **Управляйте голосом:**
-• 🎤 "Покажи траты за неделю"
-• 🎤 "Найди все операции с Петровым"
-• 🎤 "Анализ по категориям за месяц"
-• 🎤 "Когда платили Интигаму"
+async def show_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает метрики бота (вызовы ИИ, токены, задержки)"""
+    if not is_allowed_user(update):
+        await update.message.reply_text('Нет доступа')
+        return
+    message = get_message_from_update(update)
+    await message.reply_text(format_metrics_report(), parse_mode='Markdown')
 
-🏭 **11 категорий:**
-• Зарплаты, Учредители, Поставщики
-• Процент, Закупка товара, Материалы
-• Транспорт, Связь, Такси, Общественные, СВО
+async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик ошибок"""
+    logger.error(f"Ошибка: {context.error}")
 
-**Говорите естественно - бот всё поймет!**
+# Фоновые задачи (APScheduler) и задачи, которые выполняются прямо сейчас
+SCHEDULER = None
+RUNNING_JOBS = set()
+
+async def run_background_job(name, func, *args):
+    """Выполняет блокирующую задачу в потоке, не допуская наложения запусков.
+
+    Если предыдущий запуск еще не закончился (например, таблица отвечает медленно),
+    новый пропускается, а не встает в очередь.
     """
+    if name in RUNNING_JOBS:
+        increment_metric(f"job.{name}.skipped")
+        logger.warning(f"Фоновая задача {name} еще выполняется - пропускаю запуск")
+        return None
 
-    await update.message.reply_text(
-        welcome_text,
-        parse_mode='Markdown',
-        reply_markup=create_quick_buttons()
+    RUNNING_JOBS.add(name)
+    started = time.monotonic()
+    try:
+        return await asyncio.to_thread(func, *args)
+    except Exception as e:
+        increment_metric(f"job.{name}.errors")
+        logger.error(f"Ошибка фоновой задачи {name}: {e}")
+        return None
+    finally:
+        RUNNING_JOBS.discard(name)
+        record_timing(f"job.{name}", time.monotonic() - started)
+
+def refresh_ledger_and_reports():
+    """Перечитывает таблицу (или сверяет с ней локальную базу) и заранее строит отчеты /analytics"""
+    if uses_ledger_store():
+        # База общая для процессов: очередь отправляет и сверяет с таблицей только первый,
+        # иначе два процесса возьмут одни и те же записи очереди и добавят их в таблицу дважды
+        if WORKER_INDEX == 0:
+            replicate_ledger_outbox()
+            reconcile_ledger_store()
+    else:
+        refresh_ledger_snapshot()
+    refresh_recipient_index()
+    refresh_recipient_profiles()
+    if current_tenant().budgets:
+        # Счетчики бюджетов учитывают и ручные правки таблицы
+        build_budget_spending()
+    if current_tenant().duplicate_index is not None:
+        build_duplicate_index()
+    prerender_analytics_reports()
+
+def replicate_loaded_tenants():
+    """Отправляет в таблицы очереди outbox организаций с локальной базой"""
+    for tenant in list(LOADED_TENANTS.values()):
+        if tenant.store != 'sqlite' or tenant.db is None:
+            continue
+        CURRENT_TENANT.set(tenant)
+        try:
+            replicate_ledger_outbox()
+        except Exception as e:
+            increment_metric("job.replicate_ledger.errors")
+            logger.error(f"Ошибка отправки записей организации {tenant.name}: {e}")
+
+def refresh_loaded_tenants():
+    """Выгружает простаивающие организации и обновляет данные остальных"""
+    evict_idle_tenants(TENANT_IDLE_MINUTES * 60)
+    for tenant in list(LOADED_TENANTS.values()):
+        # Без get_tenant(): фоновое обновление не должно продлевать жизнь простаивающей организации
+        CURRENT_TENANT.set(tenant)
+        try:
+            refresh_ledger_and_reports()
+        except Exception as e:
+            increment_metric("job.refresh_ledger.errors")
+            logger.error(f"Ошибка обновления данных организации {tenant.name}: {e}")
+
+def build_morning_digest(tenant_name):
+    """Строит утреннюю сводку организации за вчерашний день"""
+    use_tenant(tenant_name)
+    yesterday = get_moscow_time().date() - timedelta(days=1)
+    report = build_analytics_report(get_finance_records(start=yesterday, end=yesterday), yesterday, yesterday, f"Сводка за {yesterday.strftime('%d.%m.%Y')}")
+    return report or f"☀️ Доброе утро! За {yesterday.strftime('%d.%m.%Y')} операций не было."
+
+async def refresh_ledger_job():
+    await run_background_job('refresh_ledger', refresh_loaded_tenants)
+
+async def replicate_ledger_job():
+    await run_background_job('replicate_ledger', replicate_loaded_tenants)
+
+async def morning_digest_job(application):
+    for tenant_name, config in TENANT_CONFIGS.items():
+        if not config.get('digest_chat_id'):
+            continue
+        digest = await run_background_job('morning_digest', build_morning_digest, tenant_name)
+        if digest:
+            await application.bot.send_message(chat_id=config['digest_chat_id'], text=digest, parse_mode='Markdown')
+
+async def start_scheduler(application):
+    """Запускает фоновые задачи вместе с приложением"""
+    global SCHEDULER
+    SCHEDULER = AsyncIOScheduler(timezone=MOSCOW_TZ)
+    job_defaults = {'max_instances': 1, 'coalesce': True, 'misfire_grace_time': 60}
+
+    # Первое обновление сразу прогревает данные организаций (в пределах лимита памяти)
+    for tenant_name in list(TENANT_CONFIGS)[:TENANT_CACHE_LIMIT]:
+        get_tenant(tenant_name)
+
+    SCHEDULER.add_job(
+        refresh_ledger_job, 'interval', minutes=LEDGER_REFRESH_MINUTES,
+        id='refresh_ledger', next_run_time=datetime.now(MOSCOW_TZ), **job_defaults
     )
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик текстовых сообщений с контекстом"""
-    if not is_allowed_user(update):
-        await update.message.reply_text('Нет доступа')
-        return
-    user_id = update.effective_user.id
-    user_message = update.message.text
+    # Остальные задачи выполняет только первый процесс, иначе сводка придет WORKER_COUNT раз
+    if WORKER_INDEX == 0 and any(config.get('store', LEDGER_STORE) == 'sqlite' for config in TENANT_CONFIGS.values()):
+        SCHEDULER.add_job(
+            replicate_ledger_job, 'interval', seconds=LEDGER_REPLICATION_SECONDS,
+            id='replicate_ledger', **job_defaults
+        )
 
-    # Показываем что бот думает
-    await update.message.reply_text("🤔 Анализирую с учетом контекста...")
+    if WORKER_INDEX == 0 and any(config.get('digest_chat_id') for config in TENANT_CONFIGS.values()):
+        hour, minute = (int(part) for part in DIGEST_TIME.split(':'))
+        SCHEDULER.add_job(
+            morning_digest_job, 'cron', hour=hour, minute=minute, args=[application],
+            id='morning_digest', **job_defaults
+        )
 
-    # Анализируем с контекстом
-    user_context = USER_CONTEXT.get(user_id)
-    analysis = analyze_message_with_ai(user_message, user_context)
+    SCHEDULER.start()
+    logger.info("Фоновые задачи запущены")
 
-    await process_analysis_result(update, analysis, user_id, context=context)
+async def stop_scheduler(application):
+    """Останавливает фоновые задачи при остановке приложения"""
+    if SCHEDULER and SCHEDULER.running:
+        SCHEDULER.shutdown(wait=False)
 
-async def show_context_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показывает историю с контекстом"""
-    if not is_allowed_user(update):
-        await update.message.reply_text('Нет доступа')
-        return
-    user_id = update.effective_user.id
+def main():
+    """Запуск продвинутого ИИ-бота"""
+    print("🚀 Запускаю продвинутый ИИ финансовый бот...")
+
+    if WORKER_COUNT > 1 and not (WEBHOOK_URL and STATE_BACKEND == 'redis'):
+        # Обновления делит между процессами роутер вебхука, а состояние должно быть общим
+        raise SystemExit("❌ Для WORKER_COUNT > 1 нужны WEBHOOK_URL и STATE_BACKEND=redis")
+    try:
+        shared_state()
+    except ImportError:
+        raise SystemExit("❌ Для STATE_BACKEND=redis установите модуль: pip install redis")
+
+    # Создаем приложение
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(start_scheduler)
+        .post_shutdown(stop_scheduler)
+        # Обновления разных чатов обрабатываются параллельно: долгий отчет не задерживает остальных
+        .concurrent_updates(UPDATE_CONCURRENCY)
+        # Пул соединений не меньше числа параллельных обработчиков, иначе ответы ждут в очереди
+        .connection_pool_size(max(TELEGRAM_POOL_SIZE, UPDATE_CONCURRENCY))
+        .pool_timeout(TELEGRAM_TIMEOUT_SECONDS)
+        .connect_timeout(TELEGRAM_TIMEOUT_SECONDS)
+        .read_timeout(TELEGRAM_TIMEOUT_SECONDS)
+        .write_timeout(TELEGRAM_TIMEOUT_SECONDS)
+        .build()
+    )
+
+    # Добавляем обработчики
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("search", advanced_search))
+    application.add_handler(CommandHandler("categories", category_analysis))
+    application.add_handler(CommandHandler("recipients", description_analysis))
+    application.add_handler(CommandHandler("suppliers", supplier_analysis))
+    application.add_handler(CommandHandler("history", show_context_history))
+    application.add_handler(CommandHandler("analytics", show_analytics))
+    application.add_handler(CommandHandler("trends", show_trends))
+    application.add_handler(CommandHandler("duplicates", show_duplicates))
+    application.add_handler(CommandHandler("backup", create_backup))
+    application.add_handler(CommandHandler("export", export_records))
+    application.add_handler(CommandHandler("import", import_statement))
+    application.add_handler(CommandHandler("stats", show_metrics))
+    application.add_handler(CommandHandler("archive", archive_partitions))
+    application.add_handler(CallbackQueryHandler(handle_callback_query))
+    application.add_handler(MessageHandler(filters.VOICE, handle_voice))
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_error_handler(error_handler)
+
+    # Запускаем бота
+    print("🧠 Продвинутый ИИ-бот готов к работе!")
+    print("🎤 Поддержка голосовых сообщений включена!")
+    print("🧠 Контекстное понимание активировано!")
+    print("📊 Умная аналитика доступна!")
+    print("🔍 Продвинутый поиск включен!")
+    
+    # Запускаем приложение: вебхук (за роутером webhook_router.py) или опрос
+    if WEBHOOK_URL:
+        print(f"🌐 Процесс {WORKER_INDEX + 1} из {WORKER_COUNT}, порт {WEBHOOK_PORT + WORKER_INDEX}")
+        application.run_webhook(
+            listen='127.0.0.1' if WORKER_COUNT > 1 else '0.0.0.0',
+            port=WEBHOOK_PORT + WORKER_INDEX,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Разбиение единого листа финансов (SHEET_NAME) на месячные разделы.
+
+Каждый месяц переносится на отдельный лист "Финансы ГГГГ-ММ", старые годы можно
+сложить в годовые листы "Финансы ГГГГ". Разделы записываются в лист "Каталог".
+Исходный лист не изменяется. Повторный запуск пропускает уже перенесенные разделы.
+
+Примеры:
+    python3 migrate_partitions.py --dry-run
+    python3 migrate_partitions.py --yearly-before 2024
+После миграции задайте переменную окружения LEDGER_PARTITIONING=month.
+"""
+
+import argparse
+from datetime import datetime, timedelta
+
+import gspread
+
+from main import (
+    use_tenant,
+    tenant_spreadsheet,
+    get_worksheet,
+    get_partition_catalog,
+    register_partition,
+    partition_title,
+    month_bounds,
+    parse_record_date,
+    PARTITION_UNDATED,
+    PARTITION_UNDATED_RANGE,
+    FINANCE_COLUMNS,
+    current_tenant
+)
+
+# Сколько строк переносить одним запросом append_rows
+APPEND_BATCH_SIZE = 1000
+
+# Дата в Google Sheets без форматирования - число дней от 30.12.1899
+SHEETS_EPOCH = datetime(1899, 12, 30)
+
+def normalize_date(value):
+    """Приводит дату ячейки к виду ДД.ММ.ГГГГ (или None, если это не дата)"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (SHEETS_EPOCH + timedelta(days=int(value))).strftime('%d.%m.%Y')
+    if parse_record_date(str(value).strip()):
+        return str(value).strip()
+    return None
+
+def plan_partitions(rows, yearly_before):
+    """Раскладывает строки по разделам: {лист: (начало, конец, строки)}"""
+    plan = {}
+    for row in rows:
+        row = list(row) + [''] * (len(FINANCE_COLUMNS) - len(row))
+        date_str = normalize_date(row[0])
+        if date_str is None:
+            title = PARTITION_UNDATED
+            start, end = PARTITION_UNDATED_RANGE
+        else:
+            row[0] = date_str
+            day = parse_record_date(date_str)
+            if yearly_before and day.year < yearly_before:
+                title = f"Финансы {day.year}"
+                start, end = day.replace(month=1, day=1), day.replace(month=12, day=31)
+            else:
+                title = partition_title(day)
+                start, end = month_bounds(day)
+        plan.setdefault(title, (start, end, []))[2].append(row[:len(FINANCE_COLUMNS)])
+    return dict(sorted(plan.items(), key=lambda item: item[1][0]))
+
+def main():
+    parser = argparse.ArgumentParser(description='Разбиение листа финансов на месячные разделы')
+    parser.add_argument('--dry-run', action='store_true', help='только показать план')
+    parser.add_argument('--yearly-before', type=int, default=None, help='годы раньше этого - в годовые листы')
+    parser.add_argument('--tenant', default=None, help='организация из реестра TENANTS_FILE (по умолчанию - первая)')
+    args = parser.parse_args()
+
+    tenant = use_tenant(args.tenant) if args.tenant else current_tenant()
+    print(f"📥 Читаю лист '{tenant.sheet_name}'...")
+    values = get_worksheet(tenant.sheet_name).get_all_values(value_render_option='UNFORMATTED_VALUE')
+    if not values or values[0][:len(FINANCE_COLUMNS)] != FINANCE_COLUMNS:
+        print("❌ Неожиданная структура листа - ожидаются колонки: " + ", ".join(FINANCE_COLUMNS))
+        return
+
+    plan = plan_partitions(values[1:], args.yearly_before)
+    for title, (start, end, rows) in plan.items():
+        print(f"• {title}: {len(rows)} строк ({start.strftime('%d.%m.%Y')} - {end.strftime('%d.%m.%Y')})")
+    print(f"\n📊 Разделов: {len(plan)}, строк: {sum(len(rows) for _, _, rows in plan.values())}")
+
+    if args.dry_run:
+        print("🧪 Пробный запуск - таблица не изменена.")
+        return
+
+    catalog = list(get_partition_catalog())
+    catalog_titles = {entry['sheet'] for entry in catalog}
+    existing_titles = {worksheet.title for worksheet in tenant_spreadsheet().worksheets()}
+
+    for title, (start, end, rows) in plan.items():
+        if title in catalog_titles:
+            print(f"⏭ {title}: уже в каталоге, пропускаю")
+            continue
+        overlapping = [
+            entry['sheet'] for entry in catalog
+            if entry['sheet'] != PARTITION_UNDATED and title != PARTITION_UNDATED
+            and entry['start'] <= end and entry['end'] >= start
+        ]
+        if overlapping:
+            print(f"⚠️ {title}: пересекается с разделами {', '.join(overlapping)} - пропускаю, чтобы не задвоить записи")
+            continue
+        if title in existing_titles:
+            # Лист мог остаться от прерванного запуска - переносим заново только пустой
+            worksheet = get_worksheet(title)
+            current_values = worksheet.get_all_values()
+            if len(current_values) > 1:
+                print(f"⚠️ {title}: лист уже содержит данные, но его нет в каталоге - проверьте вручную")
+                continue
+            if not current_values:
+                worksheet.append_row(FINANCE_COLUMNS)
+        else:
+            worksheet = get_worksheet(title, create=True)
+
+        for i in range(0, len(rows), APPEND_BATCH_SIZE):
+            worksheet.append_rows(rows[i:i + APPEND_BATCH_SIZE], value_input_option='RAW')
+        register_partition(title, start, end)
+        print(f"✅ {title}: перенесено {len(rows)} строк")
+
+    print("\n🎉 Миграция завершена. Включите разбиение: LEDGER_PARTITIONING=month")
+
+if __name__ == '__main__':
+    try:
+        main()
+    except gspread.exceptions.APIError as e:
+        print(f"❌ Ошибка Google Sheets: {e}")
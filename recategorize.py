@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Пакетная перекатегоризация исторических записей таблицы финансов.
+
+Сначала применяются локальные правила по ключевым словам, оставшиеся описания
+отправляются модели пачками с ограниченным числом одновременных запросов.
+Изменившиеся категории записываются обратно пакетными обновлениями диапазонов.
+
+Примеры:
+    python3 recategorize.py --dry-run          # показать изменения, ничего не записывая
+    python3 recategorize.py                    # записать изменения (продолжит прерванный запуск)
+    python3 recategorize.py --restart          # начать заново, забыв сохраненный прогресс
+"""
+
+import argparse
+import json
+import os
+
+from main import (
+    use_tenant,
+    get_worksheet,
+    partitions_for_range,
+    is_frozen_partition,
+    categorize_descriptions_in_bulk,
+    AI_BATCH_SIZE,
+    column_letter,
+    parse_amount,
+    logger
+)
+
+# Файл прогресса: ответы модели и номер строки (по каждому листу), до которой изменения уже записаны
+STATE_FILE = 'recategorize_state.json'
+
+# Сколько ячеек обновлять одним запросом batch_update
+WRITE_BATCH_SIZE = 500
+
+def load_state(path):
+    """Загружает сохраненный прогресс (или пустой)"""
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    return {'written_until_row': {}, 'ai_categories': {}}
+
+def save_state(path, state):
+    """Атомарно сохраняет прогресс, чтобы прерывание не испортило файл"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def collect_rows(values, start_row):
+    """Возвращает расходные строки таблицы: (номер строки, описание, текущая категория)"""
+    header = values[0]
+    description_col = header.index('Описание/Получатель')
+    category_col = header.index('Категория')
+    amount_col = header.index('Сумма')
+    comment_col = header.index('Комментарий') if 'Комментарий' in header else None
+
+    rows = []
+    for row_number, row in enumerate(values[1:], 2):
+        if row_number <= start_row:
+            continue
+        row = row + [''] * (len(header) - len(row))
+        description = row[description_col].strip()
+        if not description or (parse_amount(row[amount_col]) or 0) >= 0:
+            continue  # пополнения не категоризируются
+        if comment_col is not None and row[comment_col].strip():
+            description = f"{description} ({row[comment_col].strip()})"
+        rows.append((row_number, description, row[category_col]))
+    return rows, category_col + 1
+
+def main():
+    parser = argparse.ArgumentParser(description='Пакетная перекатегоризация записей таблицы финансов')
+    parser.add_argument('--dry-run', action='store_true', help='только показать изменения')
+    parser.add_argument('--chunk-size', type=int, default=AI_BATCH_SIZE, help='описаний в одном запросе к модели')
+    parser.add_argument('--concurrency', type=int, default=4, help='одновременных запросов к модели')
+    parser.add_argument('--state-file', default=STATE_FILE, help='файл прогресса для продолжения')
+    parser.add_argument('--restart', action='store_true', help='игнорировать сохраненный прогресс')
+    parser.add_argument('--tenant', default=None, help='организация из реестра TENANTS_FILE (по умолчанию - первая)')
+    args = parser.parse_args()
+
+    if args.tenant:
+        use_tenant(args.tenant)
+
+    state = {'written_until_row': {}, 'ai_categories': {}} if args.restart else load_state(args.state_file)
+    ai_categories = state['ai_categories']
+
+    # Замороженные разделы архива не меняются
+    sheet_rows = {}
+    for title in partitions_for_range():
+        if is_frozen_partition(title):
+            continue
+        print(f"📥 Загружаю лист '{title}'...")
+        start_row = state['written_until_row'].get(title, 1)
+        sheet_rows[title] = collect_rows(get_worksheet(title).get_all_values(), start_row)
+    rows = [row for title_rows, _ in sheet_rows.values() for row in title_rows]
+    print(f"📊 Расходных строк к проверке: {len(rows)}")
+
+    # Ответы модели из прерванного запуска используются повторно
+    descriptions = [description for _, description, _ in rows if description not in ai_categories]
+
+    def remember_chunk(chunk_result):
+        ai_categories.update({description: category for description, category in chunk_result.items() if category})
+        save_state(args.state_file, state)
+
+    categories = categorize_descriptions_in_bulk(
+        descriptions,
+        chunk_size=args.chunk_size,
+        concurrency=args.concurrency,
+        on_chunk_done=remember_chunk
+    )
+    categories.update(ai_categories)
+
+    changes = {}
+    unresolved = 0
+    for title, (title_rows, _) in sheet_rows.items():
+        for row_number, description, old_category in title_rows:
+            new_category = categories.get(description)
+            if not new_category:
+                unresolved += 1
+            elif new_category != old_category:
+                changes.setdefault(title, []).append((row_number, description, old_category, new_category))
+
+    for title, title_changes in changes.items():
+        for row_number, description, old_category, new_category in title_changes:
+            print(f"{title}, строка {row_number}: {description}: {old_category or '—'} → {new_category}")
+    total_changes = sum(len(title_changes) for title_changes in changes.values())
+    print(f"\n🔄 Изменений: {total_changes}, без категории: {unresolved}")
+
+    if args.dry_run:
+        print("🧪 Пробный запуск - таблица не изменена.")
+        return
+
+    for title, title_changes in changes.items():
+        worksheet = get_worksheet(title)
+        letter = column_letter(sheet_rows[title][1])
+        for i in range(0, len(title_changes), WRITE_BATCH_SIZE):
+            batch = title_changes[i:i + WRITE_BATCH_SIZE]
+            worksheet.batch_update([
+                {'range': f"{letter}{row_number}", 'values': [[new_category]]}
+                for row_number, _, _, new_category in batch
+            ])
+            state['written_until_row'][title] = batch[-1][0]
+            save_state(args.state_file, state)
+            logger.info(f"Перекатегоризация '{title}': записано {i + len(batch)} из {len(title_changes)}")
+
+    # Все строки обработаны - следующий запуск начнется с начала таблицы
+    if os.path.exists(args.state_file):
+        os.remove(args.state_file)
+    print("✅ Категории обновлены в Google Таблице!")
+
+if __name__ == '__main__':
+    main()
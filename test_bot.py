@@ -3,8 +3,12 @@
 Тестовый файл для проверки основных функций бота
 """
 
+import asyncio
 import sys
 import os
+import re
+import time
+from datetime import date, timedelta
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from main import (
@@ -15,8 +19,68 @@ from main import (
     parse_voice_command,
     extract_params_from_voice,
     parse_search_query,
-    matches_filters
+    matches_filters,
+    compile_search_query,
+    build_ai_messages,
+    validate_analysis,
+    categorize_locally,
+    render_analytics_period,
+    month_bounds,
+    partition_title,
+    search_date_range,
+    TenantState,
+    CURRENT_TENANT,
+    ledger_snapshot,
+    store_ledger_part,
+    LEDGER_SCHEMA,
+    add_to_ledger_store,
+    update_ledger_store,
+    query_ledger_store,
+    parse_export_args,
+    write_csv_export,
+    open_statement_text,
+    parse_bank_statement,
+    records_from_mappings,
+    parse_finance_record,
+    FinanceRecord,
+    RecipientIndex,
+    suggest_search_query,
+    compute_trends,
+    render_chart,
+    daily_expenses,
+    run_report,
+    ReportCancelled,
+    StatusMessage,
+    StreamedJson,
+    analyze_message_with_ai,
+    note_user_action,
+    predict_user_action,
+    Prefetch,
+    get_recent_finance_records,
+    read_sheet_rows,
+    add_finance_record,
+    HISTORY_COLUMNS,
+    rendered_key,
+    get_rendered,
+    store_rendered,
+    send_rendered,
+    MemoryState,
+    sync_shared_state,
+    publish_data_change,
+    update_user_context,
+    get_user_context,
+    budget_spending,
+    note_budget_spending,
+    budget_alert,
+    find_duplicate,
+    note_duplicate_key,
+    find_ledger_duplicates,
+    resolve_context_phrase
 )
+import csv
+import tempfile
+import sqlite3
+import main
 
 def test_basic_functions():
     """Тестирует основные функции"""
@@ -72,7 +136,7 @@ def test_search_functions():
     print("\n🔍 Тестирование функций поиска...")
     
     # Тестовые записи
-    test_records = [
+    test_records = records_from_mappings([
         {
             'Дата': '15.12.2024',
             'Описание/Получатель': 'Петров',
@@ -85,22 +149,1316 @@ def test_search_functions():
             'Категория': 'Оплата поставщику',
             'Сумма': -150000
         }
-    ]
+    ], 'тест')
     
     # Тест фильтров
     filters = parse_search_query("Петров")
     for record in test_records:
         matches = matches_filters(record, filters)
-        print(f"✅ Запись '{record['Описание/Получатель']}' соответствует фильтру 'Петров': {matches}")
+        print(f"✅ Запись '{record.description}' соответствует фильтру 'Петров': {matches}")
     
     print("🎉 Тесты поиска пройдены!")
 
+def test_compiled_search():
+    """Тестирует скомпилированные планы поиска: месяцы, годы, ИЛИ между категориями"""
+    print("\n🧭 Тестирование планов поиска...")
+
+    records = records_from_mappings([
+        {'Дата': '15.12.2024', 'Описание/Получатель': 'Петров', 'Категория': 'Зарплаты сотрудникам', 'Сумма': -40000},
+        {'Дата': '10.11.2024', 'Описание/Получатель': 'Яндекс', 'Категория': 'Такси', 'Сумма': -900},
+        {'Дата': '05.12.2023', 'Описание/Получатель': 'Интигам', 'Категория': 'Оплата поставщику', 'Сумма': -150000},
+    ], 'тест')
+
+    def found(query):
+        _, predicate = compile_search_query(query)
+        return [record.description for record in records if predicate(record)]
+
+    assert found("декабрь") == ['Петров', 'Интигам']
+    assert found("2024") == ['Петров', 'Яндекс']
+    assert found("декабря 2023") == ['Интигам']
+    assert found("зарплаты или такси") == ['Петров', 'Яндекс']
+    assert found("зарплаты|такси 2024 <1000") == ['Яндекс']
+    assert found("поставщик >100000") == ['Интигам']
+    assert found("петров декабрь") == ['Петров']
+
+    # Планы запоминаются по строке запроса
+    assert compile_search_query("Петров декабрь") is compile_search_query("петров декабрь")
+
+    # Старый интерфейс фильтров работает так же
+    filters = parse_search_query("такси 2024")
+    compiled = main._compile_frozen_filters.cache_info().misses
+    assert [matches_filters(record, filters) for record in records] == [False, True, False]
+    assert main._compile_frozen_filters.cache_info().misses == compiled + 1  # один план на все записи
+
+    # Строка текстового поиска считается один раз и хранится в записи
+    assert records[1].search_text == "яндекс такси" and records[1].search_text is records[1].search_text
+
+    print("✅ Месяцы, годы и ИЛИ между категориями распознаются")
+    print("🎉 Тесты планов поиска пройдены!")
+
+def legacy_parse_voice_command(text):
+    """Прежняя цепочка if из parse_voice_command - эталон приоритетов"""
+    text_lower = text.lower()
+    chain = [
+        ('recipients', ['кому платили', 'анализ получателей', 'по получателям', 'кому больше', 'топ получателей']),
+        ('suppliers', ['анализ поставщика', 'по поставщику', 'история с', 'поставщик']),
+        ('analytics', ['анализ', 'аналитика', 'отчет', 'покажи траты', 'сколько потратили']),
+        ('search', ['найди', 'найти', 'поиск', 'покажи операции', 'когда платили']),
+        ('categories', ['по категориям', 'категории', 'расходы по']),
+        ('history', ['история', 'последние операции', 'что было']),
+        ('backup', ['бэкап', 'резервная копия', 'сохрани', 'backup']),
+    ]
+    for command, phrases in chain:
+        if any(phrase in text_lower for phrase in phrases):
+            return command
+    return None
+
+def legacy_extract_params(text, command_type):
+    """Прежняя реализация extract_params_from_voice - эталон извлечения параметров"""
+    text_lower = text.lower()
+    params = {}
+    if command_type == 'suppliers':
+        patterns = [
+            r'поставщика\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?)',
+            r'поставщику\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?)',
+            r'история\s+с\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?)',
+            r'по\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?)',
+            r'анализ\s+([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?)'
+        ]
+        known = {'интигаму': 'Интигам', 'интигама': 'Интигам', 'балтики': 'Балтика', 'балтике': 'Балтика',
+                 'балтику': 'Балтика', 'петрову': 'Петров', 'петрова': 'Петров', 'рустаму': 'Рустам', 'рустама': 'Рустам'}
+        for pattern in patterns:
+            match = re.search(pattern, text, re.IGNORECASE)
+            if match:
+                name = match.group(1).strip()
+                if name.lower() in known:
+                    params['name'] = known[name.lower()]
+                elif name.endswith('у') or name.endswith('а') or name.endswith('е'):
+                    params['name'] = name[:-1]
+                else:
+                    params['name'] = name
+                break
+    if 'name' not in params:
+        names = re.findall(r'\b[А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?\b', text)
+        if names:
+            name = names[0]
+            params['name'] = name[:-1] if name[-1] in 'уае' else name
+    months = ['январь', 'февраль', 'март', 'апрель', 'май', 'июнь', 'июль', 'август', 'сентябрь', 'октябрь', 'ноябрь', 'декабрь']
+    if any(word in text_lower for word in ['неделя', 'неделю']):
+        params['period'] = 'неделя'
+    elif 'месяц' in text_lower:
+        params['period'] = 'месяц'
+    else:
+        for month in months:
+            if month in text_lower:
+                params['period'] = month
+                break
+    if any(word in text_lower for word in ['зарплат', 'зарплаты']):
+        params['category'] = 'зарплаты'
+    elif any(word in text_lower for word in ['поставщик', 'поставщиков']):
+        params['category'] = 'поставщик'
+    elif any(word in text_lower for word in ['процент', 'проценты']):
+        params['category'] = 'процент'
+    return params
+
+VOICE_FIXTURES = [
+    "покажи траты за неделю",
+    "анализ поставщика Интигам",
+    "найди все операции с Петровым",
+    "по категориям за месяц",
+    "Кому платили больше всего в декабрь",
+    "анализ получателей за месяц",
+    "расходы по получателям",
+    "топ получателей за неделю",
+    "история с Балтикой",
+    "оплата по поставщику Рустаму",
+    "сколько потратили на такси",
+    "Покажи операции за март",
+    "когда платили Интигаму",
+    "расходы по категориям",
+    "последние операции",
+    "что было вчера",
+    "сделай бэкап",
+    "резервная копия пожалуйста",
+    "сохрани данные",
+    "BACKUP now",
+    "отчет по зарплатам за май",
+    "анализ по Петрову",
+    "найти проценты за январь",
+    "история операций",
+    "анализ Сидорова за неделю",
+    "поставщиков за сентябрь покажи",
+    "категории за август",
+    "дал Петрову 40000 за работу",
+    "Таня лично 30000",
+    "оплатил поставщику Интигаму 300000",
+    "найди зарплаты и проценты за ноябрь и декабрь",
+    "аналитика за месяц и неделю",
+    "кому больше платили по поставщику Балтике",
+    "поиск по Рустаму",
+    "что было в октябрь",
+    "покажи операции с поставщиком Интигам",
+    "просто текст без команды",
+    "",
+]
+
+def test_voice_matcher_matches_legacy_chain():
+    """Проверяет, что однопроходный разбор голосовых команд совпадает с прежней цепочкой if"""
+    print("\n🎤 Тестирование однопроходного разбора голосовых команд...")
+
+    for text in VOICE_FIXTURES:
+        result = parse_voice_command(text)
+        command = result['command'] if result else None
+        assert command == legacy_parse_voice_command(text), text
+
+        for command_type in ['suppliers', 'search', 'categories']:
+            assert extract_params_from_voice(text, command_type) == legacy_extract_params(text, command_type), (text, command_type)
+
+    print(f"✅ {len(VOICE_FIXTURES)} фраз разобраны так же, как раньше")
+    print("🎉 Тесты голосовых команд пройдены!")
+
+def test_ai_prompt_and_schema():
+    """Проверяет стабильный префикс запроса к ИИ и валидацию ответа по схеме"""
+    print("\n🧠 Тестирование запроса и схемы ответа ИИ...")
+
+    first = build_ai_messages("такси 500")
+    second = build_ai_messages("дал Петрову 40000", {'recent_operations': ['Петров: -40,000 ₽ (Зарплаты сотрудникам)']})
+    assert first[0] == second[0], "системный префикс должен быть одинаковым"
+    assert second[1]['content'].endswith('Сообщение: "дал Петрову 40000"')
+
+    result = validate_analysis({
+        "type": "finance", "operation_type": "Расход", "amount": 40000,
+        "category": "Зарплаты сотрудникам", "description": " Петров ", "confidence": 0.9
+    })
+    assert result['amount'] == -40000 and result['description'] == 'Петров' and result['comment'] == ''
+
+    clarification = validate_analysis({"type": "clarification", "message": "Кому?"})
+    assert clarification['suggestions'] == []
+
+    for broken in [
+        [],
+        {"type": "finance", "operation_type": "Расход", "amount": "много", "category": "Такси", "description": "Такси"},
+        {"type": "finance", "operation_type": "Расход", "amount": -500, "category": "Еда", "description": "Обед"},
+        {"type": "unknown"},
+    ]:
+        try:
+            validate_analysis(broken)
+        except ValueError:
+            continue
+        raise AssertionError(f"ответ должен быть отклонен: {broken}")
+
+    print("✅ Префикс стабилен, ответы проверяются по схеме")
+    print("🎉 Тесты ИИ-запроса пройдены!")
+
+def test_local_categorization():
+    """Тестирует локальные правила категорий, которые применяются до обращения к ИИ"""
+    print("\n🏷️ Тестирование локальных правил категорий...")
+
+    assert categorize_locally("Яндекс такси") == "Такси"
+    assert categorize_locally("Таня лично") == "Выплаты учредителям"
+    assert categorize_locally("Бензин") == "Транспорт"
+    assert categorize_locally("Интернет в офис") == "Связь"
+    assert categorize_locally("СВО") == "Благотворительность"
+    assert categorize_locally("Свой человек") is None
+    assert categorize_locally("Петров") is None
+
+    print("✅ Ключевые слова распознаются, имена остаются модели")
+    print("🎉 Тесты локальных правил пройдены!")
+
+def test_analytics_periods():
+    """Тестирует отчеты /analytics за день, неделю и месяц"""
+    print("\n📊 Тестирование периодов аналитики...")
+
+    records = records_from_mappings([
+        {'Дата': '15.12.2024', 'Описание/Получатель': 'Петров', 'Категория': 'Зарплаты сотрудникам', 'Сумма': -40000},
+        {'Дата': '10.12.2024', 'Описание/Получатель': 'Яндекс', 'Категория': 'Такси', 'Сумма': -700},
+        {'Дата': '20.11.2024', 'Описание/Получатель': 'Снял', 'Категория': '-', 'Сумма': 100000},
+        {'Дата': 'вчера', 'Описание/Получатель': 'Без даты', 'Категория': 'Такси', 'Сумма': -1},
+    ], 'тест')
+    today = date(2024, 12, 15)
+
+    day = render_analytics_period(records, 'день', today)
+    assert 'Операций: 1' in day and 'Средние траты в день:** 40,000' in day
+
+    week = render_analytics_period(records, 'неделя', today)
+    assert 'Операций: 2' in week
+
+    month = render_analytics_period(records, 'месяц', today)
+    assert 'Операций: 3' in month and 'Доходы: +100,000' in month
+
+    assert render_analytics_period(records, 'день', date(2025, 1, 1)) is None
+
+    # Готовый отчет отдается без чтения записей
+    tenant = TenantState("test", {'spreadsheet_id': 'test-sheet'})
+    token = CURRENT_TENANT.set(tenant)
+    original_get = main.get_finance_records
+    try:
+        tenant.reports['неделя'] = (ledger_snapshot()['version'], date.today(), "📊 готово")
+
+        def unexpected_read(*args, **kwargs):
+            raise AssertionError("готовый отчет не должен читать записи")
+        main.get_finance_records = unexpected_read
+        assert main.get_analytics_report('неделя') == "📊 готово"
+    finally:
+        main.get_finance_records = original_get
+        CURRENT_TENANT.reset(token)
+
+    print("✅ Отчеты строятся за нужные периоды")
+    print("🎉 Тесты аналитики пройдены!")
+
+def test_partition_ranges():
+    """Тестирует границы месячных разделов и периоды, которые читает поиск"""
+    print("\n🗂 Тестирование разделов по месяцам...")
+
+    assert month_bounds(date(2024, 2, 10)) == (date(2024, 2, 1), date(2024, 2, 29))
+    assert month_bounds(date(2024, 12, 31)) == (date(2024, 12, 1), date(2024, 12, 31))
+    assert partition_title(date(2024, 3, 5)) == "Финансы 2024-03"
+
+    today = date(2024, 12, 15)
+    assert search_date_range(parse_search_query("петров"), today) == (None, None)
+    assert search_date_range(parse_search_query("неделя"), today) == (date(2024, 12, 9), None)
+    assert search_date_range(parse_search_query("2023 или 2024"), today) == (date(2023, 1, 1), date(2024, 12, 31))
+    assert search_date_range(parse_search_query("декабрь"), today) == (None, None)
+
+    print("✅ Поиск читает только пересекающиеся разделы")
+    print("🎉 Тесты разделов пройдены!")
+
+def test_tenant_record_budget():
+    """Тестирует бюджет памяти снимка данных организации"""
+    print("\n🏢 Тестирование бюджета памяти организации...")
+
+    tenant = TenantState("test", {'spreadsheet_id': 'test-sheet'})
+    token = CURRENT_TENANT.set(tenant)
+    saved_budget = main.TENANT_RECORD_BUDGET
+    main.TENANT_RECORD_BUDGET = 5
+    try:
+        store_ledger_part("Финансы 2024-10", [{'Сумма': -1}] * 3)
+        store_ledger_part("Финансы 2024-11", [{'Сумма': -2}] * 2)
+        assert list(ledger_snapshot()['parts']) == ["Финансы 2024-10", "Финансы 2024-11"]
+
+        # Сверх бюджета вытесняется давно не читанный лист
+        store_ledger_part("Финансы 2024-12", [{'Сумма': -3}] * 2)
+        assert list(ledger_snapshot()['parts']) == ["Финансы 2024-11", "Финансы 2024-12"]
+
+        # Только что прочитанный лист остается, даже если сам больше бюджета
+        store_ledger_part("Финансы 2025-01", [{'Сумма': -4}] * 7)
+        assert list(ledger_snapshot()['parts']) == ["Финансы 2025-01"]
+        assert ledger_snapshot()['version'] == 4
+    finally:
+        main.TENANT_RECORD_BUDGET = saved_budget
+        CURRENT_TENANT.reset(token)
+
+    print("✅ Снимок не выходит за бюджет")
+    print("🎉 Тесты организаций пройдены!")
+
+def test_ledger_store_queries():
+    """Тестирует локальную базу операций: отбор по индексам и очередь отправки в таблицу"""
+    print("\n🗄 Тестирование локальной базы операций...")
+
+    tenant = TenantState("test", {'spreadsheet_id': 'test-sheet', 'store': 'sqlite'})
+    tenant.db = sqlite3.connect(':memory:')
+    tenant.db.executescript(LEDGER_SCHEMA)
+    tenant.store_ready = True
+    token = CURRENT_TENANT.set(tenant)
+    try:
+        add_to_ledger_store(['01.12.2024', 'Расход', 'Такси', 'Яндекс', -500, ''])
+        key = add_to_ledger_store(['05.12.2024', 'Расход', 'Оплата поставщику', 'Интигам', '-1500', ''])
+        add_to_ledger_store(['без даты', 'Пополнение', '-', 'Касса', 1000, ''])
+
+        assert [record.description for record in query_ledger_store()] == ['Яндекс', 'Интигам', 'Касса']
+        assert query_ledger_store(category='Оплата поставщику')[0].amount == -1500
+        assert [record.description for record in query_ledger_store(start=date(2024, 12, 2))] == ['Интигам']
+        assert query_ledger_store(recipient='  ЯНДЕКС')[0].category == 'Такси'
+        assert [record.description for record in query_ledger_store(limit=2)] == ['Интигам', 'Касса']
+
+        update_ledger_store(key, ['05.12.2024', 'Расход', 'Оплата поставщику', 'Интигам', -1700, ''])
+        outbox = tenant.db.execute("SELECT action FROM outbox ORDER BY id").fetchall()
+        assert [action for action, in outbox] == ['append', 'append', 'append', 'update']
+        assert tenant.ledger['version'] == 4
+    finally:
+        CURRENT_TENANT.reset(token)
+
+    print("✅ Записи отбираются по дате, категории и получателю")
+    print("🎉 Тесты локальной базы пройдены!")
+
+def test_export_periods_and_csv():
+    """Тестирует разбор периода /export и потоковую запись CSV"""
+    print("\n📤 Тестирование выгрузки...")
+
+    today = date(2024, 12, 15)
+    assert parse_export_args([], today) == (date(2024, 11, 1), date(2024, 11, 30), 'csv')
+    assert parse_export_args(['2024-02', 'xlsx'], today) == (date(2024, 2, 1), date(2024, 2, 29), 'xlsx')
+    assert parse_export_args(['декабрь'], today)[:2] == (date(2024, 12, 1), date(2024, 12, 31))
+    assert parse_export_args(['январь'], today)[:2] == (date(2024, 1, 1), date(2024, 1, 31))
+    assert parse_export_args(['месяц', 'Excel'], today) == (date(2024, 12, 1), today, 'xlsx')
+    assert parse_export_args(['все', 'parquet'], today) == (None, None, 'parquet')
+    try:
+        parse_export_args(['вчерашний'], today)
+        assert False, "неизвестный аргумент должен отклоняться"
+    except ValueError:
+        pass
+
+    chunks = [
+        records_from_mappings([{'Дата': '01.11.2024', 'Тип операции': 'Расход', 'Категория': 'Такси', 'Описание/Получатель': 'Яндекс', 'Сумма': -500, 'Комментарий': ''}], 'тест'),
+        records_from_mappings([{'Дата': '02.11.2024', 'Тип операции': 'Расход', 'Категория': 'Связь', 'Описание/Получатель': 'МТС; тариф', 'Сумма': '-300,5'}], 'тест')
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'export.csv')
+        assert write_csv_export(iter(chunks), path) == 2
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            rows = list(csv.reader(f, delimiter=';'))
+    assert rows[0][0] == 'Дата' and rows[1][4] == '-500'
+    assert rows[2] == ['02.11.2024', 'Расход', 'Связь', 'МТС; тариф', '-300,5', '']
+
+    print("✅ Период и формат выгрузки разбираются, CSV пишется пачками")
+    print("🎉 Тесты выгрузки пройдены!")
+
+def test_bank_statement_parsing():
+    """Тестирует разбор CSV-выписок: кодировка, разделитель, колонки и суммы"""
+    print("\n📥 Тестирование импорта выписок...")
+
+    statement = (
+        "Дата операции;Контрагент;Назначение платежа;Расход;Приход\n"
+        "01.11.2024 10:15;ООО Ромашка;Оплата по счету 15;12 500,00;\n"
+        "итого;;;;\n"
+        "02.11.2024;Касса;Снятие наличных;;3 000,00\n"
+    ).encode('cp1251')
+    operations, skipped = parse_bank_statement(open_statement_text(statement))
+    assert operations == [
+        {'date': '01.11.2024', 'amount': -12500.0, 'description': 'ООО Ромашка', 'comment': 'Оплата по счету 15'},
+        {'date': '02.11.2024', 'amount': 3000.0, 'description': 'Касса', 'comment': 'Снятие наличных'}
+    ]
+    assert skipped == [3]
+
+    statement = 'Date,Amount,Description\n2024-11-01,"-1,500.00",Uber\n'.encode('utf-8-sig')
+    operations, _ = parse_bank_statement(open_statement_text(statement))
+    assert operations == [{'date': '01.11.2024', 'amount': -1500.0, 'description': 'Uber', 'comment': ''}]
+
+    # Европейская запись: точка отделяет тысячи, запятая - копейки
+    statement = 'Дата;Сумма;Получатель\n01.11.2024;-1.500,00;Ромашка\n02.11.2024;1.234.567,89;Касса\n'.encode()
+    operations, _ = parse_bank_statement(open_statement_text(statement))
+    assert [operation['amount'] for operation in operations] == [-1500.0, 1234567.89]
+
+    try:
+        parse_bank_statement(open_statement_text("Получатель;Сумма\nИван;100\n".encode()))
+        assert False, "выписка без даты должна отклоняться"
+    except ValueError:
+        pass
+
+    # Нераспознанный при импорте расход получает одну из категорий таблицы
+    assert main.IMPORT_UNKNOWN_CATEGORY in main.FINANCE_CATEGORIES
+
+    print("✅ Выписки разбираются в операции")
+    print("🎉 Тесты импорта пройдены!")
+
+def test_finance_record_parsing():
+    """Тестирует разбор строк таблицы в записи: даты, суммы и ошибки разбора"""
+    print("\n🧾 Тестирование разбора записей...")
+
+    record, problem = parse_finance_record(['01.12.2024', 'Расход', 'Такси', 'Яндекс', '-1 500,50', ''])
+    assert problem is None
+    assert record.day == date(2024, 12, 1) and record.amount == -1500.5
+    assert record.as_dict()['Описание/Получатель'] == 'Яндекс'
+
+    record, problem = parse_finance_record(['вчера', 'Расход', 'Такси', 'Яндекс', 'много'])
+    assert record.day is None and record.amount == 0.0 and record.comment == ''
+    assert problem == "дата «вчера», сумма «много»"
+
+    # Одинаковые строки разных записей хранятся один раз
+    first, _ = parse_finance_record(['01.12.2024', 'Расход', 'Зарплаты ' + 'сотрудникам', 'Петров', -1])
+    second, _ = parse_finance_record(['02.12.2024', 'Расход', ''.join(['Зарплаты ', 'сотрудникам']), 'Петров', -2])
+    assert first.category is second.category
+    assert not hasattr(first, '__dict__')
+    assert first == FinanceRecord('01.12.2024', date(2024, 12, 1), 'Расход', 'Зарплаты сотрудникам', 'Петров', -1.0)
+
+    print("✅ Записи разбираются один раз, ошибки видны")
+    print("🎉 Тесты разбора записей пройдены!")
+
+def test_recipient_index():
+    """Тестирует указатель получателей: падежные формы приводятся к имени из таблицы"""
+    print("\n👥 Тестирование указателя получателей...")
+
+    index = RecipientIndex()
+    for description, count in [('Рустам', 40), ('Рустаму', 1), ('ООО Балтика', 5), ('Петров', 10), ('Петрова', 8), ('Мария', 2)]:
+        index.add(description, count)
+
+    assert index.resolve_word('Рустаму') == 'Рустам'  # редкая запись с окончанием уходит к основной
+    assert index.resolve_word('балтике') == 'Балтика'
+    assert index.resolve_word('Петровым') == 'Петров'
+    assert index.resolve_word('Петрова') == 'Петрова'  # сама записана в таблице
+    assert index.resolve_word('Марией') == 'Мария'
+    assert index.resolve_word('Сидорову') is None
+    assert index.resolve_name('Рустама') == 'Рустам' and index.resolve_name('Рустаму Сидорову') is None
+    # При группировке записанные в таблице слова остаются собой: "Петрова" - не "Петров"
+    assert index.canonical_description('Рустаму') == 'Рустаму'
+    assert index.canonical_description('Рустаму Петровой') == 'Рустаму Петрова'
+    assert index.canonical_description('ооо балтика') == 'ооо балтика'
+    grouping = RecipientIndex()
+    grouping.add('Петров', 30)
+    grouping.add('Петрова', 5)
+    assert grouping.canonical_description('Петрова') == 'Петрова'
+
+    # Новый получатель виден сразу, версия меняется (планы поиска строятся заново)
+    version = index.version
+    index.add('Интигам')
+    assert index.resolve_word('Интигаму') == 'Интигам' and index.version != version
+
+    tenant = TenantState("test", {'spreadsheet_id': 'test-sheet'})
+    tenant.recipient_index = index
+    token = CURRENT_TENANT.set(tenant)
+    try:
+        assert extract_params_from_voice("анализ поставщику Балтике", "suppliers", index)['name'] == 'Балтика'
+        assert extract_params_from_voice("найди Петровым за неделю", "search", index)['name'] == 'Петров'
+        filters, _ = compile_search_query("рустаму декабрь", index)
+        assert filters['text'] == ['рустам']
+    finally:
+        CURRENT_TENANT.reset(token)
+
+    # Указатель организации собирается из уже прочитанных листов, без чтения таблицы
+    tenant = TenantState("test", {'spreadsheet_id': 'test-sheet'})
+    token = CURRENT_TENANT.set(tenant)
+    try:
+        december = records_from_mappings([{'Дата': '15.12.2024', 'Описание/Получатель': 'Петров', 'Сумма': -1}], 'тест')
+        assert main.recipient_index().resolve_word('Петрову') is None
+        store_ledger_part("Финансы 2024-12", december)
+        assert main.recipient_index().resolve_word('Петрову') == 'Петров'
+        store_ledger_part("Финансы 2024-11", records_from_mappings([{'Дата': '15.11.2024', 'Описание/Получатель': 'Рустам', 'Сумма': -1}], 'тест'))
+        index = main.recipient_index()
+        assert index.resolve_word('Рустаму') == 'Рустам' and index.sources == {"Финансы 2024-12", "Финансы 2024-11"}
+        # Измененный лист сбрасывает указатель - он собирается заново из снимка
+        store_ledger_part("Финансы 2024-12", records_from_mappings([{'Дата': '15.12.2024', 'Описание/Получатель': 'Мария', 'Сумма': -1}], 'тест'))
+        assert main.recipient_index() is not index and main.recipient_index().resolve_word('Петрову') is None
+    finally:
+        CURRENT_TENANT.reset(token)
+
+    print("✅ Падежные формы находят получателей из таблицы")
+    print("🎉 Тесты указателя получателей пройдены!")
+
+def test_fuzzy_recipient_matching():
+    """Тестирует поиск похожих имен по триграммам и подсказку «Возможно, вы имели в виду»"""
+    print("\n🔤 Тестирование нечеткого поиска получателей...")
+
+    records = records_from_mappings([
+        {'Дата': '10.12.2024', 'Описание/Получатель': 'Интигам', 'Категория': 'Оплата поставщику', 'Сумма': -150000},
+        {'Дата': '15.12.2024', 'Описание/Получатель': 'Петров', 'Категория': 'Зарплаты сотрудникам', 'Сумма': -40000},
+        {'Дата': '20.12.2024', 'Описание/Получатель': 'ООО Балтика', 'Категория': 'Оплата поставщику', 'Сумма': -9000},
+    ], 'тест')
+    index = RecipientIndex()
+    for record in records:
+        index.add(record.description)
+
+    assert index.similar_words('Интегам')[0][0] == 'Интигам'
+    assert index.similar_words('Интегаму')[0][0] == 'Интигам'
+    assert index.similar_words('Сидоров') == []
+    # Латинская "o" в русском слове не мешает точному совпадению
+    assert index.resolve_word('Петрoв') == 'Петров'
+    assert index.suggest(['интегам', 'декабрь']) == 'Интигам декабрь'
+    assert index.suggest(['петров']) is None
+
+    tenant = TenantState("test", {'spreadsheet_id': 'test-sheet'})
+    tenant.recipient_index = index
+    token = CURRENT_TENANT.set(tenant)
+    try:
+        assert suggest_search_query("интегам декабрь", records, index) == 'Интигам декабрь'
+        assert suggest_search_query("балтка 2023", records, index) is None  # исправленный запрос тоже ничего не находит
+        _, predicate = compile_search_query("петрoв", index)
+        assert [record.description for record in records if predicate(record)] == ['Петров']
+    finally:
+        CURRENT_TENANT.reset(token)
+
+    print("✅ Опечатки в именах находят получателей из таблицы")
+    print("🎉 Тесты нечеткого поиска пройдены!")
+
+def test_trends():
+    """Тестирует /trends: динамику по месяцам, выбросы и регулярные платежи"""
+    print("\n📈 Тестирование трендов...")
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        print("⏭ numpy не установлен - пропускаю")
+        return
+
+    mappings = []
+    for month in range(1, 13):
+        mappings.append({'Дата': f"15.{month:02d}.2024", 'Категория': 'Зарплаты сотрудникам',
+                         'Описание/Получатель': 'Петров', 'Сумма': -120000 if month == 12 else -40000})
+        mappings.append({'Дата': f"03.{month:02d}.2024", 'Категория': 'Такси',
+                         'Описание/Получатель': 'Яндекс', 'Сумма': -1000 * month})
+    mappings.append({'Дата': '20.06.2024', 'Категория': 'Материалы', 'Описание/Получатель': 'Леруа', 'Сумма': -5000})
+    trends = compute_trends(records_from_mappings(mappings, 'тест'), date(2025, 1, 10))
+
+    # Январь 2025 еще не закончился - последний показанный месяц декабрь
+    month, total, rolling = trends['months'][-1]
+    assert (month % 12 + 1, month // 12) == (12, 2024)
+    assert total == 132000 and round(rolling) == round((50000 + 51000 + 132000) / 3)
+    assert trends['categories'][0][:3] == ('Зарплаты сотрудникам', 120000, 40000)
+    assert round(trends['categories'][0][3]) == 200
+
+    assert [(date_str, recipient) for date_str, recipient, *_ in trends['outliers']] == [('15.12.2024', 'Петров')]
+    recurring = {recipient: next_date for recipient, _, _, next_date in trends['recurring']}
+    assert set(recurring) == {'Петров', 'Яндекс'}  # разовая покупка не регулярна
+    assert date(2025, 1, 10) <= recurring['Петров'] <= date(2025, 1, 20)
+
+    assert compute_trends([], date(2025, 1, 10)) is None
+
+    # Готовый отчет отдается без чтения записей
+    def unexpected_read(*args, **kwargs):
+        raise AssertionError("готовый отчет не должен читать записи")
+
+    tenant = TenantState("test", {'spreadsheet_id': 'test-sheet'})
+    tenant.reports['trends'] = (tenant.ledger['version'], date.today(), "📈 готовый")
+    token = CURRENT_TENANT.set(tenant)
+    original_get = main.get_finance_records
+    main.get_finance_records = unexpected_read
+    try:
+        assert main.get_trends_report() == "📈 готовый"
+    finally:
+        main.get_finance_records = original_get
+        CURRENT_TENANT.reset(token)
+
+    print("✅ Динамика, выбросы и регулярные платежи считаются")
+    print("🎉 Тесты трендов пройдены!")
+
+def test_charts():
+    """Тестирует графики PNG: рисование в пуле процессов и кэш по версии данных"""
+    print("\n🖼 Тестирование графиков...")
+    try:
+        import matplotlib  # noqa: F401
+    except ImportError:
+        print("⏭ matplotlib не установлен - пропускаю")
+        return
+
+    records = records_from_mappings([
+        {'Дата': '01.12.2024', 'Категория': 'Такси', 'Описание/Получатель': 'Яндекс', 'Сумма': -900},
+        {'Дата': '03.12.2024', 'Категория': 'Связь', 'Описание/Получатель': 'МТС', 'Сумма': -500},
+        {'Дата': '03.12.2024', 'Категория': 'Связь', 'Описание/Получатель': 'МТС', 'Сумма': 500},
+    ], 'тест')
+    labels, values = daily_expenses(records, date(2024, 12, 1), date(2024, 12, 4))
+    assert labels == ['01.12', '02.12', '03.12', '04.12'] and values == [900, 0, 500, 0]
+
+    tenant = TenantState("test", {'spreadsheet_id': 'test-sheet'})
+    token = CURRENT_TENANT.set(tenant)
+    try:
+        async def draw():
+            return await render_chart('analytics', 'неделя', 'line', 'Расходы по дням', labels, values)
+
+        first = asyncio.run(draw())
+        assert first.startswith(b'\x89PNG')
+        # Процессы пула не копируют бота с его потоками (fork), а запускаются заново
+        assert main.chart_pool()._mp_context.get_start_method() == 'spawn'
+        hits = main.METRICS_COUNTERS.get('charts.cache_hits', 0)
+        assert asyncio.run(draw()) is first  # повторное нажатие - картинка из кэша
+        assert main.METRICS_COUNTERS['charts.cache_hits'] == hits + 1
+
+        # Данные изменились - график рисуется заново
+        ledger_snapshot()['version'] += 1
+        assert asyncio.run(draw()) is not first
+        assert main.METRICS_TIMINGS['charts.render.analytics']['count'] >= 2
+    finally:
+        CURRENT_TENANT.reset(token)
+
+    print("✅ Графики рисуются вне бота и берутся из кэша")
+    print("🎉 Тесты графиков пройдены!")
+
+def test_report_deadlines():
+    """Тестирует расчет отчетов в пуле: срок с кратким ответом и отмену устаревшего запроса"""
+    print("\n⏳ Тестирование сроков отчетов...")
+    from types import SimpleNamespace
+    import time as time_module
+
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=1))
+
+    def slow(job):
+        while True:
+            job.check()
+            time_module.sleep(0.01)
+
+    async def scenario():
+        # Поток пула видит организацию обработчика
+        assert await run_report(update, 'test', lambda job: main.current_tenant().name) == "test"
+
+        # Не успел к сроку - краткий ответ вместо ошибки
+        assert await run_report(update, 'test', slow, fallback=lambda job: "кратко", deadline=0.05) == "кратко"
+        try:
+            await run_report(update, 'test', slow, deadline=0.05)
+            assert False, "без упрощенного ответа ожидалась ошибка срока"
+        except asyncio.TimeoutError:
+            pass
+
+        # Новый запрос того же отчета отменяет старый
+        old = asyncio.ensure_future(run_report(update, 'test', slow, deadline=5))
+        await asyncio.sleep(0.05)
+        assert await run_report(update, 'test', lambda job: "новый") == "новый"
+        try:
+            await old
+            assert False, "старый расчет должен быть отменен"
+        except ReportCancelled:
+            pass
+
+    # Упрощенные /categories, /suppliers и /search читают только последние дни
+    today = date.today()
+    old_day = today - timedelta(days=400)
+    records = [
+        FinanceRecord(today.strftime('%d.%m.%Y'), today, 'Расход', 'Оплата поставщику', 'Интигам', -1000.0),
+        FinanceRecord(old_day.strftime('%d.%m.%Y'), old_day, 'Расход', 'Оплата поставщику', 'Интигам', -9000.0)
+    ]
+    starts = []
+
+    def fake_records(max_age=None, start=None, end=None, category=None):
+        starts.append(start)
+        return [record for record in records if category in (None, record.category)]
+
+    tenant = TenantState("test", {'spreadsheet_id': 'test-sheet'})
+    token = CURRENT_TENANT.set(tenant)
+    original_get = main.get_finance_records
+    try:
+        asyncio.run(scenario())
+
+        main.get_finance_records = fake_records
+        job = main.ReportJob()
+        assert main.build_categories_report(None, job)[1] == 10000
+        period_name, total, _ = main.build_categories_report(None, job, brief=True)
+        assert total == 1000 and starts[-1] == today - timedelta(days=main.BRIEF_REPORT_DAYS)
+        text, _ = main.build_supplier_report('интигам', job, brief=True)
+        assert "1,000 ₽" in text and "9,000" not in text and "⏳" in text
+        text, kwargs = main.build_search_report('интигам', job, brief=True)
+        assert "Найдено: 1" in text and kwargs == {'parse_mode': 'Markdown'}
+    finally:
+        main.get_finance_records = original_get
+        CURRENT_TENANT.reset(token)
+    assert main.METRICS_COUNTERS['reports.test.fallbacks'] >= 1
+    assert main.METRICS_COUNTERS['reports.test.superseded'] >= 1
+    assert not main.RUNNING_REPORTS
+
+    print("✅ Долгие отчеты не держат бота и заменяются краткими")
+    print("🎉 Тесты сроков отчетов пройдены!")
+
+def test_status_message():
+    """Тестирует заглушку: быстрый ответ - одно сообщение, долгий - правка показанной заглушки"""
+    print("\n💬 Тестирование заглушек...")
+
+    class FakeMessage:
+        def __init__(self, chat_id, log):
+            self.chat_id = chat_id
+            self.log = log
+
+        async def reply_text(self, text, **kwargs):
+            self.log.append(('reply', text))
+            return FakeMessage(self.chat_id, self.log)
+
+        async def edit_text(self, text, **kwargs):
+            self.log.append(('edit', text))
+            return self
+
+        async def delete(self):
+            self.log.append(('delete', None))
+
+    async def scenario():
+        # Ответ готов раньше срока - заглушка не отправляется вовсе
+        fast = []
+        status = StatusMessage(FakeMessage(1, fast), "⏳ Считаю...", delay=0.2)
+        await status.finish("готово")
+        await asyncio.sleep(0.3)
+        assert fast == [('reply', "готово")], fast
+
+        # Долгий ответ заменяет показанную заглушку
+        slow = []
+        status = StatusMessage(FakeMessage(2, slow), "⏳ Считаю...", delay=0.01)
+        await asyncio.sleep(0.05)
+        await status.finish("готово")
+        assert slow == [('reply', "⏳ Считаю..."), ('edit', "готово")], slow
+
+        # Частые промежуточные правки в одном чате пропускаются
+        progress = []
+        status = StatusMessage(FakeMessage(3, progress), "⏳ Считаю...", delay=0)
+        await asyncio.sleep(0)
+        assert await status.progress("1 из 3")
+        assert not await status.progress("2 из 3")
+        await status.delete()
+        assert progress == [('reply', "⏳ Считаю..."), ('edit', "1 из 3"), ('delete', None)], progress
+
+        # Чаты без правок за последнюю секунду не копятся в памяти
+        main.note_status_edit(100, now=0.0)
+        main.note_status_edit(101, now=main.STATUS_EDIT_INTERVAL + 1)
+        assert 100 not in main.LAST_STATUS_EDIT and 101 in main.LAST_STATUS_EDIT
+
+    asyncio.run(scenario())
+
+    # Ошибка после распознавания голосового не затирает "Распознал" - приходит отдельным сообщением
+    from types import SimpleNamespace
+    voice_log = []
+
+    class FakeVoiceFile:
+        async def download_to_drive(self, path):
+            with open(path, 'wb') as f:
+                f.write(b'ogg')
+
+    async def get_file(file_id):
+        return FakeVoiceFile()
+
+    async def failing_analysis(*args, **kwargs):
+        raise RuntimeError("модель недоступна")
+
+    voice_message = FakeMessage(4, voice_log)
+    voice_message.voice = SimpleNamespace(file_id='test-voice')
+    update = SimpleNamespace(
+        message=voice_message, callback_query=None,
+        effective_user=SimpleNamespace(id=4, username=main.ALLOWED_USERNAME)
+    )
+    original_client, original_analysis = main.client, main.analyze_message_streaming
+    main.client = SimpleNamespace(audio=SimpleNamespace(transcriptions=SimpleNamespace(
+        create=lambda **kwargs: SimpleNamespace(text="такси 500")
+    )))
+    main.analyze_message_streaming = failing_analysis
+    token = CURRENT_TENANT.set(None)
+    try:
+        asyncio.run(main.handle_voice(update, SimpleNamespace(bot=SimpleNamespace(get_file=get_file))))
+    finally:
+        main.client, main.analyze_message_streaming = original_client, original_analysis
+        CURRENT_TENANT.reset(token)
+    assert voice_log[-2:] == [('edit', '📝 Распознал: "такси 500"'), ('reply', "❌ Ошибка при обработке голосового сообщения.")], voice_log
+    assert not os.path.exists("voice_test-voice.ogg")
+
+    # Заглушка не создалась - об ошибке все равно сообщается обычным ответом
+    def broken_status(*args, **kwargs):
+        raise RuntimeError("нет цикла событий")
+
+    failed_log = []
+    failed_message = FakeMessage(5, failed_log)
+    update = SimpleNamespace(
+        message=failed_message, callback_query=None,
+        effective_user=SimpleNamespace(id=5, username=main.ALLOWED_USERNAME)
+    )
+    original_status = main.StatusMessage
+    main.StatusMessage = broken_status
+    try:
+        asyncio.run(main.show_duplicates(update, SimpleNamespace(args=[])))
+    finally:
+        main.StatusMessage = original_status
+    assert failed_log == [('reply', "❌ Ошибка при поиске повторов.")], failed_log
+
+    print("✅ Быстрые ответы приходят одним сообщением, долгие - на месте заглушки")
+    print("🎉 Тесты заглушек пройдены!")
+
+def test_streamed_analysis():
+    """Тестирует потоковый ответ модели: обрыв после закрытия JSON и показ уточнения на лету"""
+    print("\n📡 Тестирование потокового ответа модели...")
+    from types import SimpleNamespace
+
+    # Фрагменты могут резать экранирование пополам
+    streamed = StreamedJson()
+    for chunk in ['{"type": "clarification", "message": "Кому \\"', 'Ба', 'лтика\\" ', '\\u0437а?"}', ' хвост']:
+        streamed.feed(chunk)
+    assert streamed.end is not None
+    assert streamed.partial_string('message') == 'Кому "Балтика" за?'
+    assert streamed.result()['message'] == 'Кому "Балтика" за?'
+
+    answer = '{"type": "clarification", "message": "Какую сумму заплатить Интигаму?", "suggestions": ["5000"]}'
+    consumed = []
+
+    class FakeStream:
+        def __init__(self, pieces):
+            self.pieces = pieces
+            self.closed = False
+
+        def __iter__(self):
+            for piece in self.pieces:
+                consumed.append(piece)
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece), finish_reason=None)])
+
+        def close(self):
+            self.closed = True
+
+    pieces = [answer[i:i + 7] for i in range(0, len(answer), 7)] + ["\n\n", "лишнее"]
+    stream = FakeStream(pieces)
+    requests = []
+
+    def create(**kwargs):
+        requests.append(kwargs)
+        return stream
+
+    completions = SimpleNamespace(create=create)
+    original_client = main.client
+    main.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    partials = []
+    early_stops = main.METRICS_COUNTERS.get('ai.analyze.early_stops', 0)
+    prompt_tokens = main.METRICS_COUNTERS.get('ai.analyze.prompt_tokens', 0)
+    estimated = main.METRICS_COUNTERS.get('ai.analyze.estimated_usage', 0)
+    try:
+        analysis = analyze_message_with_ai("заплатил интигаму", on_partial=partials.append)
+        # Оборванный поток не донес usage - токены оценены по длине запроса и ответа
+        assert requests[-1]['extra_body'] == {'stream_options': {'include_usage': True}}
+        assert main.METRICS_COUNTERS['ai.analyze.estimated_usage'] == estimated + 1
+        assert main.METRICS_COUNTERS['ai.analyze.prompt_tokens'] > prompt_tokens
+
+        # Поток дочитан до конца - учитывается usage из последнего фрагмента
+        class UsageStream(FakeStream):
+            def __iter__(self):
+                yield from super().__iter__()
+                yield SimpleNamespace(choices=[], usage=SimpleNamespace(prompt_tokens=1000, completion_tokens=20))
+
+        stream = UsageStream([answer[:-1], "}"])
+        completion_tokens = main.METRICS_COUNTERS['ai.analyze.completion_tokens']
+        analyze_message_with_ai("заплатил интигаму")
+        assert main.METRICS_COUNTERS['ai.analyze.estimated_usage'] == estimated + 1
+        assert main.METRICS_COUNTERS['ai.analyze.completion_tokens'] == completion_tokens + 20
+    finally:
+        main.client = original_client
+
+    assert analysis['type'] == 'clarification'
+    assert analysis['suggestions'] == ["5000"]
+    # Хвост после закрытой скобки не читается, поток закрыт
+    assert "лишнее" not in consumed and stream.closed
+    assert main.METRICS_COUNTERS['ai.analyze.early_stops'] == early_stops + 1
+    assert main.METRICS_TIMINGS['ai.analyze.ttfb']['count'] >= 1
+    # Вопрос показывается по мере прихода и растет
+    assert partials and partials[-1] == "Какую сумму заплатить Интигаму?"
+    assert all(partials[i + 1].startswith(partials[i]) for i in range(len(partials) - 1))
+
+    print("✅ Уточнение видно по мере ответа, лишние токены не ждем")
+    print("🎉 Тесты потокового ответа пройдены!")
+
+def test_speculative_prefetch():
+    """Тестирует упреждающую загрузку: догадку по словам и привычкам, попадания и промахи"""
+    print("\n🔮 Тестирование упреждающей загрузки...")
+    import time as time_module
+
+    tenant = TenantState("test", {'spreadsheet_id': 'test-sheet'})
+    token = CURRENT_TENANT.set(tenant)
+    loaded = []
+
+    def fake_prefetch(action):
+        time_module.sleep(0.05)
+        loaded.append((main.current_tenant().name, action))
+
+    async def scenario():
+        # Команду по ключевым словам угадывать не нужно, иной текст - скорее операция
+        assert predict_user_action(1, "аналитика за неделю") is None
+        assert predict_user_action(1, "заплатил Петрову 5000") == 'finance'
+
+        # До распознавания голоса - преобладающее из последних действий
+        assert predict_user_action(1) is None
+        for action in ['analytics', 'analytics', 'finance']:
+            note_user_action(1, action)
+        assert predict_user_action(1) == 'analytics'
+        note_user_action(1, 'search')
+        note_user_action(1, 'search')
+        assert predict_user_action(1) is None  # 2 из 5 - привычки нет
+
+        hits = main.METRICS_COUNTERS.get('prefetch.hits', 0)
+        misses = main.METRICS_COUNTERS.get('prefetch.misses', 0)
+
+        prefetch = Prefetch('analytics')
+        await asyncio.sleep(0.01)
+        await prefetch.resolve('analytics')
+        assert ("test", 'analytics') in loaded  # загрузка закончилась до ответа обработчику
+
+        prefetch = Prefetch('finance')
+        await prefetch.resolve('clarification')
+
+        assert main.METRICS_COUNTERS['prefetch.hits'] == hits + 1
+        assert main.METRICS_COUNTERS['prefetch.misses'] == misses + 1
+
+    # Лист, который уже читает упреждающая загрузка, обработчик не читает второй раз
+    reads = []
+
+    def slow_load(title):
+        reads.append(title)
+        time_module.sleep(0.05)
+        return [FinanceRecord('01.12.2024', date(2024, 12, 1), 'Расход', 'Такси', 'Яндекс', -700.0)]
+
+    def read_part():
+        return main.get_partition_records('Лист1', 60)
+
+    original_prefetch, original_load = main.prefetch_data, main.load_partition_records
+    main.prefetch_data = fake_prefetch
+    try:
+        asyncio.run(scenario())
+
+        main.load_partition_records = slow_load
+        tenant.catalog_loaded = True
+        futures = [main.REPORT_POOL.submit(main.contextvars.copy_context().run, read_part) for _ in range(3)]
+        assert all(len(future.result()) == 1 for future in futures)
+        assert reads == ['Лист1'] and tenant.ledger['version'] == 1
+        assert main.recipient_index().resolve_name("Яндекс") == "Яндекс"
+    finally:
+        main.prefetch_data, main.load_partition_records = original_prefetch, original_load
+        CURRENT_TENANT.reset(token)
+
+    # Догадка о записи ничего не создает: раздела нового месяца нет - лист не открывается
+    opened = []
+    partitioned = TenantState("test", {'spreadsheet_id': 'test-sheet', 'partitioning': 'month'})
+    partitioned.catalog_loaded = True
+    token = CURRENT_TENANT.set(partitioned)
+    original_get_worksheet = main.get_worksheet
+    main.get_worksheet = lambda title, create=False, **kwargs: opened.append((title, create))
+    try:
+        main.prefetch_data('finance')
+        assert opened == [] and partitioned.catalog == []
+        partitioned.catalog.append({'sheet': main.partition_title(main.get_moscow_time().date()), 'start': None, 'end': None, 'status': 'active'})
+        main.prefetch_data('finance')
+        assert opened == [(partitioned.catalog[0]['sheet'], False)]
+    finally:
+        main.get_worksheet = original_get_worksheet
+        CURRENT_TENANT.reset(token)
+    assert main.METRICS_TIMINGS['prefetch.saved']['count'] >= 1
+    assert "попаданий" in main.format_metrics_report()
+
+    print("✅ Данные для вероятной команды читаются, пока разбирается сообщение")
+    print("🎉 Тесты упреждающей загрузки пройдены!")
+
+def test_projected_reads():
+    """Тестирует чтение хвоста листа и отдельных колонок без загрузки всего листа"""
+    print("\n✂️ Тестирование чтения диапазонами...")
+    import re as re_module
+
+    class RangeWorksheet:
+        """Лист, который отвечает на диапазоны A1 и запоминает запросы"""
+
+        def __init__(self, rows):
+            self.rows = rows
+            self.requests = []
+
+        def _range(self, name):
+            match = re_module.fullmatch(r'([A-Z]*)(\d*):([A-Z]*)(\d*)', name)
+            first_col = ord(match.group(1)) - 64 if match.group(1) else 1
+            last_col = ord(match.group(3)) - 64 if match.group(3) else len(self.rows[0])
+            first_row = int(match.group(2) or 1)
+            last_row = int(match.group(4) or len(self.rows))
+            return [row[first_col - 1:last_col] for row in self.rows[first_row - 1:last_row]]
+
+        def get(self, name, **kwargs):
+            self.requests.append(name)
+            return self._range(name)
+
+        def batch_get(self, names, **kwargs):
+            self.requests.extend(names)
+            return [self._range(name) for name in names]
+
+        def col_values(self, column, **kwargs):
+            self.requests.append(f"col {column}")
+            return [row[column - 1] for row in self.rows]
+
+        def get_all_values(self, **kwargs):
+            raise AssertionError("весь лист читать не нужно")
+
+        def append_row(self, row, **kwargs):
+            self.rows.append(list(row))
+            return {'updates': {'updatedRange': f"'Финансы'!A{len(self.rows)}:F{len(self.rows)}"}}
+
+    rows = [['Дата', 'Тип операции', 'Категория', 'Описание/Получатель', 'Сумма', 'Комментарий']]
+    rows += [[f"{day:02d}.05.2025", 'Расход', 'Такси', f"Получатель {day}", -100 * day, ''] for day in range(1, 21)]
+    worksheet = RangeWorksheet(rows)
+    tenant = TenantState("test", {'spreadsheet_id': 'test-sheet', 'worksheet': 'Финансы'})
+    tenant.worksheets['Финансы'] = worksheet
+    token = CURRENT_TENANT.set(tenant)
+    original_note, original_state = main.note_budget_spending, main.SHARED_STATE
+    # Свое общее состояние: версии данных других тестов - не чужие записи в этот лист
+    main.SHARED_STATE = MemoryState()
+    try:
+        # История: только последние строки и только нужные колонки
+        recent = get_recent_finance_records(3, HISTORY_COLUMNS)
+        assert [record.description for record in recent] == ["Получатель 18", "Получатель 19", "Получатель 20"]
+        assert recent[-1].amount == -2000 and recent[-1].category == ''
+        assert "B19:B21" not in worksheet.requests and "D19:D21" in worksheet.requests
+
+        # Проекция колонок без границы строк
+        values = read_sheet_rows('Финансы', columns=['Сумма'])
+        assert values[0] == ['Сумма'] and len(values) == 21
+
+        # Номер записанной строки берется из ответа таблицы
+        add_finance_record({'operation_type': 'Расход', 'category': 'Такси', 'description': 'Тест', 'amount': -5}, 1)
+        assert main.get_last_operation(1)['row'] == 22
+        assert tenant.row_counts['Финансы'] == 22
+
+        # Ошибка учета после записи не выдает записанную операцию за неудачную
+        def broken_note(row):
+            raise RuntimeError("сбой учета")
+
+        main.note_budget_spending = broken_note
+        assert add_finance_record({'operation_type': 'Расход', 'category': 'Такси', 'description': 'Тест', 'amount': -7}, 1)
+        assert main.get_last_operation(1)['row'] == 23 and tenant.recipient_index is None
+    finally:
+        main.note_budget_spending, main.SHARED_STATE = original_note, original_state
+        CURRENT_TENANT.reset(token)
+
+    print("✅ Объем чтения зависит от показанного, а не от размера таблицы")
+    print("🎉 Тесты чтения диапазонами пройдены!")
+
+def test_rendered_cache():
+    """Тестирует кэш готовых ответов: ключ по аргументам и версии данных, LRU и пометку в отладке"""
+    print("\n🗂 Тестирование кэша готовых ответов...")
+
+    tenant = TenantState("test", {'spreadsheet_id': 'test-sheet'})
+    token = CURRENT_TENANT.set(tenant)
+    original_size, original_debug = main.RENDERED_CACHE_SIZE, main.REPORT_CACHE_DEBUG
+    try:
+        key = rendered_key('search', "  Петров   МЕСЯЦ ")
+        assert key == rendered_key('search', "петров месяц")
+        assert get_rendered(key) is None
+        store_rendered(key, "🔍 Найдено: 1", parse_mode='Markdown')
+        assert get_rendered(rendered_key('search', "петров месяц"))['kwargs'] == {'parse_mode': 'Markdown'}
+
+        # Запись операции меняет версию данных - прежний ответ не используется и вытесняется
+        tenant.ledger['version'] += 1
+        assert get_rendered(rendered_key('search', "петров месяц")) is None
+        store_rendered(rendered_key('categories', None), "📊 Категории")
+        assert key not in tenant.rendered
+
+        # Размер ограничен, вытесняется давно не использованный ответ
+        main.RENDERED_CACHE_SIZE = 2
+        store_rendered(rendered_key('search', "а"), "а")
+        get_rendered(rendered_key('categories', None))
+        store_rendered(rendered_key('search', "б"), "б")
+        assert [cached[1] for cached in tenant.rendered] == [(), ("б",)]
+
+        class Status:
+            async def finish(self, text, **kwargs):
+                self.text = text
+
+        main.REPORT_CACHE_DEBUG = True
+        status = Status()
+        asyncio.run(send_rendered(None, None, status, get_rendered(rendered_key('search', "б")), cached=True))
+        assert status.text == "б\n\n⚡ из кэша"
+        assert main.METRICS_COUNTERS['rendered.search.hits'] >= 2
+    finally:
+        main.RENDERED_CACHE_SIZE, main.REPORT_CACHE_DEBUG = original_size, original_debug
+        CURRENT_TENANT.reset(token)
+
+    print("✅ Повторные запросы между записями отвечаются готовым текстом")
+    print("🎉 Тесты кэша готовых ответов пройдены!")
+
+def test_shared_state():
+    """Тестирует общее состояние процессов: контекст, сброс снимка по чужой записи, блокировку и роутер"""
+    print("\n🔀 Тестирование общего состояния процессов...")
+    import threading as threading_module
+    from webhook_router import worker_for_update
+
+    original_state = main.SHARED_STATE
+    main.SHARED_STATE = MemoryState()
+    # Два процесса одной организации: у каждого свой снимок, состояние - общее
+    first = TenantState("test", {'spreadsheet_id': 'test-sheet'})
+    second = TenantState("test", {'spreadsheet_id': 'test-sheet'})
+    try:
+        token = CURRENT_TENANT.set(first)
+        update_user_context(7, {'data': {'description': 'Петров', 'amount': -5000, 'category': 'Зарплаты сотрудникам'}})
+        publish_data_change()
+        CURRENT_TENANT.reset(token)
+
+        token = CURRENT_TENANT.set(second)
+        store_ledger_part('Финансы', [])
+        version = second.ledger['version']
+        assert get_user_context(7)['recent_operations'] == ["Петров: -5,000 ₽ (Зарплаты сотрудникам)"]
+        sync_shared_state()
+        assert second.ledger['parts']['Финансы']['loaded_at'] == float('-inf')
+        assert second.ledger['version'] == version + 1
+        sync_shared_state()  # повторно сбрасывать нечего
+        assert second.ledger['version'] == version + 1
+
+        # Строки, дописанные другим процессом, дополняют счетчики бюджета и указатель повторов без пересчета
+        today = main.get_moscow_time().date()
+        second.budgets = {'Такси': 1000}
+        second.budget_spending = {'month': (today.year, today.month), 'spent': {'Такси': 100.0}}
+        second.duplicate_index = {'start': today - timedelta(days=main.DUPLICATE_WINDOW_DAYS - 1), 'days': {}}
+        first_token = CURRENT_TENANT.set(first)
+        publish_data_change([[today.strftime('%d.%m.%Y'), 'Расход', 'Такси', 'Яндекс', -300, '']])
+        CURRENT_TENANT.reset(first_token)
+        sync_shared_state()
+        assert second.budget_spending['spent']['Такси'] == 400.0
+        assert main.find_duplicate('Яндекс', -300) == 1
+        # Правка без строк - пересчет по таблице при следующей проверке
+        first_token = CURRENT_TENANT.set(first)
+        publish_data_change()
+        CURRENT_TENANT.reset(first_token)
+        sync_shared_state()
+        assert second.budget_spending is None and second.duplicate_index is None
+
+        # Запись под блокировкой: второй писатель ждет, пока первый не закончит
+        order = []
+        state = main.shared_state()
+
+        def writer(name):
+            with state.lock('append'):
+                order.append(f"{name}+")
+                time.sleep(0.02)
+                order.append(f"{name}-")
+
+        threads = [threading_module.Thread(target=writer, args=(name,)) for name in "ab"]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert order in (["a+", "a-", "b+", "b-"], ["b+", "b-", "a+", "a-"])
+        CURRENT_TENANT.reset(token)
+    finally:
+        main.SHARED_STATE = original_state
+
+    # Роутер: все обновления чата - одному процессу, нажатие кнопки - по чату сообщения
+    assert worker_for_update({'message': {'chat': {'id': 13}, 'from': {'id': 1}}}, 4) == 1
+    assert worker_for_update({'callback_query': {'from': {'id': 2}, 'message': {'chat': {'id': 13}}}}, 4) == 1
+    assert worker_for_update({'inline_query': {'from': {'id': 6}}}, 4) == 2
+
+    print("✅ Процессы видят общий контекст и сбрасывают снимок после чужой записи")
+    print("🎉 Тесты общего состояния пройдены!")
+
+def test_budget_alerts():
+    """Тестирует месячные бюджеты: пересчет по таблице, учет новых записей и предупреждения 80% и 100%"""
+    print("\n💸 Тестирование бюджетов категорий...")
+
+    tenant = TenantState("test", {'spreadsheet_id': 'test-sheet', 'budgets': {'Такси': 1000}})
+    token = CURRENT_TENANT.set(tenant)
+    try:
+        today = get_moscow_time().date()
+        last_month = today.replace(day=1) - timedelta(days=1)
+        store_ledger_part(main.current_partition(), [
+            FinanceRecord(today.strftime('%d.%m.%Y'), today, 'Расход', 'Такси', 'Яндекс', -700.0),
+            FinanceRecord(today.strftime('%d.%m.%Y'), today, 'Пополнение', 'Такси', 'Возврат', 300.0),
+            FinanceRecord(last_month.strftime('%d.%m.%Y'), last_month, 'Расход', 'Такси', 'Яндекс', -5000.0),
+            FinanceRecord(today.strftime('%d.%m.%Y'), today, 'Расход', 'Связь', 'МТС', -900.0)
+        ])
+        assert budget_spending()['spent'] == {'Такси': 700.0}
+
+        def record(amount):
+            note_budget_spending([format_moscow_date(), 'Расход', 'Такси', 'Яндекс', amount, ''])
+            return budget_alert('Такси', amount)
+
+        assert record(-50) is None
+        assert "израсходован на 85%" in record(-100)
+        assert record(-100) is None
+        assert "превышен" in record(-200)
+        assert record(-10) is None
+        assert budget_alert('Связь', -900) is None
+        assert budget_spending()['spent']['Такси'] == 1160.0
+
+        # Правка другим процессом сбрасывает счетчики - перед записью они пересчитываются по таблице в потоке
+        tenant.budget_spending = None
+        asyncio.run(main.prepare_write_checks('Такси'))
+        assert tenant.budget_spending['spent'] == {'Такси': 700.0} and tenant.duplicate_index is not None
+    finally:
+        CURRENT_TENANT.reset(token)
+
+    print("✅ Предупреждения приходят один раз при пересечении 80% и 100%")
+    print("🎉 Тесты бюджетов пройдены!")
+
+def test_duplicate_detection():
+    """Тестирует поиск повторов: проверку перед записью, сдвиг окна и проход по всей истории"""
+    print("\n🔁 Тестирование поиска повторов...")
+
+    tenant = TenantState("test", {'spreadsheet_id': 'test-sheet'})
+    token = CURRENT_TENANT.set(tenant)
+    try:
+        today = get_moscow_time().date()
+        yesterday = today - timedelta(days=1)
+        records = [
+            FinanceRecord(today.strftime('%d.%m.%Y'), today, 'Расход', 'Зарплаты сотрудникам', 'Петров', -5000.0),
+            FinanceRecord(yesterday.strftime('%d.%m.%Y'), yesterday, 'Расход', 'Такси', 'Яндекс', -700.0),
+            FinanceRecord(yesterday.strftime('%d.%m.%Y'), yesterday, 'Расход', 'Такси', 'яндекс!', -700.0),
+            FinanceRecord(yesterday.strftime('%d.%m.%Y'), yesterday, 'Расход', 'Такси', 'Яндекс', -700.0),
+            FinanceRecord(None, None, 'Расход', 'Такси', 'Яндекс', -700.0)
+        ]
+        store_ledger_part(main.current_partition(), records)
+
+        # Регистр, знаки и латинские буквы-двойники не мешают узнать повтор
+        assert find_duplicate('петров', -5000) == 1
+        assert find_duplicate('Пeтров.', -5000.0) == 1
+        assert find_duplicate('Петров', -4000) == 0
+        assert find_duplicate('Яндекс', -700) == 0  # вчерашний день вне окна
+
+        note_duplicate_key([format_moscow_date(), 'Расход', 'Такси', 'Яндекс', -700, ''])
+        assert find_duplicate('Яндекс', -700) == 1
+
+        # Со сменой дня сегодняшние операции выпадают из окна
+        tenant.duplicate_index['start'] = yesterday
+        tenant.duplicate_index['days'][yesterday] = tenant.duplicate_index['days'].pop(today)
+        assert find_duplicate('Петров', -5000) == 0
+
+        duplicates = find_ledger_duplicates(records)
+        assert [(record.description, count) for record, count in duplicates] == [('Яндекс', 3)]
+
+        # Получатель со знаками разметки не ломает Markdown отчета
+        store_ledger_part(main.current_partition(), records + [
+            FinanceRecord(today.strftime('%d.%m.%Y'), today, 'Расход', 'Такси', 'ИП *Иванов_А*', -300.0)
+        ] * 2)
+        assert "ИП \\*Иванов\\_А\\*" in main.get_duplicates_report()
+    finally:
+        CURRENT_TENANT.reset(token)
+
+    print("✅ Повтор находится до записи, а по истории - одним проходом")
+    print("🎉 Тесты поиска повторов пройдены!")
+
+def test_context_phrases():
+    """Тестирует разбор "такая же сумма", "тому же" и "обычная зарплата" по контексту и таблице без модели"""
+    print("\n🧩 Тестирование контекстных фраз...")
+
+    tenant = TenantState("test", {'spreadsheet_id': 'test-sheet'})
+    token = CURRENT_TENANT.set(tenant)
+    try:
+        today = get_moscow_time().date()
+        store_ledger_part(main.current_partition(), [
+            FinanceRecord(today.strftime('%d.%m.%Y'), today, 'Расход', 'Зарплаты сотрудникам', 'Петров', amount)
+            for amount in (-30000.0, -30000.0, -25000.0)
+        ] + [
+            FinanceRecord(today.strftime('%d.%m.%Y'), today, 'Расход', 'Оплата поставщику', 'Интигам', amount)
+            for amount in (-8000.0, -9000.0)
+        ])
+        user_context = {'recent_operations': ['Рустам: -5,000 ₽ (Зарплаты сотрудникам)', 'Яндекс такси: -650 ₽ (Такси)']}
+
+        def resolve(text, context=user_context):
+            analysis = resolve_context_phrase(text, context)
+            return analysis and (analysis['description'], analysis['amount'], analysis['category'])
+
+        assert resolve("обычная зарплата Петрову") == ('Петров', -30000.0, 'Зарплаты сотрудникам')
+        assert resolve("такая же сумма Рустаму") == ('Рустам', -650.0, 'Зарплаты сотрудникам')
+        assert resolve("тому же 2,5 тыс") == ('Яндекс такси', -2500.0, 'Такси')
+        assert resolve("как обычно Рустаму") == ('Рустам', -5000.0, 'Зарплаты сотрудникам')
+
+        # Неоднозначное разбирает модель
+        assert resolve("обычная сумма Интигаму") is None  # две суммы поровну
+        assert resolve("обычная зарплата Сидорову") is None
+        assert resolve("тому же") is None
+        assert resolve("такая же сумма Петрову", None) is None
+        assert resolve("заплатил Петрову 5000") is None  # контекстной фразы нет
+
+        # Новая запись сразу учитывается в обычной сумме
+        main.note_recipient_profile([format_moscow_date(), 'Расход', 'Оплата поставщику', 'Интигам', -9000, ''])
+        assert resolve("обычная сумма Интигаму") == ('Интигам', -9000.0, 'Оплата поставщику')
+    finally:
+        CURRENT_TENANT.reset(token)
+
+    print("✅ Ссылки на прошлые операции разбираются локально, неоднозначные - моделью")
+    print("🎉 Тесты контекстных фраз пройдены!")
+
 if __name__ == "__main__":
     print("🚀 Запуск тестов бота...\n")
     
     try:
         test_basic_functions()
         test_search_functions()
+        test_compiled_search()
+        test_voice_matcher_matches_legacy_chain()
+        test_ai_prompt_and_schema()
+        test_local_categorization()
+        test_analytics_periods()
+        test_partition_ranges()
+        test_tenant_record_budget()
+        test_ledger_store_queries()
+        test_export_periods_and_csv()
+        test_bank_statement_parsing()
+        test_finance_record_parsing()
+        test_recipient_index()
+        test_fuzzy_recipient_matching()
+        test_trends()
+        test_charts()
+        test_report_deadlines()
+        test_status_message()
+        test_streamed_analysis()
+        test_speculative_prefetch()
+        test_projected_reads()
+        test_rendered_cache()
+        test_shared_state()
+        test_budget_alerts()
+        test_duplicate_detection()
+        test_context_phrases()
         print("\n✅ Все тесты успешно пройдены!")
         print("📊 Бот готов к работе!")
         
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Роутер вебхука Telegram для нескольких процессов бота.
+
+Принимает обновления на внешнем адресе (WEBHOOK_URL указывает сюда) и передает каждое
+процессу, который отвечает за чат: номер чата по модулю WORKER_COUNT. Так все
+сообщения и кнопки одного чата обрабатывает один процесс, а общее между процессами
+состояние (контекст, последние операции, версия данных) хранится в Redis.
+
+Пример (4 процесса):
+    python3 webhook_router.py
+    WORKER_INDEX=0 python3 main.py   # ... и так для WORKER_INDEX от 0 до 3
+с переменными WORKER_COUNT=4, STATE_BACKEND=redis, WEBHOOK_URL=https://.../telegram
+"""
+
+import json
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import WORKER_COUNT, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, ROUTER_PORT
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# Сколько секунд ждать ответа процесса (Telegram повторит обновление, если роутер не ответил)
+FORWARD_TIMEOUT = 10
+
+def update_chat_id(update):
+    """Номер чата обновления (для нажатий кнопок - чат сообщения с кнопкой; 0, если чата нет)"""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        if value.get('from'):
+            return value['from']['id']
+    return 0
+
+def worker_for_update(update, worker_count=WORKER_COUNT):
+    """Номер процесса, который обрабатывает чат обновления"""
+    return update_chat_id(update) % worker_count
+
+class RouterHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path.strip('/') != WEBHOOK_PATH:
+            self.send_error(404)
+            return
+        if WEBHOOK_SECRET and self.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            self.send_error(403)
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            worker = worker_for_update(json.loads(body))
+        except (ValueError, AttributeError):
+            self.send_error(400)
+            return
+
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{WEBHOOK_PORT + worker}/{WEBHOOK_PATH}",
+            data=body,
+            headers={'Content-Type': 'application/json', **({SECRET_HEADER: WEBHOOK_SECRET} if WEBHOOK_SECRET else {})}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=FORWARD_TIMEOUT) as response:
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except OSError as e:
+            # Процесс недоступен - Telegram повторит доставку позже
+            self.log_error("процесс %d недоступен: %s", worker, e)
+            status = 502
+        self.send_response(status)
+        self.end_headers()
+
+def main():
+    server = ThreadingHTTPServer(('0.0.0.0', ROUTER_PORT), RouterHandler)
+    print(f"🌐 Роутер вебхука: порт {ROUTER_PORT}, процессов {WORKER_COUNT} (порты {WEBHOOK_PORT}-{WEBHOOK_PORT + WORKER_COUNT - 1})")
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()